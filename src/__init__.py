@@ -3,6 +3,9 @@ def __getattr__(name):
     This means `from src import app`, or `uvicorn src:app` works while allowing settings to be imported
     without importing views.
     """
+    if name != 'app':
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
     from .views import app
 
     return app
@@ -0,0 +1,133 @@
+"""
+Cache of each repo's collaborators, who are the reviewers when a repo's config has no `reviewers`.
+
+Rosters are stored in redis as lists for `collaborators_cache_timeout` seconds and in process for
+`collaborators_local_cache_timeout` seconds, they're cleared by "member", "membership" and "team" events.
+Lists keep GitHub's order, so reviewers are assigned in the same order as when rosters weren't cached.
+When a repo's roster isn't cached, `is_collaborator` checks the single user's access instead of fetching
+every page of collaborators.
+"""
+from collections import OrderedDict
+from time import time
+
+from . import stats
+from .github_client import Repository as GhRepository
+from .redis_client import get_redis_async
+from .settings import Settings
+
+__all__ = (
+    'get_collaborators',
+    'is_collaborator',
+    'invalidate_collaborators',
+    'invalidate_org_collaborators',
+    'clear_collaborators_cache',
+    'collaborators_cache_stats',
+)
+# repo full name -> (expiry timestamp, logins in GitHub's order, the same logins as a set for membership checks)
+_local: 'OrderedDict[str, tuple[float, tuple[str, ...], frozenset[str]]]' = OrderedDict()
+# logins can't be empty, so this starts every list in redis to store repos without collaborators
+_ROSTER_MARKER = ''
+
+
+async def get_collaborators(gh_repo: GhRepository, settings: Settings) -> tuple[str, ...]:
+    """
+    Get the logins of the repo's collaborators in the order GitHub returns them, from the cache or GitHub.
+    """
+    if (cached := await _get_cached(gh_repo.full_name, settings)) is not None:
+        return cached[0]
+
+    stats.incr('collaborators.fetched')
+    roster = tuple([u.login async for u in gh_repo.get_collaborators()])
+    owner = gh_repo.full_name.split('/', 1)[0]
+    async with get_redis_async(settings).pipeline(transaction=True) as pipe:
+        roster_key = _cache_key(gh_repo.full_name)
+        pipe.delete(roster_key)
+        pipe.rpush(roster_key, _ROSTER_MARKER, *roster)
+        pipe.expire(roster_key, settings.collaborators_cache_timeout)
+        # so all of an organisation's rosters can be cleared by "membership" events
+        pipe.sadd(_org_key(owner), gh_repo.full_name)
+        pipe.expire(_org_key(owner), settings.collaborators_cache_timeout)
+        await pipe.execute()
+    _set_local(gh_repo.full_name, roster, settings)
+    return roster
+
+
+async def is_collaborator(gh_repo: GhRepository, login: str, settings: Settings) -> bool:
+    """
+    Check if `login` is a collaborator using the cached roster if available, otherwise by asking GitHub about
+    just that user.
+    """
+    if (cached := await _get_cached(gh_repo.full_name, settings)) is not None:
+        return login in cached[1]
+
+    stats.incr('collaborators.permission_checked')
+    return await gh_repo.is_collaborator(login)
+
+
+async def invalidate_collaborators(repo_full_name: str, settings: Settings) -> None:
+    _local.pop(repo_full_name, None)
+    async with get_redis_async(settings).pipeline(transaction=True) as pipe:
+        pipe.delete(_cache_key(repo_full_name))
+        pipe.srem(_org_key(repo_full_name.split('/', 1)[0]), repo_full_name)
+        await pipe.execute()
+
+
+async def invalidate_org_collaborators(org: str, settings: Settings) -> int:
+    """
+    Forget the rosters of all the organisation's repos, returns the number of repos whose roster was cached.
+    """
+    redis_client = get_redis_async(settings)
+    repos = {r.decode() for r in await redis_client.smembers(_org_key(org))}
+    repos.update(repo for repo in list(_local) if repo.startswith(f'{org}/'))
+    for repo in repos:
+        _local.pop(repo, None)
+    await redis_client.delete(_org_key(org), *(_cache_key(repo) for repo in repos))
+    return len(repos)
+
+
+async def _get_cached(repo_full_name: str, settings: Settings) -> tuple[tuple[str, ...], frozenset[str]] | None:
+    if local := _local.get(repo_full_name):
+        expires, roster, members = local
+        if expires > time():
+            stats.incr('collaborators.local_hit')
+            _local.move_to_end(repo_full_name)
+            return roster, members
+
+    logins = await get_redis_async(settings).lrange(_cache_key(repo_full_name), 0, -1)
+    if not logins:
+        stats.incr('collaborators.miss')
+        return None
+
+    stats.incr('collaborators.redis_hit')
+    roster = tuple(login.decode() for login in logins[1:])
+    return roster, _set_local(repo_full_name, roster, settings)
+
+
+def _set_local(repo_full_name: str, roster: tuple[str, ...], settings: Settings) -> frozenset[str]:
+    members = frozenset(roster)
+    _local[repo_full_name] = time() + settings.collaborators_local_cache_timeout, roster, members
+    _local.move_to_end(repo_full_name)
+    while len(_local) > settings.collaborators_local_cache_size:
+        _local.popitem(last=False)
+    return members
+
+
+def _cache_key(repo_full_name: str) -> str:
+    return f'collaborators_{repo_full_name}'
+
+
+def _org_key(org: str) -> str:
+    return f'collaborators_repos_{org}'
+
+
+def clear_collaborators_cache() -> None:
+    _local.clear()
+
+
+def collaborators_cache_stats() -> dict[str, float | int | None]:
+    hits = stats.counter('collaborators.local_hit') + stats.counter('collaborators.redis_hit')
+    total = hits + stats.counter('collaborators.miss')
+    return {'hit_rate': round(hits / total, 4) if total else None, 'local_size': len(_local)}
+
+
+stats.register_gauge('collaborators.cache', collaborators_cache_stats)
@@ -0,0 +1,62 @@
+"""
+Deduplication of webhook deliveries using the `X-GitHub-Delivery` header.
+
+The first time a delivery ID is seen it's claimed with `SET NX` for `delivery_pending_timeout` seconds, once
+processed the response is stored under the same key so redeliveries can be answered without doing any work.
+Events which are queued are saved by the worker that processes them, if processing fails the claim is released
+so the delivery can be redelivered.
+"""
+import json
+from dataclasses import dataclass
+
+from . import stats
+from .redis_client import get_redis_async
+from .settings import Settings
+
+__all__ = 'DeliveryResult', 'claim_delivery', 'save_delivery_result', 'release_delivery'
+_PENDING = b'pending'
+
+stats.register_gauge('deliveries.duplicate_rate', lambda: stats.hit_rate('deliveries.duplicate', 'deliveries.new'))
+
+
+@dataclass
+class DeliveryResult:
+    status_code: int
+    message: str
+
+
+async def claim_delivery(delivery_id: str, settings: Settings) -> DeliveryResult | None:
+    """
+    Claim a delivery, returns `None` if the delivery is new, otherwise the result of processing the delivery.
+    """
+    redis_client = get_redis_async(settings)
+    key = _cache_key(delivery_id)
+    if await redis_client.set(key, _PENDING, nx=True, ex=settings.delivery_pending_timeout):
+        stats.incr('deliveries.new')
+        return None
+
+    stats.incr('deliveries.duplicate')
+    cached = await redis_client.get(key)
+
+    if cached is None or cached == _PENDING:
+        return DeliveryResult(202, f'Delivery {delivery_id} is already being processed')
+    else:
+        return DeliveryResult(**json.loads(cached))
+
+
+async def save_delivery_result(delivery_id: str, result: DeliveryResult, settings: Settings) -> None:
+    redis_client = get_redis_async(settings)
+    value = json.dumps({'status_code': result.status_code, 'message': result.message})
+    await redis_client.set(_cache_key(delivery_id), value, ex=settings.delivery_dedup_timeout)
+
+
+async def release_delivery(delivery_id: str, settings: Settings) -> None:
+    """
+    Forget about a delivery which failed, so it can be redelivered.
+    """
+    redis_client = get_redis_async(settings)
+    await redis_client.delete(_cache_key(delivery_id))
+
+
+def _cache_key(delivery_id: str) -> str:
+    return f'delivery_{delivery_id}'
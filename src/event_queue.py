@@ -0,0 +1,101 @@
+import asyncio
+from contextlib import suppress
+from dataclasses import dataclass
+from textwrap import indent
+from time import perf_counter
+
+from redis import RedisError
+
+from . import stats
+from .deliveries import DeliveryResult, release_delivery, save_delivery_result
+from .logic import process_event
+from .settings import Settings, log
+
+__all__ = ('EventQueue',)
+
+
+@dataclass
+class QueuedEvent:
+    request_body: bytes
+    event_name: str | None
+    queued_at: float
+    delivery_id: str | None = None
+
+
+class EventQueue:
+    """
+    Bounded in-process queue of verified webhook bodies, processed by `settings.queue_workers` workers.
+
+    Used when `settings.event_processing == 'queue'` so the webhook endpoint can respond immediately.
+    """
+
+    def __init__(self, settings: Settings):
+        self.settings = settings
+        self._queue: asyncio.Queue[QueuedEvent] | None = None
+        self._workers: list[asyncio.Task] = []
+        stats.register_gauge('queue.depth', self.depth)
+
+    def start(self) -> None:
+        self._queue = asyncio.Queue(maxsize=self.settings.queue_max_size)
+        self._workers = [asyncio.create_task(self._worker(n)) for n in range(self.settings.queue_workers)]
+        log(f'Event queue started with {self.settings.queue_workers} workers')
+
+    def put(self, request_body: bytes, event_name: str | None, delivery_id: str | None = None) -> bool:
+        """
+        Add an event to the queue, returns `False` if the queue is full.
+        """
+        assert self._queue is not None, 'event queue not started'
+        try:
+            self._queue.put_nowait(QueuedEvent(request_body, event_name, perf_counter(), delivery_id))
+        except asyncio.QueueFull:
+            stats.incr('queue.rejected')
+            return False
+        else:
+            stats.incr('queue.accepted')
+            return True
+
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def drain(self) -> None:
+        """
+        Wait for queued events to be processed (up to `settings.queue_drain_timeout`), then stop the workers.
+        """
+        if self._queue is None:
+            return
+        log(f'Draining event queue, {self.depth()} events waiting')
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=self.settings.queue_drain_timeout)
+        except asyncio.TimeoutError:
+            log(f'Event queue drain timed out, {self.depth()} events dropped')
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = None
+
+    async def _worker(self, worker_id: int) -> None:
+        assert self._queue is not None
+        while True:
+            event = await self._queue.get()
+            stats.record_time('queue.wait', perf_counter() - event.queued_at)
+            try:
+                with stats.timer('queue.process'):
+                    action_taken, message = await process_event(
+                        request_body=event.request_body, settings=self.settings, event_name=event.event_name
+                    )
+                message = message if action_taken else f'{message}, no action taken'
+                log(message)
+                if event.delivery_id:
+                    result = DeliveryResult(200 if action_taken else 202, message)
+                    await save_delivery_result(event.delivery_id, result, self.settings)
+            except Exception as e:
+                stats.incr('queue.errors')
+                log(f'worker {worker_id}: error processing event:')
+                log(indent(f'{type(e).__name__}: {e}', '  '))
+                if event.delivery_id:
+                    # so the delivery can be redelivered, if redis is down the claim expires anyway
+                    with suppress(RedisError):
+                        await release_delivery(event.delivery_id, self.settings)
+            finally:
+                self._queue.task_done()
@@ -1,63 +1,293 @@
+import asyncio
+import functools
 import typing
+from datetime import datetime
+from pathlib import Path
+from textwrap import indent
 from time import time
 
 import jwt
-import redis
+import redis.asyncio
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.backends.openssl.backend import Backend as OpenSSLBackend
-from github import Auth, Github, Repository as GhRepository
-from requests import Session
+from cryptography.hazmat.primitives.asymmetric.rsa import RSAPrivateKey
+from httpx import Response
 
+from . import stats
+from .github_client import GithubClient, Repository as GhRepository
+from .http_session import get_http_client
+from .rate_limit import get_rate_limiter
+from .redis_client import get_redis_async
+from .response_cache import ResponseCache
 from .settings import Settings, log
 
-__all__ = 'get_repo_client', 'GithubContext'
+__all__ = (
+    'get_repo_client',
+    'refresh_tokens',
+    'refresh_tokens_periodically',
+    'prepare_installation',
+    'forget_installation',
+    'clear_token_cache',
+)
 github_base_url = 'https://api.github.com'
+# seconds before an access token expires to stop using it
+token_expiry_margin = 100
+# repo full name -> installation ID
+_installations: dict[str, int] = {}
+# installation ID -> (access token, time after which the token shouldn't be used)
+_access_tokens: dict[int, tuple[str, float]] = {}
+# installation ID -> time the installation was last used, used to decide which tokens to refresh
+_last_used: dict[int, float] = {}
+# installation ID -> lock held while creating an access token
+_create_locks: dict[int, asyncio.Lock] = {}
+# seconds before the app JWT expires to stop using it
+app_jwt_expiry_margin = 10
+# (JWT, expiry timestamp)
+_app_jwt: tuple[str, int] | None = None
 
 
-def get_repo_client(repo_full_name: str, settings: Settings) -> 'GithubContext':
+async def get_repo_client(repo_full_name: str, settings: Settings, installation_id: int | None = None) -> GhRepository:
     """
-    This could all be async, but since it's call from sync code (that can't be async because of GitHub)
-    there's no point in making it async.
+    Get a client for a repo, authenticated as the app's installation on the repo.
+
+    Access tokens are shared by all repos in an installation, the installation ID is taken from the event
+    if available, otherwise it's looked up. Installation IDs and access tokens are looked up in the in-process
+    cache, then redis, before calling GitHub.
+    """
+    if installation_id is None:
+        installation_id = _installations.get(repo_full_name)
+    if installation_id is not None:
+        _last_used[installation_id] = time()
+        if access_token := _get_local_token(installation_id):
+            stats.incr('tokens.local_hit')
+            return _repo_client(access_token, installation_id, repo_full_name, settings)
+
+    redis_client = get_redis_async(settings)
+    if installation_id is None:
+        installation_id = await _get_installation_id(redis_client, repo_full_name, settings)
+        _last_used[installation_id] = time()
+    access_token = await _get_access_token(redis_client, installation_id, settings)
+    return _repo_client(access_token, installation_id, repo_full_name, settings)
+
+
+def _repo_client(access_token: str, installation_id: int, repo_full_name: str, settings: Settings) -> GhRepository:
+    # connections come from the shared pool, see `http_session`
+    client = GithubClient(
+        access_token,
+        github_base_url,
+        settings.github_pool_size,
+        ResponseCache(settings),
+        get_rate_limiter(installation_id, settings),
+        functools.partial(_renew_client, repo_full_name, installation_id, settings),
+    )
+    return GhRepository(client, repo_full_name)
+
+
+async def _renew_client(repo_full_name: str, installation_id: int, settings: Settings) -> GithubClient:
+    repo = await get_repo_client(repo_full_name, settings, installation_id)
+    return repo.client
+
+
+async def refresh_tokens(settings: Settings) -> int:
+    """
+    Renew access tokens which expire within `settings.token_refresh_before` seconds for installations used in the
+    last `settings.token_active_window` seconds, so events never have to wait for a token to be created.
+
+    Returns the number of tokens checked in redis or renewed, errors for one installation, e.g. because the app
+    has been suspended, are logged so other installations' tokens are still renewed.
+    """
+    now = time()
+    active = []
+    for installation_id, last_used in list(_last_used.items()):
+        if now - last_used < settings.token_active_window:
+            active.append(installation_id)
+        else:
+            _last_used.pop(installation_id, None)
+
+    to_refresh = [i for i in active if not _get_local_token(i, settings.token_refresh_before)]
+    refreshed = 0
+    if to_refresh:
+        redis_client = get_redis_async(settings)
+        for installation_id in to_refresh:
+            try:
+                await _get_access_token(redis_client, installation_id, settings, settings.token_refresh_before)
+            except Exception as e:
+                stats.incr('tokens.refresh_errors')
+                log(f'Error refreshing access token for installation {installation_id}:')
+                log(indent(f'{type(e).__name__}: {e}', '  '))
+            else:
+                refreshed += 1
+    return refreshed
+
+
+async def refresh_tokens_periodically(settings: Settings) -> None:
+    while True:
+        await asyncio.sleep(settings.token_refresh_interval)
+        try:
+            await refresh_tokens(settings)
+        except Exception as e:
+            log('Error refreshing access tokens:')
+            log(indent(f'{type(e).__name__}: {e}', '  '))
+
+
+async def prepare_installation(installation_id: int, repo_full_names: list[str], settings: Settings) -> None:
+    """
+    Record the repos in an installation and create an access token, before any events for the installation arrive.
     """
-    with redis.from_url(str(settings.redis_dsn)) as redis_client:
-        cache_key = f'github_access_token_{repo_full_name}'
-        if access_token := redis_client.get(cache_key):
-            access_token = access_token.decode()
-            log(f'Using cached access token {access_token:.7}... for {repo_full_name}')
-            return GithubContext(access_token, repo_full_name)
+    _last_used[installation_id] = time()
+    redis_client = get_redis_async(settings)
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for repo_full_name in repo_full_names:
+            _installations[repo_full_name] = installation_id
+            pipe.setex(f'github_installation_{repo_full_name}', settings.installation_cache_timeout, installation_id)
+        await pipe.execute()
+    await _get_access_token(redis_client, installation_id, settings)
 
-        pem_bytes = settings.github_app_secret_key.read_bytes()
 
-        private_key = typing.cast(OpenSSLBackend, default_backend()).load_pem_private_key(pem_bytes, None, False)
+async def forget_installation(installation_id: int, settings: Settings) -> None:
+    _last_used.pop(installation_id, None)
+    _access_tokens.pop(installation_id, None)
+    await get_redis_async(settings).delete(f'github_access_token_{installation_id}')
 
-        now = int(time())
-        payload = {'iat': now - 30, 'exp': now + 60, 'iss': settings.github_app_id}
-        jwt_value = jwt.encode(payload, private_key, algorithm='RS256')
 
-        with Session() as session:
-            session.headers.update({'Authorization': f'Bearer {jwt_value}', 'Accept': 'application/vnd.github+json'})
-            r = session.get(f'{github_base_url}/repos/{repo_full_name}/installation')
-            r.raise_for_status()
-            installation_id = r.json()['id']
+def _get_local_token(installation_id: int, min_remaining: float = 0) -> str | None:
+    if cached := _access_tokens.get(installation_id):
+        access_token, expires = cached
+        if expires - min_remaining > time():
+            return access_token
 
-            r = session.post(f'{github_base_url}/app/installations/{installation_id}/access_tokens')
-            r.raise_for_status()
-            access_token = r.json()['token']
 
-        # access token's lifetime is 1 hour
-        # https://docs.github.com/en/rest/apps/apps#create-an-installation-access-token-for-an-app
-        redis_client.setex(cache_key, 3600 - 100, access_token)
-        log(f'Created new access token {access_token:.7}... for {repo_full_name}')
-        return GithubContext(access_token, repo_full_name)
+async def _get_redis_token(
+    redis_client: redis.asyncio.Redis, installation_id: int, min_remaining: float = 0
+) -> str | None:
+    async with redis_client.pipeline() as pipe:
+        pipe.get(f'github_access_token_{installation_id}')
+        pipe.ttl(f'github_access_token_{installation_id}')
+        access_token, ttl = await pipe.execute()
+    if access_token and ttl > min_remaining:
+        access_token = access_token.decode()
+        _access_tokens[installation_id] = access_token, time() + ttl
+        return access_token
 
 
-class GithubContext:
-    def __init__(self, access_token: str, repo_full_name: str):
-        self._gh = Github(auth=Auth.Token(access_token), base_url=github_base_url)
-        self._repo = self._gh.get_repo(repo_full_name)
+async def _get_installation_id(redis_client: redis.asyncio.Redis, repo_full_name: str, settings: Settings) -> int:
+    cache_key = f'github_installation_{repo_full_name}'
+    if installation_id := await redis_client.get(cache_key):
+        installation_id = int(installation_id)
+    else:
+        r = await _app_request('GET', f'/repos/{repo_full_name}/installation', settings)
+        installation_id = int(r.json()['id'])
+        await redis_client.setex(cache_key, settings.installation_cache_timeout, installation_id)
+        log(f'Found installation {installation_id} for {repo_full_name}')
+
+    _installations[repo_full_name] = installation_id
+    return installation_id
+
+
+async def _get_access_token(
+    redis_client: redis.asyncio.Redis, installation_id: int, settings: Settings, min_remaining: float = 0
+) -> str:
+    """
+    Get an access token with at least `min_remaining` seconds before it expires.
+
+    Only one task per process, and one process across all workers, creates a token for an installation at once,
+    others wait and then use the new token.
+    """
+    if access_token := _get_local_token(installation_id, min_remaining):
+        stats.incr('tokens.local_hit')
+        return access_token
+    if access_token := await _get_redis_token(redis_client, installation_id, min_remaining):
+        stats.incr('tokens.redis_hit')
+        return access_token
+
+    async with _get_create_lock(installation_id):
+        # another task may have created the token while we were waiting for the lock
+        if access_token := _get_local_token(installation_id, min_remaining):
+            stats.incr('tokens.waited')
+            return access_token
+
+        lock_key = f'github_access_token_lock_{installation_id}'
+        async with redis_client.lock(
+            lock_key, timeout=settings.token_lock_timeout, blocking_timeout=settings.token_lock_timeout
+        ):
+            if access_token := await _get_redis_token(redis_client, installation_id, min_remaining):
+                stats.incr('tokens.waited')
+                return access_token
+
+            r = await _app_request('POST', f'/app/installations/{installation_id}/access_tokens', settings)
+            access_token, lifetime = _token_lifetime(r.json())
+
+            # stop using the token a little before it expires
+            cache_time = lifetime - token_expiry_margin
+            await redis_client.setex(f'github_access_token_{installation_id}', cache_time, access_token)
+            _access_tokens[installation_id] = access_token, time() + cache_time
+
+    stats.incr('tokens.created')
+    log(f'Created new access token {access_token:.7}... for installation {installation_id}')
+    return access_token
+
+
+def _get_create_lock(installation_id: int) -> asyncio.Lock:
+    return _create_locks.setdefault(installation_id, asyncio.Lock())
+
+
+async def _app_request(method: str, path: str, settings: Settings) -> Response:
+    """
+    Make a request to GitHub authenticated as the app rather than an installation.
+    """
+    headers = {'Authorization': f'Bearer {_get_app_jwt(settings)}', 'Accept': 'application/vnd.github+json'}
+    client = get_http_client(settings.github_pool_size)
+    r = await client.request(method, f'{github_base_url}{path}', headers=headers)
+    r.raise_for_status()
+    return r
+
+
+def _get_app_jwt(settings: Settings) -> str:
+    """
+    Get a JWT to authenticate as the app, JWTs are reused until shortly before they expire so signing happens
+    about once a minute.
+    """
+    global _app_jwt
+    now = int(time())
+    if _app_jwt is not None:
+        jwt_value, expires = _app_jwt
+        if expires - app_jwt_expiry_margin > now:
+            return jwt_value
+
+    private_key = _load_private_key(settings.github_app_secret_key)
+    expires = now + 60
+    payload = {'iat': now - 30, 'exp': expires, 'iss': settings.github_app_id}
+    jwt_value = jwt.encode(payload, private_key, algorithm='RS256')
+    _app_jwt = jwt_value, expires
+    stats.incr('tokens.jwt_created')
+    return jwt_value
+
+
+@functools.cache
+def _load_private_key(key_path: Path) -> 'RSAPrivateKey':
+    pem_bytes = key_path.read_bytes()
+    return typing.cast(OpenSSLBackend, default_backend()).load_pem_private_key(pem_bytes, None, False)
+
+
+def _token_lifetime(data: dict[str, typing.Any]) -> tuple[str, int]:
+    """
+    Get the access token and its remaining lifetime in seconds from the access token response.
+
+    Access token's lifetime is 1 hour
+    https://docs.github.com/en/rest/apps/apps#create-an-installation-access-token-for-an-app
+    """
+    if expires_at := data.get('expires_at'):
+        lifetime = int(datetime.fromisoformat(expires_at).timestamp() - time())
+    else:
+        lifetime = 3600
+    return data['token'], lifetime
 
-    def __enter__(self) -> GhRepository:
-        return self._repo
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self._gh._Github__requester._Requester__connection.session.close()
+def clear_token_cache() -> None:
+    global _app_jwt
+    _app_jwt = None
+    _installations.clear()
+    _access_tokens.clear()
+    _last_used.clear()
+    # asyncio locks belong to an event loop
+    _create_locks.clear()
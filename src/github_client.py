@@ -0,0 +1,477 @@
+"""
+Async client for the parts of the GitHub API hooky uses, so events can be processed on the event loop
+without tying up a thread while waiting for GitHub.
+
+Objects are built from identifiers in the webhook payload, details are only fetched when they're used.
+GET requests are made conditionally when a previous response is cached, see `response_cache`, and requests
+are scheduled within the installation's rate limit, see `rate_limit`.
+Methods are named after the PyGithub methods they replace.
+"""
+import base64
+import json
+import typing
+from contextlib import nullcontext
+from urllib.parse import quote, urlsplit
+
+import httpx
+from pydantic import BaseModel, Field
+
+from .http_session import get_http_client
+from .rate_limit import RateLimiter, RateLimitExceeded
+from .response_cache import CachedResponse, ResponseCache, record_request
+
+__all__ = (
+    'GithubError',
+    'GithubClient',
+    'Repository',
+    'PullRequest',
+    'Issue',
+    'IssueComment',
+    'Commit',
+    'ContentFile',
+    'Blob',
+    'PullRequestFile',
+    'User',
+    'Label',
+)
+T = typing.TypeVar('T', bound=BaseModel)
+
+
+class GithubError(Exception):
+    def __init__(self, status: int, data: typing.Any):
+        super().__init__(status, data)
+        self.status = status
+        self.data = data
+
+    def __str__(self) -> str:
+        return f'{self.status} {json.dumps(self.data)}'
+
+
+class User(BaseModel):
+    login: str
+
+
+class Label(BaseModel):
+    name: str
+
+
+class ContentFile(BaseModel):
+    # git blob SHA
+    sha: str
+    # base64 encoded
+    content: str
+
+
+class Blob(BaseModel):
+    # git blob SHA
+    oid: str
+    # `None` for binary files
+    text: str | None = None
+    is_truncated: bool = Field(False, alias='isTruncated')
+
+
+class PullRequestFile(BaseModel):
+    filename: str
+    status: str
+
+
+class Branch(BaseModel):
+    ref: str
+    sha: str | None = None
+
+
+class PullRequestDetails(BaseModel):
+    body: str | None = None
+    base: Branch
+    head: Branch | None = None
+
+
+class IssueDetails(BaseModel):
+    labels: list[Label] = []
+    assignees: list[User] = []
+
+
+class GithubClient:
+    """
+    Makes requests to the GitHub API authenticated as an installation.
+    """
+
+    rate_limit_retries = 2
+
+    def __init__(
+        self,
+        access_token: str,
+        base_url: str,
+        pool_size: int,
+        cache: ResponseCache | None = None,
+        rate_limiter: RateLimiter | None = None,
+        renew: 'typing.Callable[[], typing.Awaitable[GithubClient]] | None' = None,
+    ):
+        self.base_url = base_url
+        self.pool_size = pool_size
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        # gets a client with a current access token, for requests made after this client's token may have expired
+        self.renew = renew
+        self._headers = {'Authorization': f'token {access_token}', 'Accept': 'application/vnd.github+json'}
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        *,
+        params: dict[str, typing.Any] | None = None,
+        json_data: typing.Any = None,
+        headers: dict[str, str] | None = None,
+        write: bool | None = None,
+        resource: str = 'core',
+    ) -> httpx.Response:
+        """
+        Make a request, `path` may be relative to `base_url` or a full URL, e.g. from a "Link" header.
+
+        Requests which hit a rate limit are retried once the limit lifts. Writes are serialised per installation,
+        `write` defaults to `True` for all methods except GET. `resource` is the rate limit the request counts
+        against.
+        """
+        if write is None:
+            write = method != 'GET'
+        limiter = self.rate_limiter
+        http_client = get_http_client(self.pool_size)
+        for attempt in range(self.rate_limit_retries + 1):
+            if limiter is None:
+                slot = nullcontext()
+            else:
+                await limiter.wait(resource)
+                slot = limiter.write_slot() if write else nullcontext()
+            async with slot:
+                r = await http_client.request(
+                    method, self._url(path), params=params, json=json_data, headers={**self._headers, **(headers or {})}
+                )
+            if limiter is None or not limiter.update(r.status_code, r.headers, r.text, resource):
+                break
+
+        if r.status_code >= 400:
+            raise GithubError(r.status_code, _response_data(r))
+        return r
+
+    async def request_non_urgent(self, method: str, path: str, *, json_data: typing.Any = None) -> None:
+        """
+        Make a request which isn't needed to process the event, it's deferred if the installation's budget is low.
+        """
+        if self.rate_limiter is not None and self.rate_limiter.budget_low():
+            self.rate_limiter.defer(self._deferred_request(method, path, json_data))
+        else:
+            await self.request(method, path, json_data=json_data)
+
+    async def _deferred_request(self, method: str, path: str, json_data: typing.Any) -> None:
+        # deferred requests run up to an hour later, the access token is only looked up when the request is made
+        client = await self.renew() if self.renew is not None else self
+        await client.request(method, path, json_data=json_data)
+
+    async def get(self, path: str, *, params: dict[str, typing.Any] | None = None) -> httpx.Response:
+        """
+        Make a GET request, conditionally if the response for the same URL is cached.
+        """
+        if self.cache is None:
+            return await self.request('GET', path, params=params)
+
+        url = str(httpx.URL(self._url(path), params=params))
+        endpoint = _endpoint_name(url)
+        cached = await self.cache.get(url)
+        r = await self.request('GET', url, headers=cached.conditional_headers() if cached else None)
+        if cached and r.status_code == 304:
+            record_request(endpoint, 'not_modified')
+            return httpx.Response(200, headers=cached.headers(), content=cached.content, request=r.request)
+
+        record_request(endpoint, 'stale' if cached else 'miss')
+        etag, last_modified = r.headers.get('ETag'), r.headers.get('Last-Modified')
+        if etag or last_modified:
+            await self.cache.set(url, CachedResponse(etag, last_modified, r.headers.get('Link'), r.content))
+        return r
+
+    async def graphql(self, query: str, variables: dict[str, typing.Any]) -> dict[str, typing.Any]:
+        """
+        Make a GraphQL query, GraphQL has its own rate limit which is reported with a "RATE_LIMITED" error in a
+        200 response, limited queries are retried once the limit lifts, `RateLimitExceeded` is raised if they're
+        still limited.
+        """
+        for attempt in range(self.rate_limit_retries + 1):
+            r = await self.request(
+                'POST', '/graphql', json_data={'query': query, 'variables': variables}, write=False, resource='graphql'
+            )
+            response = r.json()
+            errors = response.get('errors')
+            if self.rate_limiter is None or not any(e.get('type') == 'RATE_LIMITED' for e in errors or []):
+                break
+            self.rate_limiter.limited('graphql')
+        else:
+            raise RateLimitExceeded(f'GraphQL rate limited: {errors}')
+
+        if errors:
+            raise GithubError(r.status_code, errors)
+        return response['data']
+
+    async def paginate(
+        self, path: str, model: type[T], *, params: dict[str, typing.Any] | None = None
+    ) -> typing.AsyncIterator[T]:
+        """
+        Iterate over the items of a list endpoint, following "next" links.
+        """
+        url: str | None = path
+        while url is not None:
+            r = await self.get(url, params=params)
+            for item in r.json():
+                yield model.model_validate(item)
+            # the next link includes all query parameters
+            params = None
+            url = r.links.get('next', {}).get('url')
+
+    def _url(self, path: str) -> str:
+        return path if path.startswith(('http://', 'https://')) else f'{self.base_url}{path}'
+
+
+def _endpoint_name(url: str) -> str:
+    """
+    Name of an endpoint for stats, e.g. "pulls.files" for `/repos/{owner}/{repo}/pulls/{number}/files`.
+    """
+    parts = urlsplit(url).path.strip('/').split('/')
+    if parts[0] == 'repos':
+        parts = parts[3:]
+    name = []
+    for part in parts:
+        if not part.isdigit():
+            name.append(part)
+        if part == 'contents':
+            # the rest is the file path
+            break
+    return '.'.join(name) or 'repo'
+
+
+# the maximum page size for listing pull request files
+files_per_page = 100
+added_files_query = """
+fragment entries on Tree { entries { name type } }
+query($owner: String!, $name: String!, $base: String!, $head: String!) {
+  repository(owner: $owner, name: $name) {
+    base: object(expression: $base) { ...entries }
+    head: object(expression: $head) { ...entries }
+  }
+}
+"""
+
+
+def _tree_files(tree: dict[str, typing.Any] | None) -> set[str]:
+    """
+    Names of the files in a directory from the `entries` fragment, empty if the directory doesn't exist.
+    """
+    if not tree:
+        return set()
+    return {entry['name'] for entry in tree.get('entries', []) if entry['type'] == 'blob'}
+
+
+def _response_data(r: httpx.Response) -> typing.Any:
+    try:
+        return r.json()
+    except ValueError:
+        return r.text
+
+
+class Repository:
+    def __init__(self, client: GithubClient, full_name: str):
+        self.client = client
+        self.full_name = full_name
+        self.url = f'/repos/{full_name}'
+
+    async def get_contents(self, path: str, ref: str | None = None) -> ContentFile:
+        params = {'ref': ref} if ref else None
+        r = await self.client.get(f'{self.url}/contents/{quote(path)}', params=params)
+        return ContentFile.model_validate_json(r.content)
+
+    async def get_blobs(self, paths: typing.Sequence[str], ref: str | None = None) -> dict[str, Blob | None]:
+        """
+        Get several files from `ref`, or the default branch, in a single GraphQL query, `None` for missing files.
+        """
+        owner, name = self.full_name.split('/', 1)
+        variables: dict[str, str] = {'owner': owner, 'name': name}
+        objects = []
+        for index, path in enumerate(paths):
+            variables[f'e{index}'] = f'{ref or "HEAD"}:{path}'
+            objects.append(f'f{index}: object(expression: $e{index}) {{ ... on Blob {{ oid text isTruncated }} }}')
+        expressions = ', '.join(f'$e{index}: String!' for index in range(len(paths)))
+        query = (
+            f'query($owner: String!, $name: String!, {expressions}) '
+            f'{{ repository(owner: $owner, name: $name) {{ {" ".join(objects)} }} }}'
+        )
+        repository = (await self.client.graphql(query, variables))['repository']
+
+        blobs: dict[str, Blob | None] = {}
+        for index, path in enumerate(paths):
+            blob = Blob.model_validate(data) if (data := repository[f'f{index}']) else None
+            if blob is not None and blob.is_truncated:
+                # the contents API returns larger files
+                f = await self.get_contents(path, ref)
+                blob = Blob(oid=f.sha, text=base64.b64decode(f.content).decode())
+            blobs[path] = blob
+        return blobs
+
+    def get_collaborators(self) -> typing.AsyncIterator[User]:
+        return self.client.paginate(f'{self.url}/collaborators', User)
+
+    async def is_collaborator(self, login: str) -> bool:
+        """
+        Check a single user's access, cheaper than fetching all collaborators.
+        """
+        try:
+            await self.client.request('GET', f'{self.url}/collaborators/{quote(login)}')
+        except GithubError as e:
+            if e.status == 404:
+                return False
+            raise
+        else:
+            return True
+
+    def get_pull(self, number: int, base_ref: str | None = None) -> 'PullRequest':
+        """
+        Get a pull request without fetching it, `base_ref` should be provided if it's in the webhook payload.
+        """
+        return PullRequest(self, number, base_ref)
+
+    def get_issue(self, number: int) -> 'Issue':
+        """
+        Get an issue without fetching it.
+        """
+        return Issue(self, number)
+
+    def get_commit(self, sha: str) -> 'Commit':
+        return Commit(self, sha)
+
+
+class _IssueLike:
+    """
+    Labels, assignees and reactions of both issues and pull requests are managed via the issues API.
+    """
+
+    def __init__(self, repo: Repository, number: int):
+        self.repo = repo
+        self.client = repo.client
+        self.number = number
+        self.issue_url = f'{repo.url}/issues/{number}'
+
+    async def add_to_labels(self, *labels: str) -> None:
+        await self.client.request('POST', f'{self.issue_url}/labels', json_data={'labels': list(labels)})
+
+    async def remove_from_labels(self, label: str) -> None:
+        await self.client.request('DELETE', f'{self.issue_url}/labels/{quote(label)}')
+
+    async def add_to_assignees(self, *assignees: str) -> None:
+        await self.client.request('POST', f'{self.issue_url}/assignees', json_data={'assignees': list(assignees)})
+
+    async def remove_from_assignees(self, *assignees: str) -> None:
+        await self.client.request('DELETE', f'{self.issue_url}/assignees', json_data={'assignees': list(assignees)})
+
+
+class Issue(_IssueLike):
+    def __init__(self, repo: Repository, number: int):
+        super().__init__(repo, number)
+        self._details: IssueDetails | None = None
+
+    async def get_details(self) -> IssueDetails:
+        """
+        Fetch the issue, the result is reused for the lifetime of this object.
+        """
+        if self._details is None:
+            r = await self.client.get(self.issue_url)
+            self._details = IssueDetails.model_validate_json(r.content)
+        return self._details
+
+    async def create_reaction(self, content: str) -> None:
+        await self.client.request_non_urgent('POST', f'{self.issue_url}/reactions', json_data={'content': content})
+
+
+class PullRequest(_IssueLike):
+    def __init__(self, repo: Repository, number: int, base_ref: str | None = None):
+        super().__init__(repo, number)
+        self.url = f'{repo.url}/pulls/{number}'
+        self._base_ref = base_ref
+        self._details: PullRequestDetails | None = None
+
+    async def get_details(self) -> PullRequestDetails:
+        """
+        Fetch the pull request, the result is reused for the lifetime of this object.
+        """
+        if self._details is None:
+            r = await self.client.get(self.url)
+            self._details = PullRequestDetails.model_validate_json(r.content)
+        return self._details
+
+    async def get_base_ref(self) -> str:
+        if self._base_ref is None:
+            self._base_ref = (await self.get_details()).base.ref
+        return self._base_ref
+
+    async def edit(self, *, body: str) -> None:
+        await self.client.request('PATCH', self.url, json_data={'body': body})
+        if self._details is not None:
+            self._details.body = body
+
+    def get_issue_comment(self, comment_id: int) -> 'IssueComment':
+        return IssueComment(self.repo, comment_id)
+
+    def get_files(self) -> typing.AsyncIterator[PullRequestFile]:
+        return self.client.paginate(f'{self.url}/files', PullRequestFile, params={'per_page': files_per_page})
+
+    async def get_added_files(self, directory: str, head_sha: str | None = None) -> list[str] | None:
+        """
+        Find files added to `directory` by the pull request without listing all its files, `None` if the base
+        branch and head commit can't be compared.
+
+        Like the pull request's files, the head commit is compared with the merge base of the base branch and the
+        head, so files merged from the base branch, or since deleted from it, aren't counted as added.
+        """
+        head_sha = head_sha or await self.get_head_sha()
+        base_ref = await self.get_base_ref()
+        try:
+            # only the merge base is needed, so the comparison's commits are limited to one
+            r = await self.client.request(
+                'GET', f'{self.repo.url}/compare/{quote(base_ref)}...{head_sha}', params={'per_page': 1}
+            )
+        except GithubError as e:
+            if e.status == 404:
+                return None
+            raise
+        merge_base_sha = r.json()['merge_base_commit']['sha']
+
+        owner, name = self.repo.full_name.split('/', 1)
+        variables = {
+            'owner': owner,
+            'name': name,
+            'base': f'{merge_base_sha}:{directory}',
+            'head': f'{head_sha}:{directory}',
+        }
+        repository = (await self.client.graphql(added_files_query, variables))['repository']
+        added_files = _tree_files(repository['head']) - _tree_files(repository['base'])
+        return [f'{directory}/{file_name}' for file_name in sorted(added_files)]
+
+    async def get_head_sha(self) -> str:
+        head = (await self.get_details()).head
+        assert head is not None and head.sha is not None, 'pull request has no head commit'
+        return head.sha
+
+
+class IssueComment:
+    def __init__(self, repo: Repository, comment_id: int):
+        self.client = repo.client
+        self.url = f'{repo.url}/issues/comments/{comment_id}'
+
+    async def create_reaction(self, content: str) -> None:
+        await self.client.request_non_urgent('POST', f'{self.url}/reactions', json_data={'content': content})
+
+
+class Commit:
+    def __init__(self, repo: Repository, sha: str):
+        self.repo = repo
+        self.sha = sha
+
+    async def create_status(self, state: str, *, target_url: str, description: str, context: str) -> None:
+        data = {'state': state, 'target_url': target_url, 'description': description, 'context': context}
+        await self.repo.client.request('POST', f'{self.repo.url}/statuses/{self.sha}', json_data=data)
@@ -0,0 +1,64 @@
+"""
+Process-wide pool of keep-alive connections to the GitHub API, shared by access token creation and
+all GitHub clients so events don't pay for new TCP and TLS handshakes.
+
+Connections belong to the event loop they were created on, so there's one pool per loop.
+"""
+import asyncio
+import weakref
+
+import httpx
+
+from . import stats
+
+__all__ = 'get_http_client', 'close_http_client', 'pool_stats'
+_clients: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]' = weakref.WeakKeyDictionary()
+_requests = 0
+# same as PyGithub's default
+timeout = 15
+
+
+def get_http_client(pool_size: int) -> httpx.AsyncClient:
+    """
+    Get the shared client for the running event loop, `pool_size` is only used when the client is first created.
+    """
+    loop = asyncio.get_running_loop()
+    if (client := _clients.get(loop)) is None:
+        limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        client = _clients[loop] = httpx.AsyncClient(
+            limits=limits, timeout=timeout, event_hooks={'request': [_count_request]}
+        )
+    return client
+
+
+async def close_http_client() -> None:
+    if client := _clients.pop(asyncio.get_running_loop(), None):
+        await client.aclose()
+
+
+async def _count_request(_request: httpx.Request) -> None:
+    global _requests
+    _requests += 1
+
+
+def pool_stats() -> dict[str, int]:
+    """
+    Connection pool utilisation summed over all event loops.
+    """
+    pool_size = connections = idle = 0
+    for client in list(_clients.values()):
+        pool = client._transport._pool  # type: ignore[attr-defined]
+        pool_size += pool._max_connections
+        for connection in list(pool.connections):
+            connections += 1
+            idle += connection.is_idle()
+    return {
+        'pool_size': pool_size,
+        'connections': connections,
+        'connections_in_use': connections - idle,
+        'connections_idle': idle,
+        'requests': _requests,
+    }
+
+
+stats.register_gauge('github.http_pool', pool_stats)
@@ -1,24 +1,94 @@
 from textwrap import indent
 
+from pydantic import BaseModel
+
+from .. import stats
 from ..settings import Settings, log
-from . import issues, prs
-from .models import EventParser, IssueEvent, PullRequestReviewEvent, PullRequestUpdateEvent
+from . import installations, issues, members, prs, push
+from .models import (
+    EventParser,
+    InstallationEvent,
+    IssueEvent,
+    MembershipEvent,
+    PullRequestReviewEvent,
+    PullRequestUpdateEvent,
+    PushEvent,
+    extract_action,
+)
+
+__all__ = 'process_event', 'check_event'
+
+# `X-GitHub-Event` header value -> (model to validate the payload with, actions which are processed)
+EVENT_ROUTES: dict[str, tuple[type[BaseModel], frozenset[str | None]]] = {
+    'issues': (IssueEvent, frozenset(issues.ISSUE_ACTIONS_TO_PROCESS)),
+    'issue_comment': (IssueEvent, frozenset({'created', 'edited'})),
+    'pull_request_review': (PullRequestReviewEvent, frozenset({'submitted', 'edited'})),
+    'pull_request': (PullRequestUpdateEvent, frozenset(prs.required_actions)),
+    'installation': (
+        InstallationEvent,
+        installations.INSTALLATION_ACTIONS_TO_PREPARE | installations.INSTALLATION_ACTIONS_TO_FORGET,
+    ),
+    'installation_repositories': (InstallationEvent, frozenset({'added'})),
+    # push events have no action
+    'push': (PushEvent, frozenset({None})),
+    'member': (MembershipEvent, members.MEMBER_ACTIONS),
+    'membership': (MembershipEvent, members.MEMBERSHIP_ACTIONS),
+    'team': (MembershipEvent, members.TEAM_ACTIONS),
+}
+
+
+def check_event(event_name: str | None, request_body: bytes) -> str | None:
+    """
+    Decide if an event could be processed using just the event name and action, without validating the payload.
+
+    Returns the reason to ignore the event or `None` if it should be processed.
+    """
+    if event_name is None:
+        # no `X-GitHub-Event` header, the payload has to be parsed to know what the event is
+        return None
+
+    try:
+        _, actions = EVENT_ROUTES[event_name]
+    except KeyError:
+        stats.incr('events.ignored')
+        return f'Ignoring "{event_name}" event'
+
+    if event_name == 'push' and not push.might_change_config(request_body):
+        stats.incr('events.ignored')
+        return 'Ignoring push event, config not changed'
+
+    action = extract_action(request_body)
+    if action not in actions:
+        stats.incr('events.ignored')
+        return f'Ignoring event action "{action}"'
 
-__all__ = ('process_event',)
 
+async def process_event(request_body: bytes, settings: Settings, event_name: str | None = None) -> tuple[bool, str]:
+    if reason := check_event(event_name, request_body):
+        return False, reason
 
-def process_event(request_body: bytes, settings: Settings) -> tuple[bool, str]:
     try:
-        event = EventParser.model_validate_json(request_body).root
+        with stats.timer('events.parse'):
+            if event_name is None:
+                event = EventParser.model_validate_json(request_body).root
+            else:
+                model, _ = EVENT_ROUTES[event_name]
+                event = model.model_validate_json(request_body)
     except ValueError as e:
         log(indent(f'{type(e).__name__}: {e}', '  '))
         return False, 'Error parsing request body'
 
-    if isinstance(event, IssueEvent):
+    if isinstance(event, InstallationEvent):
+        return await installations.process_installation(event, settings)
+    elif isinstance(event, PushEvent):
+        return await push.process_push(event, settings)
+    elif isinstance(event, MembershipEvent):
+        return await members.process_membership(event, settings)
+    elif isinstance(event, IssueEvent):
         if event.issue.pull_request is None:
-            return issues.process_issue(event=event, settings=settings)
+            return await issues.process_issue(event=event, settings=settings)
 
-        return prs.label_assign(
+        return await prs.label_assign(
             event=event,
             event_type='comment',
             pr=event.issue,
@@ -27,7 +97,7 @@ def process_event(request_body: bytes, settings: Settings) -> tuple[bool, str]:
             settings=settings,
         )
     elif isinstance(event, PullRequestReviewEvent):
-        return prs.label_assign(
+        return await prs.label_assign(
             event=event,
             event_type='review',
             pr=event.pull_request,
@@ -37,4 +107,4 @@ def process_event(request_body: bytes, settings: Settings) -> tuple[bool, str]:
         )
     else:
         assert isinstance(event, PullRequestUpdateEvent), 'unknown event type'
-        return prs.check_change_file(event, settings)
+        return await prs.check_change_file(event, settings)
@@ -0,0 +1,24 @@
+from ..github_auth import forget_installation, prepare_installation
+from ..settings import Settings, log
+from .models import InstallationEvent
+
+# "created", "new_permissions_accepted" and "unsuspend" are "installation" actions,
+# "added" is an "installation_repositories" action
+INSTALLATION_ACTIONS_TO_PREPARE = frozenset({'created', 'new_permissions_accepted', 'unsuspend', 'added'})
+INSTALLATION_ACTIONS_TO_FORGET = frozenset({'deleted', 'suspend'})
+
+
+async def process_installation(event: InstallationEvent, settings: Settings) -> tuple[bool, str]:
+    """
+    Create an access token as soon as the app is installed (or gets access to new repos) so it's ready
+    before the first event for the installation arrives.
+    """
+    installation_id = event.installation.id
+    log(f'[Installation] {event.action}: {installation_id}')
+    if event.action in INSTALLATION_ACTIONS_TO_FORGET:
+        await forget_installation(installation_id, settings)
+        return True, f'[Installation] access token for installation {installation_id} removed'
+
+    repos = [r.full_name for r in event.repositories + event.repositories_added]
+    await prepare_installation(installation_id, repos, settings)
+    return True, f'[Installation] access token created for installation {installation_id}, {len(repos)} repos'
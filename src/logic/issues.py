@@ -2,11 +2,9 @@ import enum
 from dataclasses import dataclass, field
 from typing import Final
 
-import redis
-from github.Issue import Issue as GhIssue
-from github.Repository import Repository as GhRepository
-
 from ..github_auth import get_repo_client
+from ..github_client import Issue as GhIssue, Repository as GhRepository
+from ..redis_client import get_redis_async
 from ..repo_config import RepoConfig
 from ..settings import Settings, log
 from . import models
@@ -21,7 +19,7 @@ class IssueAction(enum.StrEnum):
 ISSUE_ACTIONS_TO_PROCESS: Final[tuple[IssueAction, ...]] = (IssueAction.OPENED,)
 
 
-def process_issue(*, event: models.IssueEvent, settings: Settings) -> tuple[bool, str]:
+async def process_issue(*, event: models.IssueEvent, settings: Settings) -> tuple[bool, str]:
     """Processes an issue in the repo
 
     Performs following actions:
@@ -36,23 +34,24 @@ def process_issue(*, event: models.IssueEvent, settings: Settings) -> tuple[bool
     if event.action not in ISSUE_ACTIONS_TO_PROCESS:
         return False, f'Ignoring event action "{event.action}"'
 
-    with get_repo_client(event.repository.full_name, settings) as gh_repo:
-        gh_issue = gh_repo.get_issue(event.issue.number)
-        config = RepoConfig.load(issue=gh_issue, settings=settings)
+    gh_repo = await get_repo_client(event.repository.full_name, settings, event.installation_id)
+    gh_issue = gh_repo.get_issue(event.issue.number)
+    config = await RepoConfig.load(issue=gh_issue, settings=settings)
 
-        log(f'{event.issue.user} ({event.action}): #{event.issue.number}')
+    log(f'{event.issue.user} ({event.action}): #{event.issue.number}')
 
-        label_assign = LabelAssign(
-            gh_issue=gh_issue,
-            gh_repo=gh_repo,
-            action=IssueAction(event.action),
-            author=event.issue.user,
-            repo_fullname=event.repository.full_name,
-            config=config,
-            settings=settings,
-        )
+    label_assign = LabelAssign(
+        gh_issue=gh_issue,
+        gh_repo=gh_repo,
+        action=IssueAction(event.action),
+        author=event.issue.user,
+        repo_fullname=event.repository.full_name,
+        config=config,
+        settings=settings,
+        issue=event.issue,
+    )
 
-        return label_assign.assign_new()
+    return await label_assign.assign_new()
 
 
 @dataclass(kw_only=True)
@@ -66,46 +65,56 @@ class LabelAssign(BaseActor):
     repo_fullname: str
     config: RepoConfig
     settings: Settings
+    # the issue from the event payload, its labels and assignees are used instead of fetching them when possible
+    issue: models.Issue | None = None
     assignees: list[str] = field(init=False)
 
     def __post_init__(self):
         self.assignees = self.config.assignees
 
-    def assign_new(self) -> tuple[bool, str]:
+    async def assign_new(self) -> tuple[bool, str]:
         if self.action not in ISSUE_ACTIONS_TO_PROCESS:
             return False, f'Ignoring issue action "{self.action}"'
 
         if self.author.login in self.assignees:
             return False, f'@{self.author.login} is in repo assignees list, doing nothing'
 
-        assignee = self._select_assignee()
-        self._assign_user(assignee)
-        self._add_label(self.config.unconfirmed_label)
+        assignee = await self._select_assignee()
+        await self._assign_user(assignee)
+        await self._add_label(self.config.unconfirmed_label)
 
         return (True, f'@{assignee} successfully assigned to issue, "{self.config.unconfirmed_label}" label added')
 
-    def _select_assignee(self) -> str:
+    async def _select_assignee(self) -> str:
         key = f'assignee:{self.repo_fullname}'
-        with redis.from_url(str(self.settings.redis_dsn)) as redis_client:
-            assignees_count = len(self.assignees)
-            assignee_index = redis_client.incr(key) - 1
+        redis_client = get_redis_async(self.settings)
+        assignees_count = len(self.assignees)
+        assignee_index = await redis_client.incr(key) - 1
 
-            # so that key never hits 2**64 and causes an error
-            if assignee_index >= 4_294_967_296:  # 2**32
-                assignee_index %= assignees_count
-                redis_client.set(key, assignee_index + 1)
+        # so that key never hits 2**64 and causes an error
+        if assignee_index >= 4_294_967_296:  # 2**32
+            assignee_index %= assignees_count
+            await redis_client.set(key, assignee_index + 1)
 
         return self.assignees[assignee_index % assignees_count]
 
-    def _assign_user(self, username: str) -> None:
-        if username in (gh_user.login for gh_user in self.gh_issue.assignees):
+    async def _assign_user(self, username: str) -> None:
+        if self.issue is not None and self.issue.assignees is not None:
+            assignees = self.issue.assignees
+        else:
+            assignees = (await self.gh_issue.get_details()).assignees
+        if username in (user.login for user in assignees):
             return
-        self.gh_issue.add_to_assignees(username)
-
-    def _add_label(self, label: str) -> None:
-        if label in (gh_label.name for gh_label in self.gh_issue.labels):
+        await self.gh_issue.add_to_assignees(username)
+
+    async def _add_label(self, label: str) -> None:
+        if self.issue is not None and self.issue.labels is not None:
+            labels = self.issue.labels
+        else:
+            labels = (await self.gh_issue.get_details()).labels
+        if label in (lb.name for lb in labels):
             return
-        self.gh_issue.add_to_labels(label)
+        await self.gh_issue.add_to_labels(label)
 
-    def _add_reaction(self) -> None:
-        self.gh_issue.create_reaction('+1')
+    async def _add_reaction(self) -> None:
+        await self.gh_issue.create_reaction('+1')
@@ -0,0 +1,29 @@
+from .. import stats
+from ..collaborators import invalidate_collaborators, invalidate_org_collaborators
+from ..settings import Settings, log
+from .models import MembershipEvent
+
+MEMBER_ACTIONS = frozenset({'added', 'removed', 'edited'})
+MEMBERSHIP_ACTIONS = frozenset({'added', 'removed'})
+TEAM_ACTIONS = frozenset({'added_to_repository', 'removed_from_repository', 'edited', 'deleted'})
+
+
+async def process_membership(event: MembershipEvent, settings: Settings) -> tuple[bool, str]:
+    """
+    Forget cached collaborators when access to a repo changes, for every repo in the organisation
+    if the event isn't about a single repo, e.g. a team membership change.
+    """
+    if event.repository is not None:
+        repo_full_name = event.repository.full_name
+        log(f'[Collaborators] {event.action}: {repo_full_name}')
+        await invalidate_collaborators(repo_full_name, settings)
+        stats.incr('collaborators.invalidated')
+        return True, f'[Collaborators] cached collaborators for {repo_full_name} cleared'
+    elif event.organization is not None:
+        org = event.organization.login
+        log(f'[Collaborators] {event.action}: {org}')
+        repos = await invalidate_org_collaborators(org, settings)
+        stats.incr('collaborators.invalidated', repos)
+        return True, f'[Collaborators] cached collaborators for {repos} {org} repos cleared'
+    else:
+        return False, '[Collaborators] event has no repository or organization'
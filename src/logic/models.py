@@ -1,3 +1,5 @@
+import re
+
 from pydantic import BaseModel, RootModel
 
 
@@ -15,10 +17,24 @@ class IssuePullRequest(BaseModel):
     url: str
 
 
+class Label(BaseModel):
+    name: str
+
+
 class Issue(BaseModel):
+    """
+    Also used for pull requests in "issue_comment" events.
+
+    The state is a snapshot from when the event was sent, `labels` and `assignees` are `None` if they weren't
+    in the payload and have to be fetched.
+    """
+
     pull_request: IssuePullRequest | None = None
     user: User
     number: int
+    body: str | None = None
+    labels: list[Label] | None = None
+    assignees: list[User] | None = None
 
 
 class Repository(BaseModel):
@@ -26,11 +42,24 @@ class Repository(BaseModel):
     owner: User
 
 
-class IssueEvent(BaseModel):
+class Installation(BaseModel):
+    id: int
+
+
+class BaseEvent(BaseModel):
+    repository: Repository
+    # included in all events delivered to GitHub apps
+    installation: Installation | None = None
+
+    @property
+    def installation_id(self) -> int | None:
+        return self.installation.id if self.installation else None
+
+
+class IssueEvent(BaseEvent):
     action: str  # not defining a Literal here as we're not going to handle an exhaustive list of possible values
     comment: Comment | None = None
     issue: Issue
-    repository: Repository
 
 
 class Review(BaseModel):
@@ -39,23 +68,78 @@ class Review(BaseModel):
     state: str
 
 
+class Branch(BaseModel):
+    ref: str
+    sha: str | None = None
+
+
 class PullRequest(BaseModel):
     number: int
     user: User
     state: str
     body: str | None = None
+    base: Branch | None = None
+    head: Branch | None = None
+    # included in "pull_request" events
+    changed_files: int | None = None
 
 
-class PullRequestReviewEvent(BaseModel):
+class PullRequestReviewEvent(BaseEvent):
     review: Review
     pull_request: PullRequest
-    repository: Repository
 
 
-class PullRequestUpdateEvent(BaseModel):
+class PullRequestUpdateEvent(BaseEvent):
     action: str
     pull_request: PullRequest
-    repository: Repository
+
+
+class InstallationRepository(BaseModel):
+    full_name: str
+
+
+class InstallationEvent(BaseModel):
+    """
+    Either an "installation" or "installation_repositories" event.
+    """
+
+    action: str
+    installation: Installation
+    repositories: list[InstallationRepository] = []
+    repositories_added: list[InstallationRepository] = []
+
+
+class PushRepository(Repository):
+    default_branch: str
+
+
+class PushCommit(BaseModel):
+    added: list[str] = []
+    modified: list[str] = []
+    removed: list[str] = []
+
+
+class PushEvent(BaseEvent):
+    ref: str
+    repository: PushRepository
+    commits: list[PushCommit] = []
+
+
+class Organization(BaseModel):
+    login: str
+
+
+class MembershipEvent(BaseModel):
+    """
+    A "member", "membership" or "team" event, any of which can change who has access to repos.
+    """
+
+    action: str
+    # included in "member" events and "team" events about a repo
+    repository: Repository | None = None
+    # included in events from organisations
+    organization: Organization | None = None
+    installation: Installation | None = None
 
 
 Event = IssueEvent | PullRequestReviewEvent | PullRequestUpdateEvent
@@ -63,3 +147,23 @@ Event = IssueEvent | PullRequestReviewEvent | PullRequestUpdateEvent
 
 class EventParser(RootModel):
     root: Event
+
+
+class ActionPayload(BaseModel):
+    action: str | None = None
+
+
+# GitHub puts "action" first in payloads, so it can usually be found without parsing the whole body
+_ACTION_REGEX = re.compile(rb'\s*\{\s*"action"\s*:\s*"([^"\\]*)"')
+
+
+def extract_action(request_body: bytes) -> str | None:
+    """
+    Find the `action` of an event without validating the whole payload.
+    """
+    if m := _ACTION_REGEX.match(request_body):
+        return m.group(1).decode()
+    try:
+        return ActionPayload.model_validate_json(request_body).action
+    except ValueError:
+        return None
@@ -1,18 +1,18 @@
 import re
 from typing import Literal
 
-import redis
-from github.PullRequest import PullRequest as GhPullRequest
-from github.Repository import Repository as GhRepository
-
+from .. import stats
+from ..collaborators import get_collaborators, is_collaborator
 from ..github_auth import get_repo_client
+from ..github_client import GithubError, PullRequest as GhPullRequest, Repository as GhRepository, files_per_page
+from ..redis_client import get_redis_async
 from ..repo_config import RepoConfig
 from ..settings import Settings, log
 from .common import BaseActor
 from .models import Comment, Event, Issue, PullRequest, PullRequestUpdateEvent, Review
 
 
-def label_assign(
+async def label_assign(
     *,
     event: Event,
     event_type: Literal['comment', 'review'],
@@ -25,28 +25,59 @@ def label_assign(
         return False, '[Label and assign] review has no body'
     body = comment.body.lower()
 
-    with get_repo_client(event.repository.full_name, settings) as gh_repo:
-        gh_pr = gh_repo.get_pull(pr.number)
-        config = RepoConfig.load(pr=gh_pr, settings=settings)
+    if not force_assign_author:
+        # check if any action is possible before authenticating with GitHub
+        triggers = await RepoConfig.cached_triggers(event.repository.full_name, settings)
+        if triggers is not None and not any(trigger in body for trigger in triggers):
+            stats.incr('label_assign.prefiltered')
+            trigger_list = ', '.join(repr(t) for t in sorted(triggers))
+            return False, f'[Label and assign] no trigger phrase found in comment body, triggers: {trigger_list}'
 
-        log(f'{comment.user.login} ({event_type}): {body!r}')
+    stats.incr('label_assign.checked')
+    gh_repo = await get_repo_client(event.repository.full_name, settings, event.installation_id)
+    base_ref = await get_base_ref(event.repository.full_name, pr, settings)
+    gh_pr = gh_repo.get_pull(pr.number, base_ref)
+    config = await RepoConfig.load(pr=gh_pr, settings=settings)
 
-        label_assign_ = LabelAssign(
-            gh_pr, gh_repo, event_type, comment, pr.user.login, event.repository.full_name, config, settings
-        )
-        if config.request_review_trigger in body:
-            action_taken, msg = label_assign_.request_review()
-        elif config.request_update_trigger in body or force_assign_author:
-            action_taken, msg = label_assign_.assign_author()
-        else:
-            action_taken = False
-            msg = (
-                f'neither {config.request_update_trigger!r} nor {config.request_review_trigger!r} '
-                f'found in comment body'
-            )
+    log(f'{comment.user.login} ({event_type}): {body!r}')
+
+    label_assign_ = LabelAssign(
+        gh_pr, gh_repo, event_type, comment, pr.user.login, event.repository.full_name, config, settings, snapshot=pr
+    )
+    if config.request_review_trigger in body:
+        action_taken, msg = await label_assign_.request_review()
+    elif config.request_update_trigger in body or force_assign_author:
+        action_taken, msg = await label_assign_.assign_author()
+    else:
+        action_taken = False
+        msg = f'neither {config.request_update_trigger!r} nor {config.request_review_trigger!r} found in comment body'
     return action_taken, f'[Label and assign] {msg}'
 
 
+async def get_base_ref(repo_full_name: str, pr: Issue | PullRequest, settings: Settings) -> str | None:
+    """
+    Get the PR's base branch from the payload, or for comment events, which don't include it, from the last
+    "pull_request" event. `None` if it's unknown, in which case it's fetched when the config is loaded.
+    """
+    if isinstance(pr, PullRequest) and pr.base:
+        return pr.base.ref
+    base_ref = await get_redis_async(settings).get(_base_ref_key(repo_full_name, pr.number))
+    return base_ref.decode() if base_ref else None
+
+
+async def remember_base_ref(repo_full_name: str, pr: PullRequest, settings: Settings) -> None:
+    """
+    Store the base branch for later comment events, "edited" events update it when a PR is retargeted.
+    """
+    if pr.base:
+        key = _base_ref_key(repo_full_name, pr.number)
+        await get_redis_async(settings).setex(key, settings.pr_base_ref_cache_timeout, pr.base.ref)
+
+
+def _base_ref_key(repo_full_name: str, number: int) -> str:
+    return f'pr_base_ref_{repo_full_name}_{number}'
+
+
 class LabelAssign(BaseActor):
     ROLE = 'Reviewer'
 
@@ -60,8 +91,13 @@ class LabelAssign(BaseActor):
         repo_fullname: str,
         config: RepoConfig,
         settings: Settings,
+        snapshot: Issue | PullRequest | None = None,
     ):
+        """
+        `snapshot` is the pull request from the event payload, its body is used instead of fetching it when possible.
+        """
         self.gh_pr = gh_pr
+        self.gh_repo = gh_repo
         self.event_type = event_type
         self.comment = comment
         self.commenter = comment.user.login
@@ -69,45 +105,58 @@ class LabelAssign(BaseActor):
         self.repo_fullname = repo_fullname
         self.config = config
         self.settings = settings
-        if config.reviewers:
-            self.reviewers = config.reviewers
-        else:
-            self.reviewers = [r.login for r in gh_repo.get_collaborators()]
-        self.commenter_is_reviewer = self.commenter in self.reviewers
+        self.reviewers = config.reviewers
+        self.snapshot = snapshot
 
-    def assign_author(self) -> tuple[bool, str]:
-        if not self.commenter_is_reviewer:
+    async def commenter_is_reviewer(self) -> bool:
+        if self.config.reviewers:
+            return self.commenter in self.reviewers
+        # no reviewers configured, all collaborators are reviewers
+        return await is_collaborator(self.gh_repo, self.commenter, self.settings)
+
+    async def load_reviewers(self) -> None:
+        """
+        Use the repo's collaborators as reviewers if none are configured, only needed once an action is taken.
+        """
+        if not self.reviewers:
+            self.reviewers = list(await get_collaborators(self.gh_repo, self.settings))
+
+    async def assign_author(self) -> tuple[bool, str]:
+        if not await self.commenter_is_reviewer():
             return False, f'Only reviewers {self.show_reviewers()} can assign the author, not "{self.commenter}"'
 
-        self.add_reaction()
-        self.gh_pr.add_to_labels(self.config.awaiting_update_label)
-        self.remove_label(self.config.awaiting_review_label)
-        self.gh_pr.add_to_assignees(self.author)
+        await self.load_reviewers()
+        await self.add_reaction()
+        await self.gh_pr.add_to_labels(self.config.awaiting_update_label)
+        await self.remove_label(self.config.awaiting_review_label)
+        await self.gh_pr.add_to_assignees(self.author)
         to_remove = [r for r in self.reviewers if r != self.author]
         if to_remove:
-            self.gh_pr.remove_from_assignees(*to_remove)
+            await self.gh_pr.remove_from_assignees(*to_remove)
         return (
             True,
             f'Author {self.author} successfully assigned to PR, "{self.config.awaiting_update_label}" label added',
         )
 
-    def request_review(self) -> tuple[bool, str]:
+    async def request_review(self) -> tuple[bool, str]:
         commenter_is_author = self.author == self.commenter
-        if not (self.commenter_is_reviewer or commenter_is_author):
+        # the author doesn't need checking against the repo's collaborators
+        if not (commenter_is_author or await self.commenter_is_reviewer()):
             return False, f'Only the PR author @{self.author} or reviewers can request a review, not "{self.commenter}"'
 
-        self.add_reaction()
-        self.gh_pr.add_to_labels(self.config.awaiting_review_label)
-        self.remove_label(self.config.awaiting_update_label)
+        await self.load_reviewers()
+        await self.add_reaction()
+        await self.gh_pr.add_to_labels(self.config.awaiting_review_label)
+        await self.remove_label(self.config.awaiting_update_label)
 
         try:
-            reviewer = self.find_reviewer()
+            reviewer = await self.find_reviewer()
         except RuntimeError as e:
             return False, str(e)
 
         if reviewer != self.author:
-            self.gh_pr.remove_from_assignees(self.author)
-            self.gh_pr.add_to_assignees(reviewer)
+            await self.gh_pr.remove_from_assignees(self.author)
+            await self.gh_pr.add_to_assignees(reviewer)
 
         return (
             True,
@@ -115,32 +164,44 @@ class LabelAssign(BaseActor):
             f'"{self.config.awaiting_review_label}" label added',
         )
 
-    def add_reaction(self) -> None:
+    async def add_reaction(self) -> None:
         """
         Currently it seems there's no way to create a reaction on a review body, only on issue comments
         and review comments, although it's possible in the UI
         """
         if self.event_type == 'comment':
-            self.gh_pr.get_issue_comment(self.comment.id).create_reaction('+1')
+            await self.gh_pr.get_issue_comment(self.comment.id).create_reaction('+1')
 
-    def remove_label(self, label: str):
-        labels = self.gh_pr.get_labels()
-        if any(lb.name == label for lb in labels):
-            self.gh_pr.remove_from_labels(label)
+    async def remove_label(self, label: str):
+        """
+        Remove the label without checking the PR's labels first, labels in the payload may be out of date and
+        deleting a label the PR doesn't have is just a 404.
+        """
+        try:
+            await self.gh_pr.remove_from_labels(label)
+        except GithubError as e:
+            if e.status != 404:
+                raise
 
     def show_reviewers(self):
         if self.reviewers:
             return ', '.join(f'"{r}"' for r in self.reviewers)
         else:
-            return '(no reviewers configured)'
+            # collaborators are only fetched once an action is taken
+            return "(the repository's collaborators)"
 
-    def find_reviewer(self) -> str:
+    async def find_reviewer(self) -> str:
         """
         Parses the PR body to find the reviewer, otherwise choose a reviewer by round-robin from `self.reviewers`
         and update the PR body to include the reviewer magic comment.
         """
-        pr_body = self.gh_pr.body or ''
-        if m := self._get_role_regex().search(pr_body):
+        pr_body = self.snapshot.body if self.snapshot is not None else None
+        m = self._get_role_regex().search(pr_body) if pr_body else None
+        if m is None:
+            # the body is about to be edited, so it's fetched in case the payload is out of date
+            pr_body = (await self.gh_pr.get_details()).body or ''
+            m = self._get_role_regex().search(pr_body)
+        if m:
             # found the magic comment, inspect it
             username = m.group(1)
             if username in self.reviewers:
@@ -151,21 +212,21 @@ class LabelAssign(BaseActor):
 
         # reviewer not found in the PR body, choose a reviewer by round-robin
         key = f'reviewer:{self.repo_fullname}'
-        with redis.from_url(str(self.settings.redis_dsn)) as redis_client:
-            reviewer_index = redis_client.incr(key) - 1
-            # so that key never hits 2**64 and causes an error
-            if reviewer_index >= self.settings.reviewer_index_multiple * len(self.reviewers):
-                reviewer_index %= len(self.reviewers)
-                redis_client.set(key, reviewer_index + 1)
-
+        redis_client = get_redis_async(self.settings)
+        reviewer_index = await redis_client.incr(key) - 1
+        # so that key never hits 2**64 and causes an error
+        if reviewer_index >= self.settings.reviewer_index_multiple * len(self.reviewers):
+            reviewer_index %= len(self.reviewers)
+            await redis_client.set(key, reviewer_index + 1)
+
+        reviewer = self.get_reviewer(reviewer_index)
+        if reviewer == self.author:
+            # if the reviewer is the author, choose the next reviewer
+            # increment the index again so the same person isn't assigned next time
+            reviewer_index = await redis_client.incr(key) - 1
             reviewer = self.get_reviewer(reviewer_index)
-            if reviewer == self.author:
-                # if the reviewer is the author, choose the next reviewer
-                # increment the index again so the same person isn't assigned next time
-                reviewer_index = redis_client.incr(key) - 1
-                reviewer = self.get_reviewer(reviewer_index)
 
-        self.gh_pr.edit(body=f'{pr_body}\n\nSelected Reviewer: @{reviewer}')
+        await self.gh_pr.edit(body=f'{pr_body}\n\nSelected Reviewer: @{reviewer}')
         return reviewer
 
     def get_reviewer(self, reviewer_index: int) -> str:
@@ -180,7 +241,7 @@ required_actions = {'opened', 'edited', 'reopened', 'synchronize'}
 CommitStatus = Literal['error', 'failure', 'pending', 'success']
 
 
-def check_change_file(event: PullRequestUpdateEvent, settings: Settings) -> tuple[bool, str]:
+async def check_change_file(event: PullRequestUpdateEvent, settings: Settings) -> tuple[bool, str]:
     if event.pull_request.state != 'open':
         return False, f'[Check change file] Pull Request is {event.pull_request.state}, not open'
     if event.action not in required_actions:
@@ -189,19 +250,22 @@ def check_change_file(event: PullRequestUpdateEvent, settings: Settings) -> tupl
         return False, '[Check change file] Pull Request author is a bot'
 
     log(f'[Check change file] action={event.action} pull-request=#{event.pull_request.number}')
-    with get_repo_client(event.repository.full_name, settings) as gh_repo:
-        gh_pr = gh_repo.get_pull(event.pull_request.number)
-        config = RepoConfig.load(pr=gh_pr, settings=settings)
-        if not config.require_change_file:
-            return False, '[Check change file] change file not required'
-
-        body = event.pull_request.body.lower() if event.pull_request.body else ''
-        if config.no_change_file in body:
-            return set_status(gh_pr, 'success', f'Found "{config.no_change_file}" in Pull Request body')
-        elif file_match := find_change_file(gh_pr):
-            return set_status(gh_pr, *check_change_file_content(file_match, body, event.pull_request))
-        else:
-            return set_status(gh_pr, 'error', 'No change file found')
+    await remember_base_ref(event.repository.full_name, event.pull_request, settings)
+    gh_repo = await get_repo_client(event.repository.full_name, settings, event.installation_id)
+    base_ref = event.pull_request.base.ref if event.pull_request.base else None
+    gh_pr = gh_repo.get_pull(event.pull_request.number, base_ref)
+    config = await RepoConfig.load(pr=gh_pr, settings=settings)
+    if not config.require_change_file:
+        return False, '[Check change file] change file not required'
+
+    pr = event.pull_request
+    body = pr.body.lower() if pr.body else ''
+    if config.no_change_file in body:
+        return await set_status(gh_pr, pr, 'success', f'Found "{config.no_change_file}" in Pull Request body')
+    elif file_match := await find_change_file(gh_pr, pr, settings):
+        return await set_status(gh_pr, pr, *check_change_file_content(file_match, body, pr))
+    else:
+        return await set_status(gh_pr, pr, 'error', 'No change file found')
 
 
 def check_change_file_content(file_match: re.Match, body: str, pr: PullRequest) -> tuple[CommitStatus, str]:
@@ -217,15 +281,54 @@ def check_change_file_content(file_match: re.Match, body: str, pr: PullRequest)
         return 'error', 'Change file ID does not match Pull Request or closed Issue'
 
 
-def find_change_file(gh_pr: GhPullRequest) -> re.Match | None:
-    for changed_file in gh_pr.get_files():
-        if changed_file.status == 'added' and (match := re.fullmatch(r'changes/(\d+)-(.+).md', changed_file.filename)):
-            return match
+async def find_change_file(gh_pr: GhPullRequest, pr: PullRequest, settings: Settings) -> re.Match | None:
+    """
+    Find a change file added by the pull request, the result is cached by the head commit's SHA.
+
+    Pull requests with more than one page of files are checked by comparing the `changes` directory at the head
+    commit with the merge base, otherwise files are listed until a change file is found.
+    """
+    head_sha = pr.head.sha if pr.head else None
+    # the result also depends on the base branch, the PR number keeps head commits in several PRs apart
+    cache_key = f'change_file_{gh_pr.repo.full_name}_{pr.number}_{head_sha}' if head_sha else None
+    redis_client = get_redis_async(settings)
+    if cache_key and (cached := await redis_client.get(cache_key)) is not None:
+        stats.incr('change_file.cache_hit')
+        return _match_change_file(cached.decode())
+
+    filename = None
+    added_files = None
+    if pr.changed_files is not None and pr.changed_files > files_per_page:
+        stats.incr('change_file.tree_compared')
+        added_files = await gh_pr.get_added_files('changes', head_sha)
+    if added_files is not None:
+        matches = [m for f in added_files if (m := _match_change_file(f))]
+        # prefer the pull request's own change file over others which may have come with merged commits
+        matches.sort(key=lambda m: (m.group(2).lower() != pr.user.login.lower(), int(m.group(1)) != pr.number))
+        filename = matches[0].group() if matches else None
+    else:
+        stats.incr('change_file.files_listed')
+        async for changed_file in gh_pr.get_files():
+            if changed_file.status == 'added' and _match_change_file(changed_file.filename):
+                filename = changed_file.filename
+                break
+
+    if cache_key:
+        await redis_client.setex(cache_key, settings.change_file_cache_timeout, filename or '')
+    return _match_change_file(filename) if filename else None
+
+
+def _match_change_file(filename: str) -> re.Match | None:
+    return re.fullmatch(r'changes/(\d+)-(.+).md', filename)
 
 
-def set_status(gh_pr: GhPullRequest, state: CommitStatus, description: str) -> tuple[bool, str]:
-    *_, last_commit = gh_pr.get_commits()
-    last_commit.create_status(
+async def set_status(gh_pr: GhPullRequest, pr: PullRequest, state: CommitStatus, description: str) -> tuple[bool, str]:
+    """
+    Set the status on the head commit from the event, so a status for an outdated event is never set on the
+    commits of a newer push.
+    """
+    head_sha = pr.head.sha if pr.head and pr.head.sha else await gh_pr.get_head_sha()
+    await gh_pr.repo.get_commit(head_sha).create_status(
         state,
         description=description,
         target_url='https://github.com/pydantic/hooky#readme',
@@ -0,0 +1,37 @@
+from .. import stats
+from ..github_auth import get_repo_client
+from ..repo_config import CONFIG_FILES, RepoConfig
+from ..settings import Settings, log
+from .models import PushEvent
+
+
+def might_change_config(request_body: bytes) -> bool:
+    """
+    Check if a push could have changed a config file without parsing the payload.
+    """
+    return any(file_name.encode() in request_body for file_name in CONFIG_FILES)
+
+
+async def process_push(event: PushEvent, settings: Settings) -> tuple[bool, str]:
+    """
+    Forget cached configs for the branch when a config file is changed, so changes apply immediately.
+
+    The branch's new config is loaded straight away so trigger phrases it adds are cached, otherwise comments
+    using them would be skipped before the config is ever fetched.
+    """
+    if not event.ref.startswith('refs/heads/'):
+        return False, f'[Config] {event.ref} is not a branch'
+    branch = event.ref.removeprefix('refs/heads/')
+
+    changed_files = {f for commit in event.commits for f in commit.added + commit.modified + commit.removed}
+    if changed_files.isdisjoint(CONFIG_FILES):
+        return False, f'[Config] config not changed on {branch}'
+
+    repo_full_name = event.repository.full_name
+    default_branch = branch == event.repository.default_branch
+    log(f'[Config] config changed on {repo_full_name}#{branch}')
+    await RepoConfig.invalidate(repo_full_name, branch, default_branch=default_branch, settings=settings)
+    stats.incr('config.invalidated')
+    gh_repo = await get_repo_client(repo_full_name, settings, event.installation_id)
+    await RepoConfig._get(gh_repo, None if default_branch else branch, settings)
+    return True, f'[Config] cached config for {branch} reloaded'
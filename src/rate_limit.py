@@ -0,0 +1,222 @@
+"""
+Scheduling of GitHub requests within each installation's rate limit.
+
+The remaining budget is tracked per installation from the `X-RateLimit-*` headers of every response, separately
+for each of GitHub's rate limit resources, e.g. "core" for the REST API and "graphql". Following GitHub's guidance,
+writes are serialised per installation and paced by a token bucket, both kept in redis so they apply across all
+processes and hosts handling the installation's events. When a resource's budget is used up, requests
+for that resource wait for it to reset, when a secondary rate limit is hit all requests for the installation wait
+for it to lift, then the limited request is retried. When the budget is low, requests which aren't needed to
+process events, e.g. reactions, are deferred until the limit resets.
+
+Budgets and pauses are per process, each process learns of them from its own responses.
+"""
+import asyncio
+import math
+import typing
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from textwrap import indent
+from time import time
+
+from . import stats
+from .redis_client import get_redis_async
+from .settings import Settings, log
+
+__all__ = 'RateLimiter', 'Budget', 'RateLimitExceeded', 'get_rate_limiter', 'clear_rate_limiters', 'rate_limit_stats'
+_limiters: dict[int, 'RateLimiter'] = {}
+# GitHub doesn't always say how long to wait after hitting a secondary rate limit, it suggests at least a minute
+secondary_limit_wait = 60
+
+
+class RateLimitExceeded(RuntimeError):
+    pass
+
+
+@dataclass
+class Budget:
+    """
+    The budget of one rate limit resource, from the `X-RateLimit-*` headers.
+    """
+
+    limit: int | None = None
+    remaining: int | None = None
+    # timestamp when the budget is reset
+    reset: float = 0
+    # timestamp until which no requests for the resource should be made after using up the budget
+    paused_until: float = 0
+
+
+class RateLimiter:
+    def __init__(self, installation_id: int, settings: Settings):
+        self.installation_id = installation_id
+        self.settings = settings
+        # resource name from `X-RateLimit-Resource` -> budget
+        self.budgets: dict[str, Budget] = {}
+        # timestamp until which no requests should be made after hitting a secondary rate limit
+        self.paused_until: float = 0
+        self._write_lock = asyncio.Lock()
+        # the bucket as this process last saw it, the bucket itself is in redis
+        self._write_tokens = float(settings.github_write_burst)
+        self._write_tokens_updated = time()
+        self._deferred: set[asyncio.Task] = set()
+
+    def budget(self, resource: str) -> Budget:
+        if (budget := self.budgets.get(resource)) is None:
+            budget = self.budgets[resource] = Budget()
+        return budget
+
+    async def wait(self, resource: str = 'core') -> None:
+        """
+        Wait until requests for `resource` can be made, if the limit lifts too far in the future
+        `RateLimitExceeded` is raised.
+        """
+        delay = max(self.paused_until, self.budget(resource).paused_until) - time()
+        if delay <= 0:
+            return
+        if delay > self.settings.github_rate_limit_max_wait:
+            stats.incr('github.rate_limit.exceeded')
+            raise RateLimitExceeded(f'installation {self.installation_id} rate limited for {delay:0.0f} more seconds')
+        stats.incr('github.rate_limit.waited')
+        await asyncio.sleep(delay)
+
+    @asynccontextmanager
+    async def write_slot(self) -> typing.AsyncIterator[None]:
+        """
+        Hold the installation's write lock while making a write request, after waiting for a token from the bucket.
+
+        The lock and the bucket are in redis, the in-process lock stops tasks in one process polling the redis lock.
+        """
+        redis_client = get_redis_async(self.settings)
+        lock_timeout = self.settings.github_write_lock_timeout
+        redis_lock = redis_client.lock(
+            f'github_write_lock_{self.installation_id}', timeout=lock_timeout, blocking_timeout=lock_timeout
+        )
+        bucket_key = f'github_write_bucket_{self.installation_id}'
+        async with self._write_lock, redis_lock:
+            tokens, updated = await redis_client.hmget(bucket_key, 'tokens', 'updated')
+            if tokens is None:
+                self._write_tokens, self._write_tokens_updated = float(self.settings.github_write_burst), time()
+            else:
+                self._write_tokens, self._write_tokens_updated = float(tokens), float(updated)
+            self._refill()
+            if self._write_tokens < 1:
+                with stats.timer('github.rate_limit.write_wait'):
+                    await asyncio.sleep((1 - self._write_tokens) / self.settings.github_writes_per_second)
+                self._refill()
+            self._write_tokens -= 1
+            async with redis_client.pipeline(transaction=True) as pipe:
+                pipe.hset(bucket_key, mapping={'tokens': self._write_tokens, 'updated': self._write_tokens_updated})
+                # once the bucket has refilled it's the same as a missing bucket
+                pipe.expire(
+                    bucket_key, math.ceil(self.settings.github_write_burst / self.settings.github_writes_per_second)
+                )
+                await pipe.execute()
+            yield
+
+    def _refill(self) -> None:
+        now = time()
+        self._write_tokens = min(
+            self._write_tokens + (now - self._write_tokens_updated) * self.settings.github_writes_per_second,
+            self.settings.github_write_burst,
+        )
+        self._write_tokens_updated = now
+
+    def update(self, status_code: int, headers: typing.Mapping[str, str], text: str, resource: str = 'core') -> bool:
+        """
+        Update the budget from a response, returns `True` if the request hit a rate limit and should be retried.
+
+        `resource` is used if the response doesn't have an `X-RateLimit-Resource` header.
+        """
+        resource = headers.get('X-RateLimit-Resource', resource)
+        budget = self.budget(resource)
+        if remaining := headers.get('X-RateLimit-Remaining'):
+            budget.remaining = int(remaining)
+            budget.limit = int(headers.get('X-RateLimit-Limit', budget.limit or 0))
+            budget.reset = float(headers.get('X-RateLimit-Reset', budget.reset))
+
+        if status_code not in {403, 429}:
+            return False
+        if retry_after := headers.get('Retry-After'):
+            self._pause(float(retry_after))
+        elif budget.remaining == 0:
+            self.limited(resource)
+        elif 'secondary rate limit' in text.lower():
+            self._pause(secondary_limit_wait)
+        else:
+            # a permissions error
+            return False
+        return True
+
+    def limited(self, resource: str) -> None:
+        """
+        Pause requests for `resource` until its budget resets, e.g. after a GraphQL "RATE_LIMITED" error which
+        comes with a 200 response.
+        """
+        stats.incr('github.rate_limit.limited')
+        budget = self.budget(resource)
+        reset = budget.reset if budget.reset > time() else time() + secondary_limit_wait
+        budget.paused_until = max(budget.paused_until, reset)
+
+    def _pause(self, wait: float) -> None:
+        stats.incr('github.rate_limit.limited')
+        self.paused_until = max(self.paused_until, time() + wait)
+
+    def budget_low(self, resource: str = 'core') -> bool:
+        budget = self.budget(resource)
+        return (
+            budget.remaining is not None
+            and budget.remaining < self.settings.github_rate_limit_reserve
+            and budget.reset > time()
+        )
+
+    def defer(self, coro: typing.Coroutine[typing.Any, typing.Any, typing.Any], resource: str = 'core') -> None:
+        """
+        Run `coro` once the budget for `resource` resets.
+        """
+        stats.incr('github.rate_limit.deferred')
+        task = asyncio.create_task(self._run_deferred(self.budget(resource).reset - time(), coro))
+        self._deferred.add(task)
+        task.add_done_callback(self._deferred.discard)
+
+    async def _run_deferred(self, delay: float, coro: typing.Coroutine[typing.Any, typing.Any, typing.Any]) -> None:
+        await asyncio.sleep(max(delay, 0))
+        try:
+            await coro
+        except Exception as e:
+            log(f'installation {self.installation_id}: error running deferred request:')
+            log(indent(f'{type(e).__name__}: {e}', '  '))
+
+    def stats(self) -> dict[str, typing.Any]:
+        now = time()
+        return {
+            'budgets': {
+                resource: {
+                    'limit': budget.limit,
+                    'remaining': budget.remaining,
+                    'reset_in': round(max(budget.reset - now, 0), 1),
+                    'paused_for': round(max(budget.paused_until - now, 0), 1),
+                }
+                for resource, budget in list(self.budgets.items())
+            },
+            'paused_for': round(max(self.paused_until - now, 0), 1),
+            'write_tokens': round(self._write_tokens, 2),
+            'deferred': len(self._deferred),
+        }
+
+
+def get_rate_limiter(installation_id: int, settings: Settings) -> RateLimiter:
+    if (limiter := _limiters.get(installation_id)) is None:
+        limiter = _limiters[installation_id] = RateLimiter(installation_id, settings)
+    return limiter
+
+
+def clear_rate_limiters() -> None:
+    _limiters.clear()
+
+
+def rate_limit_stats() -> dict[str, dict[str, typing.Any]]:
+    return {str(installation_id): limiter.stats() for installation_id, limiter in list(_limiters.items())}
+
+
+stats.register_gauge('github.rate_limit', rate_limit_stats)
@@ -0,0 +1,58 @@
+"""
+Process-wide redis clients, all redis access should go through `get_redis_async()` so connections are reused
+between events.
+"""
+import asyncio
+import typing
+import weakref
+from time import perf_counter
+
+import redis.asyncio
+
+from . import stats
+from .settings import Settings
+
+__all__ = 'get_redis_async', 'close_redis_async', 'pool_stats'
+# async connections are bound to an event loop, so there's one client per loop
+_async_clients: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, redis.asyncio.Redis]' = (
+    weakref.WeakKeyDictionary()
+)
+
+
+class TimedAsyncBlockingConnectionPool(redis.asyncio.BlockingConnectionPool):
+    async def get_connection(
+        self, command_name: str, *keys: typing.Any, **options: typing.Any
+    ) -> redis.asyncio.Connection:
+        start = perf_counter()
+        try:
+            return await super().get_connection(command_name, *keys, **options)
+        finally:
+            stats.record_time('redis.async_pool_wait', perf_counter() - start)
+
+
+def get_redis_async(settings: Settings) -> redis.asyncio.Redis:
+    loop = asyncio.get_running_loop()
+    if (client := _async_clients.get(loop)) is None:
+        pool = TimedAsyncBlockingConnectionPool.from_url(
+            str(settings.redis_dsn), max_connections=settings.redis_max_connections, timeout=settings.redis_pool_timeout
+        )
+        client = _async_clients[loop] = redis.asyncio.Redis(connection_pool=pool)
+    return client
+
+
+async def close_redis_async() -> None:
+    if client := _async_clients.pop(asyncio.get_running_loop(), None):
+        await client.close(close_connection_pool=True)
+
+
+def pool_stats() -> dict[str, int]:
+    created = idle = 0
+    for client in list(_async_clients.values()):
+        pool = client.connection_pool
+        created += len(pool._connections)
+        # the queue is padded with `None` for connections which haven't been created
+        idle += sum(conn is not None for conn in list(pool.pool._queue))
+    return {'connections_created': created, 'connections_in_use': created - idle, 'connections_idle': idle}
+
+
+stats.register_gauge('redis.pools', pool_stats)
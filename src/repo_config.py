@@ -1,17 +1,48 @@
-import base64
+"""
+Config for each repo, read from `.hooky.toml` or `pyproject.toml`.
+
+Configs are cached in process for `config_local_cache_timeout` seconds and in redis for `config_cache_timeout`
+seconds, only one task per process fetches the config for a repo and ref at a time. Branches without a config
+are remembered for `config_missing_cache_timeout` seconds so the repo's config is used without calls to GitHub.
+
+Parsed config files are also cached by git blob SHA, so identical files on different branches and repos are
+only parsed and validated once.
+"""
+import asyncio
+import re
+import typing
+from collections import OrderedDict
 from textwrap import indent
+from time import time
 
-import redis
+import redis.asyncio
 import rtoml
-from github import GithubException
-from github.Issue import Issue as GhIssue
-from github.PullRequest import PullRequest as GhPullRequest
-from github.Repository import Repository as GhRepository
 from pydantic import BaseModel, ValidationError
 
+from . import stats
+from .github_client import GithubError, Issue as GhIssue, PullRequest as GhPullRequest, Repository as GhRepository
+from .rate_limit import RateLimitExceeded
+from .redis_client import get_redis_async
 from .settings import Settings, log
 
-__all__ = ('RepoConfig',)
+__all__ = 'RepoConfig', 'CONFIG_FILES', 'clear_config_cache', 'config_cache_stats'
+# in order of priority, only changes to these files invalidate cached configs
+CONFIG_FILES = '.hooky.toml', 'pyproject.toml'
+# cache key -> (expiry timestamp, config or `None` if there's no config for the ref)
+_local: 'OrderedDict[str, tuple[float, RepoConfig | None]]' = OrderedDict()
+# git blob SHA -> config parsed from the file or `None` if the file has no valid config
+_parsed: 'OrderedDict[str, RepoConfig | None]' = OrderedDict()
+# stored in redis for refs and files without a config
+_NO_CONFIG = b'none'
+
+# files smaller than this are always parsed in full, so errors anywhere in the file are reported
+fast_parse_min_size = 4096
+# a table or array of tables header on its own line, e.g. `[tool.hooky]` or `[[tool.mypy.overrides]]`
+_table_header = re.compile(r'^[ \t]*\[\[?[ \t]*([^\]\n]+?)[ \t]*\]\]?[ \t]*(?:#.*)?$', re.M)
+_dotted_whitespace = re.compile(r'[ \t]*\.[ \t]*')
+
+# cache key -> task fetching the config
+_loading: 'dict[str, asyncio.Future[RepoConfig | None]]' = {}
 
 
 class RepoConfig(BaseModel):
@@ -26,56 +57,182 @@ class RepoConfig(BaseModel):
     unconfirmed_label: str = 'unconfirmed'
 
     @classmethod
-    def load(cls, *, pr: GhPullRequest | None = None, issue: GhIssue | None = None, settings: Settings) -> 'RepoConfig':
+    async def load(
+        cls, *, pr: GhPullRequest | None = None, issue: GhIssue | None = None, settings: Settings
+    ) -> 'RepoConfig':
         assert (pr is None or issue is None) and pr != issue
 
-        repo = pr.base.repo if pr is not None else issue.repository
+        repo = pr.repo if pr is not None else issue.repo
+        if pr is not None:
+            if pr_config := await cls._get(repo, await pr.get_base_ref(), settings):
+                return pr_config
+        repo_config = await cls._get(repo, None, settings)
+        assert repo_config is not None, 'the default branch always has a config'
+        return repo_config
+
+    @classmethod
+    async def _get(cls, repo: GhRepository, ref: str | None, settings: Settings) -> 'RepoConfig | None':
+        """
+        Get the config for `ref`, or the default branch if `ref` is `None`, from the in-process cache,
+        otherwise wait for it to be loaded from redis or GitHub.
+
+        `None` is returned if `ref` has no config, the default config is used if the default branch has no config.
+        """
+        cache_key = _cache_key(repo.full_name, ref)
+        if local := _local.get(cache_key):
+            expires, config = local
+            if expires > time():
+                stats.incr('config.local_hit')
+                _local.move_to_end(cache_key)
+                return config
+            del _local[cache_key]
+        stats.incr('config.local_miss')
+
+        if (loading := _loading.get(cache_key)) is None:
+            loading = _loading[cache_key] = asyncio.ensure_future(cls._load(repo, ref, cache_key, settings))
+            loading.add_done_callback(lambda _: _loading.pop(cache_key, None))
+        else:
+            stats.incr('config.load_waited')
+        # shielded so one waiter being cancelled doesn't cancel the load for the others
+        return await asyncio.shield(loading)
+
+    @classmethod
+    async def _load(
+        cls, repo: GhRepository, ref: str | None, cache_key: str, settings: Settings
+    ) -> 'RepoConfig | None':
+        redis_client = get_redis_async(settings)
+        local_timeout = settings.config_local_cache_timeout
+        raw_config = await redis_client.get(cache_key)
+        if raw_config == _NO_CONFIG:
+            stats.incr('config.redis_hit')
+            config = None
+        elif raw_config:
+            stats.incr('config.redis_hit')
+            config = cls.model_validate_json(raw_config)
+        else:
+            stats.incr('config.redis_miss')
+            try:
+                config = await cls._load_raw(repo, ref=ref, settings=settings)
+            except (GithubError, RateLimitExceeded) as exc:
+                # nothing is cached so the next event fetches the config again
+                stats.incr('config.fetch_error')
+                log(f'{repo.full_name}#{ref or "[default]"}, Error fetching config files, using defaults: {exc}')
+                return None if ref else cls()
+            if config is None and ref is None:
+                config = cls()
+            if config is not None:
+                await config._cache(redis_client, cache_key, repo.full_name, settings)
+            else:
+                stats.incr('config.missing')
+                await redis_client.setex(cache_key, settings.config_missing_cache_timeout, _NO_CONFIG)
+
+        if config is None:
+            local_timeout = min(local_timeout, settings.config_missing_cache_timeout)
+        _local[cache_key] = time() + local_timeout, config
+        _local.move_to_end(cache_key)
+        while len(_local) > settings.config_local_cache_size:
+            _local.popitem(last=False)
+        return config
+
+    @classmethod
+    async def cached_triggers(cls, repo_full_name: str, settings: Settings) -> set[str] | None:
+        """
+        Get all comment trigger phrases from configs for this repo which are currently cached, or `None` if
+        no config is cached.
 
-        with redis.from_url(str(settings.redis_dsn)) as redis_client:
-            repo_ref = pr.base.ref if pr is not None else repo.default_branch
-            repo_cache_key = f'config_{repo.full_name}'
+        This allows comments to be ignored without any calls to GitHub.
+        """
+        triggers = await get_redis_async(settings).smembers(f'config_triggers_{repo_full_name}')
+        return {t.decode() for t in triggers} or None
 
-            if pr is not None:
-                pr_cache_key = f'{repo_cache_key}_{repo_ref}'
-                if pr_config := redis_client.get(pr_cache_key):
-                    return RepoConfig.model_validate_json(pr_config)
-                if pr_config := cls._load_raw(repo, ref=repo_ref):
-                    redis_client.setex(pr_cache_key, settings.config_cache_timeout, pr_config.model_dump_json())
-                    return pr_config
+    @classmethod
+    async def invalidate(cls, repo_full_name: str, ref: str, *, default_branch: bool, settings: Settings) -> None:
+        """
+        Forget cached configs for a branch, the repo's config is loaded from the default branch so it's also
+        forgotten when the default branch changes.
 
-            if repo_config := redis_client.get(repo_cache_key):
-                return RepoConfig.model_validate_json(repo_config)
-            if repo_config := cls._load_raw(repo):
-                redis_client.setex(repo_cache_key, settings.config_cache_timeout, repo_config.model_dump_json())
-                return repo_config
+        Trigger phrases are kept, configs for other branches may still use them and the set only needs to include
+        every trigger, phrases from the new config are added when it's loaded.
+        """
+        keys = [_cache_key(repo_full_name, ref)]
+        if default_branch:
+            keys.append(_cache_key(repo_full_name, None))
+        for key in keys:
+            _local.pop(key, None)
+        await get_redis_async(settings).delete(*keys)
 
-            default_config = cls()
-            redis_client.setex(repo_cache_key, settings.config_cache_timeout, default_config.model_dump_json())
-            return default_config
+    async def _cache(
+        self, redis_client: redis.asyncio.Redis, cache_key: str, repo_full_name: str, settings: Settings
+    ) -> None:
+        triggers_key = f'config_triggers_{repo_full_name}'
+        async with redis_client.pipeline() as pipe:
+            pipe.setex(cache_key, settings.config_cache_timeout, self.model_dump_json())
+            # the triggers set always outlives the configs it was built from, so it's never missing a trigger
+            pipe.sadd(triggers_key, self.request_update_trigger, self.request_review_trigger)
+            pipe.expire(triggers_key, settings.config_cache_timeout)
+            await pipe.execute()
 
     @classmethod
-    def _load_raw(cls, repo: 'GhRepository', *, ref: str | None = None) -> 'RepoConfig | None':
-        kwargs = {'ref': ref} if ref else {}
+    async def _load_raw(
+        cls, repo: 'GhRepository', *, ref: str | None = None, settings: Settings
+    ) -> 'RepoConfig | None':
+        """
+        Fetch both config files in one request, the first which exists is used.
+
+        `None` is returned if neither file exists or the file has no valid config, `GithubError` is raised if
+        the files can't be fetched.
+        """
         prefix = f'{repo.full_name}#{ref}' if ref else f'{repo.full_name}#[default]'
-        try:
-            f = repo.get_contents('.hooky.toml', **kwargs)
-            prefix += '/.hooky.toml'
-        except GithubException:
-            try:
-                f = repo.get_contents('pyproject.toml', **kwargs)
-                prefix += '/pyproject.toml'
-            except GithubException as exc:
-                log(f'{prefix}, No ".hooky.toml" or "pyproject.toml" found, using defaults: {exc}')
-                return None
+        blobs = await repo.get_blobs(CONFIG_FILES, ref=ref)
+
+        for path in CONFIG_FILES:
+            if blob := blobs.get(path):
+                prefix += f'/{path}'
+                if blob.text is None:
+                    log(f'{prefix}, Invalid config file, using defaults')
+                    return None
+                return await cls._parse_cached(blob.oid, blob.text, prefix, settings)
+
+        log(f'{prefix}, No ".hooky.toml" or "pyproject.toml" found, using defaults')
+        return None
+
+    @classmethod
+    async def _parse_cached(cls, sha: str, text: str, prefix: str, settings: Settings) -> 'RepoConfig | None':
+        """
+        Parse a config file, results are cached in process and in redis by the file's blob SHA.
+        """
+        if sha in _parsed:
+            stats.incr('config.parse_local_hit')
+            _parsed.move_to_end(sha)
+            return _parsed[sha]
+
+        redis_client = get_redis_async(settings)
+        blob_key = f'config_blob_{sha}'
+        raw_config = await redis_client.get(blob_key)
+        if raw_config == _NO_CONFIG:
+            stats.incr('config.parse_redis_hit')
+            config = None
+        elif raw_config:
+            stats.incr('config.parse_redis_hit')
+            config = cls.model_validate_json(raw_config)
+        else:
+            stats.incr('config.parse_miss')
+            config = cls._parse(text, prefix)
+            value = config.model_dump_json() if config is not None else _NO_CONFIG
+            await redis_client.setex(blob_key, settings.config_cache_timeout, value)
 
-        content = base64.b64decode(f.content.encode())
+        _parsed[sha] = config
+        while len(_parsed) > settings.config_local_cache_size:
+            _parsed.popitem(last=False)
+        return config
+
+    @classmethod
+    def _parse(cls, text: str, prefix: str) -> 'RepoConfig | None':
         try:
-            config = rtoml.loads(content.decode())
+            hooky_config = _hooky_table(text)
         except ValueError:
             log(f'{prefix}, Invalid config file, using defaults')
             return None
-        try:
-            hooky_config = config['tool']['hooky']
         except KeyError:
             log(f'{prefix}, No [tools.hooky] section found, using defaults')
             return None
@@ -89,3 +246,87 @@ class RepoConfig(BaseModel):
         else:
             log(f'{prefix}, config: {config}')
             return config
+
+
+def _hooky_table(text: str) -> dict[str, typing.Any]:
+    """
+    Get the `[tool.hooky]` table from a config file, large files are parsed with `_extract_hooky_toml` when
+    possible, otherwise the whole file is parsed.
+
+    `ValueError` is raised if the file is invalid, `KeyError` if there's no `[tool.hooky]` table.
+    """
+    if len(text) >= fast_parse_min_size:
+        if (hooky_toml := _extract_hooky_toml(text)) is not None:
+            try:
+                config = rtoml.loads(hooky_toml)
+            except ValueError:
+                # e.g. a line in a multiline array looked like a table header, the full parse decides
+                pass
+            else:
+                stats.incr('config.parse_fast')
+                return config['tool']['hooky']
+        stats.incr('config.parse_fallback')
+    return rtoml.loads(text)['tool']['hooky']
+
+
+def _extract_hooky_toml(text: str) -> str | None:
+    """
+    Extract the `[tool.hooky]` table and its sub-tables from a TOML document without parsing the rest of it.
+
+    An empty string is returned if "hooky" doesn't appear in the document. `None` is returned when the tables
+    can't be found reliably this way: if "hooky" appears outside them, e.g. as a dotted key or inline table,
+    or the tables might be part of a multiline string.
+    """
+    sections: list[tuple[int, int]] = []
+    position = text.find('hooky')
+    if position == -1:
+        return ''
+    while position != -1:
+        line_start = text.rfind('\n', 0, position) + 1
+        m = _table_header.match(text, line_start)
+        if not m or not _is_hooky_table(m.group(1)):
+            return None
+        before = text[:line_start]
+        if before.count('"""') % 2 or before.count("'''") % 2:
+            return None
+        next_header = _table_header.search(text, m.end())
+        end = next_header.start() if next_header else len(text)
+        sections.append((line_start, end))
+        position = text.find('hooky', end)
+
+    hooky_toml = ''.join(text[start:end] for start, end in sections)
+    if '"""' in hooky_toml or "'''" in hooky_toml:
+        return None
+    return hooky_toml
+
+
+def _is_hooky_table(name: str) -> bool:
+    name = _dotted_whitespace.sub('.', name)
+    return name == 'tool.hooky' or name.startswith('tool.hooky.')
+
+
+def _cache_key(repo_full_name: str, ref: str | None) -> str:
+    return f'config_{repo_full_name}_{ref}' if ref else f'config_{repo_full_name}'
+
+
+def clear_config_cache() -> None:
+    _local.clear()
+    _parsed.clear()
+
+
+def config_cache_stats() -> dict[str, float | int | None]:
+    return {
+        'local_hit_rate': stats.hit_rate('config.local_hit', 'config.local_miss'),
+        'redis_hit_rate': stats.hit_rate('config.redis_hit', 'config.redis_miss'),
+        'parse_hit_rate': _parse_hit_rate(),
+        'local_size': len(_local),
+    }
+
+
+def _parse_hit_rate() -> float | None:
+    hits = stats.counter('config.parse_local_hit') + stats.counter('config.parse_redis_hit')
+    total = hits + stats.counter('config.parse_miss')
+    return round(hits / total, 4) if total else None
+
+
+stats.register_gauge('config.cache', config_cache_stats)
@@ -0,0 +1,123 @@
+"""
+Cache of GitHub API GET responses used to make conditional requests.
+
+Responses with an `ETag` or `Last-Modified` header are stored in process and in redis, later requests for
+the same URL send `If-None-Match`/`If-Modified-Since` and the stored body is reused when GitHub replies
+`304 Not Modified`, 304 responses don't count against the rate limit.
+
+Entries are keyed by URL, every repo belongs to a single installation so responses are never shared between
+installations.
+"""
+import typing
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from . import stats
+from .redis_client import get_redis_async
+from .settings import Settings
+
+__all__ = 'CachedResponse', 'ResponseCache', 'record_request', 'clear_response_cache', 'cache_stats'
+_local: 'OrderedDict[str, CachedResponse]' = OrderedDict()
+_endpoints: set[str] = set()
+
+
+@dataclass
+class CachedResponse:
+    etag: str | None
+    last_modified: str | None
+    # the "Link" header, needed to follow pagination
+    link: str | None
+    content: bytes
+
+    def conditional_headers(self) -> dict[str, str]:
+        if self.etag:
+            return {'If-None-Match': self.etag}
+        else:
+            return {'If-Modified-Since': self.last_modified}
+
+    def headers(self) -> dict[str, str]:
+        headers = {'Content-Type': 'application/json'}
+        if self.link:
+            headers['Link'] = self.link
+        return headers
+
+
+class ResponseCache:
+    def __init__(self, settings: Settings):
+        self.settings = settings
+
+    async def get(self, url: str) -> CachedResponse | None:
+        if cached := _local.get(url):
+            _local.move_to_end(url)
+            return cached
+
+        data = await get_redis_async(self.settings).hgetall(_cache_key(url))
+        if b'content' not in data:
+            return None
+        cached = CachedResponse(
+            etag=_decode(data.get(b'etag')),
+            last_modified=_decode(data.get(b'last_modified')),
+            link=_decode(data.get(b'link')),
+            content=data[b'content'],
+        )
+        self._set_local(url, cached)
+        return cached
+
+    async def set(self, url: str, cached: CachedResponse) -> None:
+        self._set_local(url, cached)
+        mapping = {'etag': cached.etag, 'last_modified': cached.last_modified, 'link': cached.link}
+        mapping = {k: v for k, v in mapping.items() if v is not None}
+        async with get_redis_async(self.settings).pipeline(transaction=True) as pipe:
+            cache_key = _cache_key(url)
+            pipe.delete(cache_key)
+            pipe.hset(cache_key, mapping={'content': cached.content, **mapping})
+            pipe.expire(cache_key, self.settings.github_response_cache_timeout)
+            await pipe.execute()
+
+    def _set_local(self, url: str, cached: CachedResponse) -> None:
+        _local[url] = cached
+        _local.move_to_end(url)
+        while len(_local) > self.settings.github_response_cache_size:
+            _local.popitem(last=False)
+
+
+def record_request(endpoint: str, result: typing.Literal['miss', 'stale', 'not_modified']) -> None:
+    """
+    Count a cacheable request: "miss" if nothing was cached, "stale" if the cached response had changed,
+    "not_modified" if GitHub replied 304 and the cached response was used.
+    """
+    _endpoints.add(endpoint)
+    stats.incr(f'github.cache.{endpoint}.{result}')
+
+
+def clear_response_cache() -> None:
+    _local.clear()
+
+
+def cache_stats() -> dict[str, dict[str, float | int]]:
+    """
+    Per endpoint, the number of cacheable requests, the ratio with a cached response and the ratio answered with 304.
+    """
+    endpoints = {}
+    for endpoint in sorted(_endpoints):
+        miss, stale, not_modified = (
+            stats.counter(f'github.cache.{endpoint}.{result}') for result in ('miss', 'stale', 'not_modified')
+        )
+        if requests := miss + stale + not_modified:
+            endpoints[endpoint] = {
+                'requests': requests,
+                'hit_rate': round((stale + not_modified) / requests, 4),
+                'not_modified_rate': round(not_modified / requests, 4),
+            }
+    return endpoints
+
+
+def _cache_key(url: str) -> str:
+    return f'github_response_{url}'
+
+
+def _decode(value: bytes | None) -> str | None:
+    return value.decode() if value is not None else None
+
+
+stats.register_gauge('github.response_cache', cache_stats)
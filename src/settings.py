@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic import FilePath, RedisDsn, SecretBytes, field_validator
 from pydantic_settings import BaseSettings
 
@@ -11,8 +13,66 @@ class Settings(BaseSettings):
     webhook_secret: SecretBytes
     marketplace_webhook_secret: SecretBytes = None
     redis_dsn: RedisDsn = 'redis://localhost:6379'
-    config_cache_timeout: int = 600
+    # per process, and per event loop for async connections
+    redis_max_connections: int = 50
+    # seconds to wait for a connection when all connections are in use
+    redis_pool_timeout: float = 5
+    # cached configs are cleared when a push changes a config file, the timeout is just a backstop
+    config_cache_timeout: int = 86_400
+    # configs are also cached in process, other processes don't see push invalidations until this timeout
+    config_local_cache_timeout: int = 60
+    config_local_cache_size: int = 1000
+    # how long to remember that a branch has no config, cleared by pushes like configs
+    config_missing_cache_timeout: int = 86_400
+    # collaborators are reviewers when a repo configures none, rosters are cleared by membership events
+    collaborators_cache_timeout: int = 86_400
+    collaborators_local_cache_timeout: int = 60
+    collaborators_local_cache_size: int = 1000
+    installation_cache_timeout: int = 86_400
+    # access tokens for installations used in the last `token_active_window` seconds are renewed
+    # `token_refresh_before` seconds before they expire, checked every `token_refresh_interval` seconds
+    token_refresh_interval: int = 60
+    token_refresh_before: int = 600
+    token_active_window: int = 3600
+    token_lock_timeout: int = 30
+    # maximum number of keep-alive connections to the GitHub API per process
+    github_pool_size: int = 40
+    # GET responses kept to make conditional requests, the number of entries in process and the TTL in redis
+    github_response_cache_size: int = 1000
+    github_response_cache_timeout: int = 7 * 86_400
+    # requests for an installation wait up to `github_rate_limit_max_wait` seconds for a rate limit to lift,
+    # non-urgent requests like reactions are deferred when fewer than `github_rate_limit_reserve` requests remain
+    github_rate_limit_max_wait: float = 60
+    github_rate_limit_reserve: int = 500
+    # writes for an installation are serialised across all processes by a redis lock, held for up to
+    # `github_write_lock_timeout` seconds, with bursts of up to `github_write_burst` writes
+    github_write_burst: int = 10
+    github_writes_per_second: float = 1
+    github_write_lock_timeout: int = 30
     reviewer_index_multiple: int = 1000
+    # base branches from "pull_request" events, used for comments on the pull request
+    pr_base_ref_cache_timeout: int = 30 * 86_400
+    # change files found for a pull request's head commit, or that none was found
+    change_file_cache_timeout: int = 7 * 86_400
+    # 'inline' processes events before responding, 'queue' responds immediately and processes events in the background,
+    # 'stream' responds immediately and adds events to a redis stream to be processed by `python -m src.worker`
+    event_processing: Literal['inline', 'queue', 'stream'] = 'inline'
+    queue_workers: int = 8
+    queue_max_size: int = 1000
+    queue_drain_timeout: float = 20
+    stream_name: str = 'hooky:events'
+    stream_group: str = 'hooky-workers'
+    stream_max_len: int = 100_000
+    stream_worker_processes: int = 4
+    stream_block_ms: int = 5_000
+    # entries pending for longer than this are assumed to belong to a dead consumer and are reclaimed
+    stream_claim_idle_ms: int = 60_000
+    # entries which fail with errors like timeouts are retried until they've been read this many times
+    stream_max_deliveries: int = 5
+    # how long to remember `X-GitHub-Delivery` IDs, GitHub allows redelivery for 3 days
+    delivery_dedup_timeout: int = 3 * 86_400
+    # how long a delivery is claimed while it's processed, deliveries whose processing died can be redelivered after
+    delivery_pending_timeout: int = 600
 
     @classmethod
     def load_cached(cls, **kwargs) -> 'Settings':
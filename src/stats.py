@@ -0,0 +1,80 @@
+"""
+Very simple in-process counters, timings and gauges, exposed via `GET /stats/`.
+
+Values are per process, they're reset on restart.
+"""
+import threading
+import typing
+from contextlib import contextmanager
+from time import perf_counter
+
+__all__ = 'incr', 'counter', 'record_time', 'timer', 'register_gauge', 'hit_rate', 'snapshot', 'reset'
+
+_lock = threading.Lock()
+_counters: dict[str, int] = {}
+# name -> [count, total seconds, max seconds]
+_timings: dict[str, list[float]] = {}
+_gauges: dict[str, typing.Callable[[], typing.Any]] = {}
+
+
+def incr(name: str, amount: int = 1) -> None:
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def counter(name: str) -> int:
+    with _lock:
+        return _counters.get(name, 0)
+
+
+def record_time(name: str, seconds: float) -> None:
+    with _lock:
+        if timing := _timings.get(name):
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+        else:
+            _timings[name] = [1, seconds, seconds]
+
+
+@contextmanager
+def timer(name: str) -> typing.Iterator[None]:
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        record_time(name, perf_counter() - start)
+
+
+def register_gauge(name: str, func: typing.Callable[[], typing.Any]) -> None:
+    """
+    Register a function which is called to get the current value of a gauge when stats are requested.
+    """
+    _gauges[name] = func
+
+
+def hit_rate(hits: str, misses: str) -> float | None:
+    """
+    Ratio of the `hits` counter to the sum of the `hits` and `misses` counters, `None` if neither has been incremented.
+    """
+    with _lock:
+        hit_count = _counters.get(hits, 0)
+        total = hit_count + _counters.get(misses, 0)
+    return round(hit_count / total, 4) if total else None
+
+
+def snapshot() -> dict[str, typing.Any]:
+    with _lock:
+        counters = dict(sorted(_counters.items()))
+        timings = {
+            name: {'count': int(count), 'mean_ms': round(total / count * 1000, 3), 'max_ms': round(max_ * 1000, 3)}
+            for name, (count, total, max_) in sorted(_timings.items())
+        }
+    gauges = {name: func() for name, func in sorted(_gauges.items())}
+    return {'counters': counters, 'timings': timings, 'gauges': gauges}
+
+
+def reset() -> None:
+    with _lock:
+        _counters.clear()
+        _timings.clear()
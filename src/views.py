@@ -1,21 +1,45 @@
+import asyncio
 import hashlib
 import hmac
 import json
 import os
+from contextlib import asynccontextmanager
 from pathlib import Path
 
-from asyncer import asyncify
 from fastapi import FastAPI, Header, HTTPException, Request
-from fastapi.responses import FileResponse, HTMLResponse, PlainTextResponse
-
-from .logic import process_event
+from fastapi.responses import FileResponse, HTMLResponse, JSONResponse, PlainTextResponse
+
+from . import stats
+from .deliveries import DeliveryResult, claim_delivery, release_delivery, save_delivery_result
+from .event_queue import EventQueue
+from .github_auth import refresh_tokens_periodically
+from .http_session import close_http_client
+from .logic import check_event, process_event
+from .redis_client import close_redis_async
 from .settings import Settings, log
+from .worker import add_to_stream
 
 settings = Settings.load_cached()
-app = FastAPI()
+event_queue = EventQueue(settings) if settings.event_processing == 'queue' else None
 THIS_DIR = Path(__file__).parent
 
 
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    token_refresher = asyncio.create_task(refresh_tokens_periodically(settings))
+    if event_queue is not None:
+        event_queue.start()
+    yield
+    if event_queue is not None:
+        await event_queue.drain()
+    token_refresher.cancel()
+    await close_redis_async()
+    await close_http_client()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
 @app.get('/')
 def index():
     index_content = (THIS_DIR / 'index.html').read_text()
@@ -29,20 +53,70 @@ def favicon():
     return FileResponse(THIS_DIR / 'favicon.ico')
 
 
+@app.get('/stats/')
+def get_stats():
+    return JSONResponse(stats.snapshot())
+
+
 @app.post('/')
-async def webhook(request: Request, x_hub_signature_256: str = Header(default='')):
+async def webhook(
+    request: Request,
+    x_hub_signature_256: str = Header(default=''),
+    x_github_delivery: str = Header(default=''),
+    x_github_event: str | None = Header(default=None),
+):
     request_body = await request.body()
 
-    digest = hmac.new(settings.webhook_secret.get_secret_value(), request_body, hashlib.sha256).hexdigest()
+    with stats.timer('webhook.verify'):
+        digest = hmac.new(settings.webhook_secret.get_secret_value(), request_body, hashlib.sha256).hexdigest()
 
     if not hmac.compare_digest(f'sha256={digest}', x_hub_signature_256):
         log(f'Invalid signature: {digest=} {x_hub_signature_256=}')
         raise HTTPException(status_code=403, detail='Invalid signature')
 
-    action_taken, message = await asyncify(process_event)(request_body=request_body, settings=settings)
+    if reason := check_event(x_github_event, request_body):
+        message = f'{reason}, no action taken'
+        log(message)
+        return PlainTextResponse(message, status_code=202)
+
+    if not x_github_delivery:
+        result = await handle_event(request_body, x_github_event)
+        return PlainTextResponse(result.message, status_code=result.status_code)
+
+    if cached_result := await claim_delivery(x_github_delivery, settings):
+        log(f'Duplicate delivery {x_github_delivery}: {cached_result.message}')
+        return PlainTextResponse(cached_result.message, status_code=cached_result.status_code)
+
+    try:
+        result = await handle_event(request_body, x_github_event, x_github_delivery)
+    except BaseException:
+        await release_delivery(x_github_delivery, settings)
+        raise
+    return PlainTextResponse(result.message, status_code=result.status_code)
+
+
+async def handle_event(request_body: bytes, event_name: str | None, delivery_id: str | None = None) -> DeliveryResult:
+    """
+    Process the event or queue it, the result is saved for `delivery_id` once the event has been processed,
+    by the queue or stream worker if the event is queued.
+    """
+    if event_queue is not None:
+        if not event_queue.put(request_body, event_name, delivery_id):
+            log('Event queue full, rejecting event')
+            raise HTTPException(status_code=503, detail='Event queue full')
+        return DeliveryResult(202, 'Event queued')
+    elif settings.event_processing == 'stream':
+        await add_to_stream(request_body, event_name, settings, delivery_id=delivery_id)
+        return DeliveryResult(202, 'Event queued')
+
+    with stats.timer('webhook.process'):
+        action_taken, message = await process_event(request_body=request_body, settings=settings, event_name=event_name)
     message = message if action_taken else f'{message}, no action taken'
     log(message)
-    return PlainTextResponse(message, status_code=200 if action_taken else 202)
+    result = DeliveryResult(200 if action_taken else 202, message)
+    if delivery_id:
+        await save_delivery_result(delivery_id, result, settings)
+    return result
 
 
 @app.post('/marketplace/')
@@ -0,0 +1,210 @@
+"""
+Standalone worker which processes webhook events added to a redis stream by the webhook endpoint
+when `settings.event_processing == 'stream'`.
+
+Run with `python -m src.worker`, this starts `settings.stream_worker_processes` processes which share the work
+via a redis consumer group, any number of hosts can run workers against the same stream.
+
+Entries which fail with transient errors, like timeouts, rate limits and GitHub server errors, aren't acknowledged
+so they're reclaimed and retried, until they've been read `stream_max_deliveries` times.
+"""
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+from contextlib import suppress
+from textwrap import indent
+from time import time
+
+import httpx
+import redis
+
+from . import stats
+from .deliveries import DeliveryResult, release_delivery, save_delivery_result
+from .github_auth import refresh_tokens
+from .github_client import GithubError
+from .logic import process_event
+from .rate_limit import RateLimitExceeded
+from .redis_client import get_redis_async
+from .settings import Settings, log
+
+__all__ = 'add_to_stream', 'StreamWorker', 'main'
+# seconds to wait before reading the stream again after a redis error
+redis_error_wait = 5
+
+
+async def add_to_stream(
+    request_body: bytes, event_name: str | None, settings: Settings, *, delivery_id: str | None = None
+) -> None:
+    fields = {'body': request_body}
+    if event_name is not None:
+        fields['event'] = event_name
+    if delivery_id:
+        fields['delivery'] = delivery_id
+    redis_client = get_redis_async(settings)
+    await redis_client.xadd(settings.stream_name, fields, maxlen=settings.stream_max_len, approximate=True)
+
+
+class StreamWorker:
+    def __init__(self, settings: Settings, consumer_name: str | None = None):
+        self.settings = settings
+        self.consumer_name = consumer_name or f'{socket.gethostname()}-{os.getpid()}'
+        self.running = True
+
+    async def run(self) -> None:
+        log(f'Stream worker {self.consumer_name} started')
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, self.stop)
+        loop.add_signal_handler(signal.SIGINT, self.stop)
+        await self.create_group()
+        last_token_refresh = time()
+        try:
+            while self.running:
+                try:
+                    await self.run_once()
+                except redis.RedisError as e:
+                    # e.g. redis restarting, entries being processed are left pending and reclaimed later
+                    stats.incr('stream.redis_errors')
+                    log(f'{self.consumer_name}: redis error, retrying in {redis_error_wait}s:')
+                    log(indent(f'{type(e).__name__}: {e}', '  '))
+                    await asyncio.sleep(redis_error_wait)
+                if time() - last_token_refresh > self.settings.token_refresh_interval:
+                    try:
+                        await refresh_tokens(self.settings)
+                    except Exception as e:
+                        log(f'{self.consumer_name}: error refreshing access tokens:')
+                        log(indent(f'{type(e).__name__}: {e}', '  '))
+                    last_token_refresh = time()
+        finally:
+            log(f'Stream worker {self.consumer_name} stopped')
+
+    def stop(self) -> None:
+        self.running = False
+
+    async def create_group(self) -> None:
+        try:
+            await get_redis_async(self.settings).xgroup_create(
+                self.settings.stream_name, self.settings.stream_group, id='0', mkstream=True
+            )
+        except redis.ResponseError as e:
+            # the group already exists
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    async def run_once(self) -> int:
+        """
+        Process entries reclaimed from dead consumers or left to be retried, then new entries, returns the number
+        of entries processed.
+        """
+        count = 0
+        for entry_id, fields in await self.claim():
+            stats.incr('stream.reclaimed')
+            await self.handle(entry_id, fields)
+            count += 1
+
+        response = await get_redis_async(self.settings).xreadgroup(
+            self.settings.stream_group,
+            self.consumer_name,
+            {self.settings.stream_name: '>'},
+            count=1,
+            block=self.settings.stream_block_ms,
+        )
+        for _stream, entries in response:
+            for entry_id, fields in entries:
+                await self.handle(entry_id, fields)
+                count += 1
+        return count
+
+    async def claim(self) -> list[tuple[bytes, dict[bytes, bytes]]]:
+        _next_id, entries, *_ = await get_redis_async(self.settings).xautoclaim(
+            self.settings.stream_name,
+            self.settings.stream_group,
+            self.consumer_name,
+            min_idle_time=self.settings.stream_claim_idle_ms,
+            count=10,
+        )
+        # entries which have been trimmed from the stream are returned as `(entry_id, None)`
+        return [(entry_id, fields) for entry_id, fields in entries if fields]
+
+    async def handle(self, entry_id: bytes, fields: dict[bytes, bytes]) -> None:
+        delivery_id = delivery.decode() if (delivery := fields.get(b'delivery')) else None
+        try:
+            with stats.timer('stream.process'):
+                event_name = event.decode() if (event := fields.get(b'event')) else None
+                action_taken, message = await process_event(
+                    request_body=fields[b'body'], settings=self.settings, event_name=event_name
+                )
+            message = message if action_taken else f'{message}, no action taken'
+            log(message)
+            if delivery_id:
+                result = DeliveryResult(200 if action_taken else 202, message)
+                await save_delivery_result(delivery_id, result, self.settings)
+        except Exception as e:
+            stats.incr('stream.errors')
+            log(f'{self.consumer_name}: error processing entry {entry_id.decode()}:')
+            log(indent(f'{type(e).__name__}: {e}', '  '))
+            if _is_transient(e):
+                deliveries = await self.delivery_count(entry_id)
+                if deliveries < self.settings.stream_max_deliveries:
+                    # left pending, the entry is reclaimed and retried after `stream_claim_idle_ms`
+                    stats.incr('stream.retried')
+                    log(f'  delivery {deliveries} of {self.settings.stream_max_deliveries}, will be retried')
+                    return
+            # other errors are unlikely to succeed if retried, so the entry is acknowledged
+            if delivery_id:
+                # so the delivery can be redelivered, if redis is down the claim expires anyway
+                with suppress(redis.RedisError):
+                    await release_delivery(delivery_id, self.settings)
+        await get_redis_async(self.settings).xack(self.settings.stream_name, self.settings.stream_group, entry_id)
+
+    async def delivery_count(self, entry_id: bytes) -> int:
+        """
+        Number of times the entry has been read by a consumer, including the current read.
+        """
+        pending = await get_redis_async(self.settings).xpending_range(
+            self.settings.stream_name, self.settings.stream_group, min=entry_id, max=entry_id, count=1
+        )
+        return pending[0]['times_delivered'] if pending else 1
+
+
+def _is_transient(exc: Exception) -> bool:
+    """
+    Errors which may not happen if the event is processed again: timeouts and other network errors, rate limits
+    and GitHub server errors.
+    """
+    if isinstance(exc, GithubError):
+        # rate limits which were still in place after retrying
+        rate_limited = exc.status == 429 or (exc.status == 403 and 'rate limit' in str(exc).lower())
+        return exc.status >= 500 or rate_limited
+    elif isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code >= 500
+    else:
+        return isinstance(exc, (httpx.TransportError, RateLimitExceeded))
+
+
+def run_worker() -> None:
+    asyncio.run(StreamWorker(Settings.load_cached()).run())
+
+
+def main() -> None:
+    settings = Settings.load_cached()
+    processes = [
+        multiprocessing.Process(target=run_worker, name=f'hooky-worker-{n}')
+        for n in range(settings.stream_worker_processes)
+    ]
+    for p in processes:
+        p.start()
+
+    def stop(*_args) -> None:
+        for p_ in processes:
+            p_.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for p in processes:
+        p.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Benchmark parsing the hooky config from large pyproject.toml files, run with:
+
+    python -m tests.benchmark_config
+"""
+import timeit
+
+import rtoml
+
+from src.repo_config import _hooky_table
+
+# language=toml
+hooky_table = """\
+[tool.hooky]
+reviewers = ['user1', 'user2']
+assignees = ['user3']
+require_change_file = false
+"""
+
+
+def large_pyproject(hooky_position: str | None = 'middle', packages: int = 400) -> str:
+    """
+    Build a pyproject.toml like those of large monorepos, with long dependency lists, per file lint settings and
+    mypy overrides, `hooky_position` is "start", "middle", "end" or `None` for no `[tool.hooky]` table.
+    """
+    names = [f'package-{i}' for i in range(packages)]
+    head = [
+        '[project]',
+        "name = 'monorepo'",
+        "version = '1.0.0'",
+        "description = 'Lots of packages in one repo'",
+        'dependencies = [',
+        *(f"    '{name}>={i % 7}.{i % 13}',  # pinned for reasons" for i, name in enumerate(names)),
+        ']',
+        '',
+        '[project.optional-dependencies]',
+        *(f"{name} = ['{name}-extra[all]>=1', '{name}-types']" for name in names[:100]),
+        '',
+    ]
+    middle = [
+        '[tool.ruff]',
+        'line-length = 120',
+        "extend-select = ['Q', 'RUF100', 'C90', 'UP', 'I']",
+        "flake8-quotes = {inline-quotes = 'single', multiline-quotes = 'double'}",
+        '',
+        '[tool.ruff.per-file-ignores]',
+        *(f"'packages/{name}/src/**/*.py' = ['E501', 'F401', 'D10{i % 8}']" for i, name in enumerate(names)),
+        '',
+        '[tool.pytest.ini_options]',
+        "testpaths = ['packages']",
+        'filterwarnings = [',
+        "    'error',",
+        *(f"    'ignore:deprecated in {name}:DeprecationWarning'," for name in names),
+        ']',
+        '',
+    ]
+    tail = [
+        *(
+            line
+            for name in names
+            for line in (
+                '[[tool.mypy.overrides]]',
+                f"module = ['{name.replace('-', '_')}.*', '{name.replace('-', '_')}_tests.*']",
+                'ignore_missing_imports = true',
+                f'disallow_untyped_defs = {str(len(name) % 2 == 0).lower()}',
+                '',
+            )
+        ),
+        '[tool.coverage.run]',
+        "source = ['packages']",
+        'branch = true',
+        '',
+    ]
+    hooky = {position: [hooky_table] if position == hooky_position else [] for position in ('start', 'middle', 'end')}
+    return '\n'.join([*hooky['start'], *head, *middle, *hooky['middle'], *tail, *hooky['end']])
+
+
+def full_parse(text: str) -> dict:
+    return rtoml.loads(text)['tool']['hooky']
+
+
+def main() -> None:
+    number = 100
+    for hooky_position in 'start', 'middle', 'end', None:
+        text = large_pyproject(hooky_position)
+        for name, func in ('full parse', full_parse), ('fast path', _hooky_table):
+            t = timeit.timeit(lambda: _ignore_key_error(func, text), number=number)
+            print(f'hooky table {hooky_position or "missing":>7}, {len(text) / 1024:5.0f}KB, {name:>10}: ', end='')
+            print(f'{t / number * 1000:7.3f}ms')
+
+
+def _ignore_key_error(func, text: str) -> None:
+    try:
+        func(text)
+    except KeyError:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -131,6 +131,15 @@ class CallableBlock(Block):
             return f'{self.__class__.__name__}({self._name!r}, {self._return_value!r})'
 
 
+class AsyncCallableBlock(CallableBlock):
+    """
+    Like `CallableBlock` but must be awaited, the call is recorded when it's awaited.
+    """
+
+    async def __call__(self, *args, **kwargs):
+        return super().__call__(*args, **kwargs)
+
+
 @dataclass
 class HistoryIter(History):
     items: tuple[Any, ...]
@@ -155,6 +164,10 @@ class IterBlock(Block):
         self.__raw_history__.append(HistoryIter(path, items))
         return iter(items)
 
+    async def __aiter__(self):
+        for item in self.__iter__():
+            yield item
+
     def __repr__(self):
         args = (self._name,) + self._items
         return f'{self.__class__.__name__}({", ".join(repr(a) for a in args)})'
@@ -9,6 +9,11 @@ import redis
 from foxglove.testing import TestClient, create_dummy_server
 from requests import Response as RequestsResponse
 
+from src import github_auth, stats
+from src.collaborators import clear_collaborators_cache
+from src.rate_limit import clear_rate_limiters
+from src.repo_config import clear_config_cache
+from src.response_cache import clear_response_cache
 from src.settings import Settings
 
 from .dummy_server import routes
@@ -26,6 +31,16 @@ def fix_settings():
     )
 
 
+@pytest.fixture(autouse=True)
+def reset_process_state():
+    stats.reset()
+    github_auth.clear_token_cache()
+    clear_response_cache()
+    clear_rate_limiters()
+    clear_config_cache()
+    clear_collaborators_cache()
+
+
 @pytest.fixture(name='loop')
 def fix_loop(settings):
     try:
@@ -48,10 +63,17 @@ class Client(TestClient):
         super().__init__(app)
         self.settings = settings
 
-    def webhook(self, data: dict[str, Any]) -> RequestsResponse:
+    def webhook(
+        self, data: dict[str, Any], *, delivery_id: str | None = None, event_name: str | None = None
+    ) -> RequestsResponse:
         request_body = json.dumps(data).encode()
         digest = hmac.new(self.settings.webhook_secret.get_secret_value(), request_body, hashlib.sha256).hexdigest()
-        return self.post('/', data=request_body, headers={'x-hub-signature-256': f'sha256={digest}'})
+        headers = {'x-hub-signature-256': f'sha256={digest}'}
+        if delivery_id is not None:
+            headers['x-github-delivery'] = delivery_id
+        if event_name is not None:
+            headers['x-github-event'] = event_name
+        return self.post('/', data=request_body, headers=headers)
 
 
 @pytest.fixture(name='client')
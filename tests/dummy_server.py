@@ -1,10 +1,25 @@
 import base64
+import hashlib
+import json
+from time import time
 
 from aiohttp import web
 from aiohttp.abc import Request
 from aiohttp.web_response import Response, json_response
 
 
+def etag_json_response(request: Request, data, headers: dict[str, str] | None = None) -> Response:
+    """
+    JSON response with an ETag, 304 if the request's "If-None-Match" matches, like GitHub.
+    """
+    body = json.dumps(data).encode()
+    etag = f'"{hashlib.md5(body).hexdigest()}"'
+    headers = {'ETag': etag, **(headers or {})}
+    if request.headers.get('If-None-Match') == etag:
+        return Response(status=304, headers=headers)
+    return Response(body=body, content_type='application/json', headers=headers)
+
+
 async def repo_details(request: Request) -> Response:
     github_base_url = request.app['dynamic']['github_base_url']
     org = request.match_info['org']
@@ -27,6 +42,7 @@ async def pull_details(request: Request) -> Response:
                 'sha': 'abc1234',
                 'repo': {'url': f'{github_base_url}/repos/{org}/{repo}', 'full_name': f'{org}/{repo}'},
             },
+            'head': {'label': 'foobar:feature', 'ref': 'feature', 'sha': 'abc'},
         }
     )
 
@@ -35,8 +51,9 @@ async def pull_patch(_request: Request) -> Response:
     return json_response({'patch': 'foobar'})
 
 
-async def pull_files(_request: Request) -> Response:
-    return json_response(
+async def pull_files(request: Request) -> Response:
+    return etag_json_response(
+        request,
         [
             {
                 'deletions': 0,
@@ -46,16 +63,7 @@ async def pull_files(_request: Request) -> Response:
                 'sha': 'abc',
                 'status': 'added',
             }
-        ]
-    )
-
-
-async def pull_commits(request: Request) -> Response:
-    github_base_url = request.app['dynamic']['github_base_url']
-    org = request.match_info['org']
-    repo = request.match_info['repo']
-    return json_response(
-        [{'sha': 'abc', 'url': f'{github_base_url}/repos/{org}/{repo}/commits/abc', 'commit': {'message': 'foobar'}}]
+        ],
     )
 
 
@@ -63,24 +71,17 @@ async def update_status(_request: Request) -> Response:
     return json_response({})
 
 
-async def comment_details(request: Request) -> Response:
-    github_base_url = request.app['dynamic']['github_base_url']
-    org = request.match_info['org']
-    repo = request.match_info['repo']
-    comment_id = request.match_info['comment_id']
-    return json_response({'url': f'{github_base_url}/repos/{org}/{repo}/comments/{comment_id}'})
-
-
 async def comment_reaction(_request: Request) -> Response:
     return json_response({})
 
 
-async def get_labels(_request: Request) -> Response:
+async def add_labels(_request: Request) -> Response:
     return json_response({})
 
 
-async def add_labels(_request: Request) -> Response:
-    return json_response({})
+async def remove_label(_request: Request) -> Response:
+    # the issue has no labels, like GitHub a 404 is returned
+    return json_response({'message': 'Label does not exist'}, status=404)
 
 
 async def add_assignee(_request: Request) -> Response:
@@ -96,6 +97,15 @@ sample_config = b"""
 reviewers = ['user1', 'user2']
 assignees = ['user3', 'user4']
 """
+sample_config_sha = hashlib.sha1(b'blob %d\0%s' % (len(sample_config), sample_config)).hexdigest()
+custom_triggers_config = b"""
+[tool.hooky]
+reviewers = ['user1', 'user2']
+request_update_trigger = 'eggs'
+"""
+custom_triggers_config_sha = hashlib.sha1(
+    b'blob %d\0%s' % (len(custom_triggers_config), custom_triggers_config)
+).hexdigest()
 
 
 async def py_project_content(request: Request) -> Response:
@@ -103,14 +113,91 @@ async def py_project_content(request: Request) -> Response:
     if repo == 'no_reviewers':
         return json_response({}, status=404)
     else:
-        return json_response(
-            {'content': base64.b64encode(sample_config).decode(), 'encoding': 'base64', 'type': 'file'}
+        return etag_json_response(
+            request,
+            {
+                'sha': sample_config_sha,
+                'content': base64.b64encode(sample_config).decode(),
+                'encoding': 'base64',
+                'type': 'file',
+            },
         )
 
 
+async def check_collaborator(request: Request) -> Response:
+    collaborator = request.match_info['username'] in {request.match_info['org'], 'an_other'}
+    return Response(status=204 if collaborator else 404)
+
+
+async def compare_commits(request: Request) -> Response:
+    assert request.match_info['basehead'] == 'main...abc'
+    return json_response({'merge_base_commit': {'sha': 'merge_base'}, 'commits': [], 'files': []})
+
+
+def changes_trees(variables: dict[str, str]) -> dict:
+    """
+    The `changes` directory at the merge base of a pull request and at its head, the base branch had been merged
+    into the pull request, bringing "100-merged.md", which has since been deleted from the base branch.
+    """
+
+    def tree(*names: str) -> dict:
+        return {'entries': [{'name': n, 'type': 'blob'} for n in names]}
+
+    assert (variables['base'], variables['head']) == ('merge_base:changes', 'abc:changes')
+    return {
+        'base': tree('README.md', '50-released.md', '100-merged.md'),
+        'head': tree('README.md', '50-released.md', '100-merged.md', '123-foobar.md'),
+    }
+
+
+async def graphql(request: Request) -> Response:
+    data = await request.json()
+    variables = data['variables']
+    if 'base: object' in data['query']:
+        return json_response({'data': {'repository': changes_trees(variables)}})
+    if variables['name'] == 'graphql_error':
+        return json_response({'data': None, 'errors': [{'message': 'Something went wrong'}]})
+    headers = {'X-RateLimit-Resource': 'graphql', 'X-RateLimit-Limit': '5000', 'X-RateLimit-Remaining': '4999'}
+    if variables['name'] in {'graphql_rate_limited', 'graphql_rate_limited_long', 'graphql_rate_limited_always'}:
+        # the first query, or every query, hits GraphQL's rate limit, which is reported in a 200 response
+        dynamic = request.app['dynamic']
+        dynamic['graphql_rate_limited'] = dynamic.get('graphql_rate_limited', 0) + 1
+        if dynamic['graphql_rate_limited'] == 1 or variables['name'] != 'graphql_rate_limited':
+            reset = time() + (3600 if variables['name'] == 'graphql_rate_limited_long' else 0.01)
+            headers.update({'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(reset)})
+            error = {'type': 'RATE_LIMITED', 'message': 'API rate limit exceeded for installation ID 654321.'}
+            return json_response({'data': None, 'errors': [error]}, headers=headers)
+    repository = {}
+    for key, expression in variables.items():
+        if key.startswith('e'):
+            blob = None
+            if expression.endswith(':pyproject.toml') and variables['name'] == 'custom_triggers':
+                blob = {
+                    'oid': custom_triggers_config_sha,
+                    'text': custom_triggers_config.decode(),
+                    'isTruncated': False,
+                }
+            elif expression.endswith(':pyproject.toml') and variables['name'] != 'no_reviewers':
+                blob = {'oid': sample_config_sha, 'text': sample_config.decode(), 'isTruncated': False}
+            repository[f'f{key[1:]}'] = blob
+    return json_response({'data': {'repository': repository}}, headers=headers)
+
+
 async def get_collaborators(request: Request) -> Response:
     org = request.match_info['org']
-    return json_response([{'login': org, 'type': 'User'}, {'login': 'an_other', 'type': 'User'}])
+    if request.match_info['repo'] == 'rate_limited':
+        # the first request hits a secondary rate limit
+        dynamic = request.app['dynamic']
+        dynamic['rate_limited'] = dynamic.get('rate_limited', 0) + 1
+        if dynamic['rate_limited'] == 1:
+            data = {
+                'message': 'You have exceeded a secondary rate limit. Please wait a few minutes before you try again.'
+            }
+            return json_response(data, status=403, headers={'Retry-After': '0'})
+    headers = {'X-RateLimit-Limit': '5000', 'X-RateLimit-Remaining': '4321', 'X-RateLimit-Reset': '1700000000'}
+    return etag_json_response(
+        request, [{'login': org, 'type': 'User'}, {'login': 'an_other', 'type': 'User'}], headers=headers
+    )
 
 
 async def repo_apps_installed(request: Request) -> Response:
@@ -120,6 +207,9 @@ async def repo_apps_installed(request: Request) -> Response:
 
 async def installation_access_token(request: Request) -> Response:
     assert request.headers['Accept'] == 'application/vnd.github+json'
+    if request.match_info['installation'] == '111':
+        # the app has been suspended or uninstalled
+        return json_response({'message': 'Not Found'}, status=404)
     return json_response({'token': 'foobar'})
 
 
@@ -167,17 +257,18 @@ routes = [
     web.get('/repos/{org}/{repo}/pulls/{pull_number}', pull_details),
     web.patch('/repos/{org}/{repo}/pulls/{pull_number}', pull_patch),
     web.get('/repos/{org}/{repo}/pulls/{pull_number}/files', pull_files),
-    web.get('/repos/{org}/{repo}/pulls/{pull_number}/commits', pull_commits),
     web.post('/repos/{org}/{repo}/statuses/{commit}', update_status),
-    web.get('/repos/{org}/{repo}/issues/comments/{comment_id}', comment_details),
-    web.post('/repos/{org}/{repo}/comments/{comment_id}/reactions', comment_reaction),
-    web.get('/repos/{org}/{repo}/issues/{issue_id}/labels', get_labels),
+    web.post('/repos/{org}/{repo}/issues/comments/{comment_id}/reactions', comment_reaction),
     web.post('/repos/{org}/{repo}/issues/{issue_id}/labels', add_labels),
+    web.delete('/repos/{org}/{repo}/issues/{issue_id}/labels/{label}', remove_label),
     web.post('/repos/{org}/{repo}/issues/{issue_id}/assignees', add_assignee),
     web.delete('/repos/{org}/{repo}/issues/{issue_id}/assignees', remove_assignee),
     web.get('/repos/{org}/{repo}/contents/pyproject.toml', py_project_content),
     web.get('/repos/{org}/{repo}/collaborators', get_collaborators),
+    web.get('/repos/{org}/{repo}/collaborators/{username}', check_collaborator),
     web.get('/repos/{org}/{repo}/installation', repo_apps_installed),
+    web.post('/graphql', graphql),
+    web.get('/repos/{org}/{repo}/compare/{basehead}', compare_commits),
     web.post('/app/installations/{installation}/access_tokens', installation_access_token),
     web.get('/repos/{org}/{repo}/issues/{issue_number}', issue_details),
     web.patch('/repos/{org}/{repo}/issues/{issue_number}', issue_patch),
@@ -0,0 +1,83 @@
+import redis
+from foxglove.testing import DummyServer
+
+from src import stats
+from src.collaborators import (
+    clear_collaborators_cache,
+    collaborators_cache_stats,
+    get_collaborators,
+    invalidate_collaborators,
+    invalidate_org_collaborators,
+    is_collaborator,
+)
+from src.github_auth import get_repo_client
+from src.settings import Settings
+
+
+def test_roster_cached(settings: Settings, dummy_server: DummyServer, redis_cli: redis.Redis, loop):
+    async def check():
+        gh_repo = await get_repo_client('user1/repo1', settings)
+        assert await get_collaborators(gh_repo, settings) == ('user1', 'an_other')
+        assert await is_collaborator(gh_repo, 'an_other', settings)
+        assert not await is_collaborator(gh_repo, 'someone', settings)
+
+    loop.run_until_complete(check())
+    assert dummy_server.log[-1] == 'GET /repos/user1/repo1/collaborators > 200'
+    assert redis_cli.lrange('collaborators_user1/repo1', 0, -1) == [b'', b'user1', b'an_other']
+    assert redis_cli.smembers('collaborators_repos_user1') == {b'user1/repo1'}
+
+    # another process, the roster is found in redis
+    clear_collaborators_cache()
+    loop.run_until_complete(check())
+    assert dummy_server.log[-1] == 'GET /repos/user1/repo1/collaborators > 200'
+    assert collaborators_cache_stats() == {'hit_rate': 0.8333, 'local_size': 1}
+
+
+def test_permission_check(settings: Settings, dummy_server: DummyServer, redis_cli: redis.Redis, loop):
+    async def check(login: str):
+        gh_repo = await get_repo_client('user1/repo1', settings)
+        return await is_collaborator(gh_repo, login, settings)
+
+    assert loop.run_until_complete(check('an_other'))
+    assert not loop.run_until_complete(check('someone'))
+    assert dummy_server.log[-2:] == [
+        'GET /repos/user1/repo1/collaborators/an_other > 204',
+        'GET /repos/user1/repo1/collaborators/someone > 404',
+    ]
+    assert stats.snapshot()['counters']['collaborators.permission_checked'] == 2
+    assert redis_cli.keys('collaborators_*') == []
+
+
+def test_empty_roster(settings: Settings, redis_cli: redis.Redis, loop):
+    class EmptyRepo:
+        full_name = 'user1/empty'
+
+        async def get_collaborators(self):
+            for login in ():
+                yield login
+
+    assert loop.run_until_complete(get_collaborators(EmptyRepo(), settings)) == ()
+    clear_collaborators_cache()
+    assert loop.run_until_complete(is_collaborator(EmptyRepo(), 'user1', settings)) is False
+    assert stats.snapshot()['counters']['collaborators.redis_hit'] == 1
+
+
+def test_invalidate(settings: Settings, redis_cli: redis.Redis, loop):
+    class Repo:
+        def __init__(self, full_name: str):
+            self.full_name = full_name
+
+        async def get_collaborators(self):
+            yield type('User', (), {'login': 'user1'})
+
+    async def invalidate():
+        for repo in 'user1/repo1', 'user1/repo2', 'other/repo1':
+            await get_collaborators(Repo(repo), settings)
+        await invalidate_collaborators('user1/repo1', settings)
+        assert redis_cli.exists('collaborators_user1/repo1', 'collaborators_user1/repo2') == 1
+        assert await invalidate_org_collaborators('user1', settings) == 1
+        assert await invalidate_org_collaborators('user1', settings) == 0
+
+    loop.run_until_complete(invalidate())
+    assert sorted(redis_cli.keys('collaborators_*')) == [b'collaborators_other/repo1', b'collaborators_repos_other']
+    assert collaborators_cache_stats()['local_size'] == 1
@@ -0,0 +1,58 @@
+import pytest
+import redis
+from pytest_mock import MockerFixture
+
+from src import stats
+from src.deliveries import claim_delivery
+from src.logic import process_event as real_process_event
+from src.settings import Settings
+
+from .conftest import Client
+
+issue_comment = {
+    'action': 'created',
+    'comment': {'body': 'Hello world', 'user': {'login': 'user1'}, 'id': 123456},
+    'issue': {'user': {'login': 'user1'}, 'number': 123},
+    'repository': {'full_name': 'user1/repo1', 'owner': {'login': 'user1'}},
+}
+
+
+def test_duplicate_delivery(client: Client, redis_cli: redis.Redis, mocker: MockerFixture):
+    process_event = mocker.patch('src.views.process_event', wraps=real_process_event)
+    r = client.webhook(issue_comment, delivery_id='abc123')
+    assert r.status_code == 202, r.text
+    assert r.text == 'Ignoring event action "created", no action taken'
+    assert process_event.call_count == 1
+
+    r = client.webhook(issue_comment, delivery_id='abc123')
+    assert r.status_code == 202, r.text
+    assert r.text == 'Ignoring event action "created", no action taken'
+    assert process_event.call_count == 1
+
+    r = client.webhook(issue_comment, delivery_id='different')
+    assert r.status_code == 202, r.text
+    assert process_event.call_count == 2
+
+    assert stats.snapshot()['counters'] == {'deliveries.duplicate': 1, 'deliveries.new': 2}
+    assert stats.hit_rate('deliveries.duplicate', 'deliveries.new') == 0.3333
+    assert redis_cli.ttl('delivery_abc123') > 86_400
+
+
+def test_delivery_in_progress(client: Client, redis_cli: redis.Redis):
+    redis_cli.set('delivery_abc123', b'pending')
+    r = client.webhook(issue_comment, delivery_id='abc123')
+    assert r.status_code == 202, r.text
+    assert r.text == 'Delivery abc123 is already being processed'
+
+
+def test_delivery_error_released(client: Client, redis_cli: redis.Redis, mocker: MockerFixture):
+    mocker.patch('src.views.process_event', side_effect=RuntimeError('broken'))
+    with pytest.raises(RuntimeError, match='broken'):
+        client.webhook(issue_comment, delivery_id='abc123')
+    assert redis_cli.get('delivery_abc123') is None
+
+
+def test_delivery_pending_timeout(settings: Settings, loop, redis_cli: redis.Redis):
+    assert loop.run_until_complete(claim_delivery('abc123', settings)) is None
+    assert redis_cli.get('delivery_abc123') == b'pending'
+    assert 0 < redis_cli.ttl('delivery_abc123') <= settings.delivery_pending_timeout
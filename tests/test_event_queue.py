@@ -0,0 +1,128 @@
+import asyncio
+import json
+
+from src import stats
+from src.event_queue import EventQueue
+from src.settings import Settings
+
+from .conftest import Client
+
+
+def test_queue_process(settings: Settings, loop, mocker):
+    processed = []
+
+    def fake_process_event(*, request_body: bytes, settings: Settings, event_name: str | None) -> tuple[bool, str]:
+        processed.append((request_body, event_name))
+        return True, 'done'
+
+    mocker.patch('src.event_queue.process_event', side_effect=fake_process_event)
+
+    async def run():
+        queue = EventQueue(settings.model_copy(update={'queue_workers': 2}))
+        queue.start()
+        assert queue.put(b'one', None)
+        assert queue.put(b'two', 'issues')
+        await queue.drain()
+
+    loop.run_until_complete(run())
+    assert sorted(processed) == [(b'one', None), (b'two', 'issues')]
+    snapshot = stats.snapshot()
+    assert snapshot['counters'] == {'queue.accepted': 2}
+    assert snapshot['timings']['queue.wait']['count'] == 2
+    assert snapshot['timings']['queue.process']['count'] == 2
+
+
+def test_queue_full(settings: Settings, loop, mocker):
+    mocker.patch('src.event_queue.process_event', return_value=(False, 'nothing'))
+
+    async def run():
+        queue = EventQueue(settings.model_copy(update={'queue_workers': 1, 'queue_max_size': 1}))
+        queue.start()
+        assert queue.put(b'one', None)
+        assert not queue.put(b'two', 'issues')
+        assert queue.depth() == 1
+        await queue.drain()
+        assert queue.depth() == 0
+
+    loop.run_until_complete(run())
+    assert stats.snapshot()['counters'] == {'queue.accepted': 1, 'queue.rejected': 1}
+
+
+def test_queue_error(settings: Settings, loop, mocker, capsys):
+    mocker.patch('src.event_queue.process_event', side_effect=RuntimeError('broken'))
+
+    async def run():
+        queue = EventQueue(settings.model_copy(update={'queue_workers': 1}))
+        queue.start()
+        assert queue.put(b'one', None)
+        await queue.drain()
+
+    loop.run_until_complete(run())
+    assert stats.snapshot()['counters'] == {'queue.accepted': 1, 'queue.errors': 1}
+    out, err = capsys.readouterr()
+    assert 'RuntimeError: broken' in out
+
+
+def test_queue_delivery_result(settings: Settings, loop, redis_cli, mocker):
+    def fake_process_event(*, request_body: bytes, settings: Settings, event_name: str | None) -> tuple[bool, str]:
+        if request_body == b'broken':
+            raise RuntimeError('broken')
+        return False, 'nothing'
+
+    mocker.patch('src.event_queue.process_event', side_effect=fake_process_event)
+    redis_cli.mset({'delivery_good': b'pending', 'delivery_bad': b'pending'})
+
+    async def run():
+        queue = EventQueue(settings.model_copy(update={'queue_workers': 1}))
+        queue.start()
+        assert queue.put(b'one', None, 'good')
+        assert queue.put(b'broken', None, 'bad')
+        await queue.drain()
+
+    loop.run_until_complete(run())
+    assert json.loads(redis_cli.get('delivery_good')) == {'status_code': 202, 'message': 'nothing, no action taken'}
+    # released so the delivery can be redelivered
+    assert redis_cli.get('delivery_bad') is None
+
+
+def test_queue_drain_timeout(settings: Settings, loop, mocker, capsys):
+    async def run():
+        queue = EventQueue(settings.model_copy(update={'queue_workers': 0, 'queue_drain_timeout': 0.01}))
+        queue.start()
+        assert queue.put(b'one', None)
+        await queue.drain()
+
+    loop.run_until_complete(run())
+    out, err = capsys.readouterr()
+    assert 'Event queue drain timed out, 1 events dropped' in out
+
+
+def test_webhook_queued(client: Client, settings: Settings, loop, mocker):
+    queue = EventQueue(settings)
+    mocker.patch('src.views.event_queue', queue)
+    put = mocker.patch.object(queue, 'put', return_value=True)
+    r = client.webhook({'action': 'opened'})
+    assert r.status_code == 202, r.text
+    assert r.text == 'Event queued'
+    assert put.call_count == 1
+
+    put.return_value = False
+    r = client.webhook({'action': 'opened'})
+    assert r.status_code == 503, r.text
+    assert r.json() == {'detail': 'Event queue full'}
+
+
+def test_stats(client: Client):
+    r = client.webhook({})
+    assert r.status_code == 202, r.text
+    r = client.get('/stats/')
+    assert r.status_code == 200, r.text
+    data = r.json()
+    assert data['timings']['webhook.verify']['count'] == 1
+    assert data['timings']['webhook.process']['count'] == 1
+
+
+def test_queue_not_started(settings: Settings):
+    queue = EventQueue(settings)
+    assert queue.depth() == 0
+    asyncio.run(queue.drain())
@@ -1,5 +1,13 @@
+import asyncio
+from datetime import datetime, timezone
+from time import time
+
+import jwt
 from foxglove.testing import DummyServer
 
+from src import github_auth, stats
+from src.github_auth import _get_app_jwt, _token_lifetime, clear_token_cache, get_repo_client, refresh_tokens
+from src.http_session import pool_stats
 from src.settings import Settings
 
 from .conftest import Client
@@ -24,17 +32,172 @@ def test_config_cached(client: Client, settings: Settings, dummy_server: DummySe
     log1 = [
         'GET /repos/user1/repo1/installation > 200',
         'POST /app/installations/654321/access_tokens > 200',
-        'GET /repos/user1/repo1 > 200',
         'GET /repos/user1/repo1/pulls/123 > 200',
-        'GET /repos/user1/repo1/contents/.hooky.toml?ref=main > 404',
-        'GET /repos/user1/repo1/contents/pyproject.toml?ref=main > 200',
+        'POST /graphql > 200',
     ]
     assert dummy_server.log == log1
 
-    # do it again, installation is cached
+    # do it again, triggers are cached so no calls to GitHub are required
     r = client.webhook(data)
     assert r.status_code == 202, r.text
     assert r.text == (
-        "[Label and assign] neither 'please update' nor 'please review' found in comment body, no action taken"
+        "[Label and assign] no trigger phrase found in comment body, triggers: 'please review', 'please update', "
+        'no action taken'
+    )
+    assert dummy_server.log == log1
+
+    # this time with a trigger, installation is cached
+    data['comment'] = {'body': 'please update', 'user': {'login': 'other'}, 'id': 123457}
+    r = client.webhook(data)
+    assert r.status_code == 202, r.text
+    assert r.text == (
+        '[Label and assign] Only reviewers "user1", "user2" can assign the author, not "other", no action taken'
     )
-    assert dummy_server.log == log1 + ['GET /repos/user1/repo1 > 200', 'GET /repos/user1/repo1/pulls/123 > 200']
+    assert dummy_server.log == log1 + ['GET /repos/user1/repo1/pulls/123 > 200']
+
+
+def test_access_token_cache(settings: Settings, dummy_server: DummyServer, redis_cli, loop):
+    def get_client(repo_full_name: str = 'user1/repo1', installation_id: int | None = None):
+        loop.run_until_complete(get_repo_client(repo_full_name, settings, installation_id))
+
+    get_client()
+    assert dummy_server.log == [
+        'GET /repos/user1/repo1/installation > 200',
+        'POST /app/installations/654321/access_tokens > 200',
+    ]
+    ttl = redis_cli.ttl('github_access_token_654321')
+    assert 3400 <= ttl <= 3500
+    assert redis_cli.get('github_installation_user1/repo1') == b'654321'
+
+    get_client()
+    clear_token_cache()
+    get_client()
+    get_client()
+    assert stats.snapshot()['counters'] == {
+        'tokens.created': 1,
+        'tokens.jwt_created': 1,
+        'tokens.local_hit': 2,
+        'tokens.redis_hit': 1,
+    }
+    # the repo is never fetched
+    assert len(dummy_server.log) == 2
+
+    # the token is shared with other repos in the same installation
+    get_client('user1/repo2')
+    assert dummy_server.log[2:] == ['GET /repos/user1/repo2/installation > 200']
+    # no need to find the installation if it's provided by the event
+    get_client('user1/repo3', 654321)
+    assert dummy_server.log[3:] == []
+    assert stats.snapshot()['counters'] == {
+        'tokens.created': 1,
+        'tokens.jwt_created': 2,
+        'tokens.local_hit': 4,
+        'tokens.redis_hit': 1,
+    }
+
+
+def test_token_lifetime():
+    expires_at = datetime.fromtimestamp(time() + 1800, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    token, lifetime = _token_lifetime({'token': 'abc', 'expires_at': expires_at})
+    assert token == 'abc'
+    assert 1798 <= lifetime <= 1800
+
+    assert _token_lifetime({'token': 'abc'}) == ('abc', 3600)
+
+
+def test_access_token_single_flight(settings: Settings, dummy_server: DummyServer, redis_cli, loop):
+    async def get_clients():
+        await asyncio.gather(*[get_repo_client('user1/repo1', settings, 654321) for _ in range(5)])
+
+    loop.run_until_complete(get_clients())
+    assert dummy_server.log.count('POST /app/installations/654321/access_tokens > 200') == 1
+    counters = stats.snapshot()['counters']
+    assert counters['tokens.created'] == 1
+    assert counters['tokens.jwt_created'] == 1
+    assert counters['tokens.created'] + counters.get('tokens.local_hit', 0) + counters.get('tokens.waited', 0) == 5
+
+
+def test_refresh_tokens(settings: Settings, dummy_server: DummyServer, redis_cli, loop):
+    def refresh() -> int:
+        return loop.run_until_complete(refresh_tokens(settings))
+
+    assert refresh() == 0
+    loop.run_until_complete(get_repo_client('user1/repo1', settings, 654321))
+    assert dummy_server.log.count('POST /app/installations/654321/access_tokens > 200') == 1
+    # token is still fresh
+    assert refresh() == 0
+
+    # the token is about to expire
+    redis_cli.expire('github_access_token_654321', 60)
+    github_auth._access_tokens[654321] = 'foobar', time() + 60
+    assert refresh() == 1
+    assert dummy_server.log.count('POST /app/installations/654321/access_tokens > 200') == 2
+    assert redis_cli.ttl('github_access_token_654321') > 3000
+
+    # the installation hasn't been used recently
+    github_auth._last_used[654321] = time() - settings.token_active_window - 1
+    github_auth._access_tokens[654321] = 'foobar', time() + 60
+    assert refresh() == 0
+    assert github_auth._last_used == {}
+
+
+def test_refresh_tokens_error(settings: Settings, dummy_server: DummyServer, redis_cli, loop, capsys):
+    github_auth._last_used.update({111: time(), 654321: time()})
+    assert loop.run_until_complete(refresh_tokens(settings)) == 1
+    # the installation which failed doesn't stop other tokens being refreshed
+    assert dummy_server.log == [
+        'POST /app/installations/111/access_tokens > 404',
+        'POST /app/installations/654321/access_tokens > 200',
+    ]
+    assert stats.snapshot()['counters']['tokens.refresh_errors'] == 1
+    out, err = capsys.readouterr()
+    assert 'Error refreshing access token for installation 111:' in out
+
+
+def test_installation_created(client: Client, dummy_server: DummyServer, redis_cli):
+    data = {
+        'action': 'created',
+        'installation': {'id': 654321},
+        'repositories': [{'full_name': 'user1/repo1'}, {'full_name': 'user1/repo2'}],
+    }
+    r = client.webhook(data, event_name='installation')
+    assert r.status_code == 200, r.text
+    assert r.text == '[Installation] access token created for installation 654321, 2 repos'
+    assert dummy_server.log == ['POST /app/installations/654321/access_tokens > 200']
+    assert redis_cli.get('github_installation_user1/repo2') == b'654321'
+    assert redis_cli.get('github_access_token_654321') == b'foobar'
+
+    r = client.webhook({'action': 'deleted', 'installation': {'id': 654321}}, event_name='installation')
+    assert r.status_code == 200, r.text
+    assert r.text == '[Installation] access token for installation 654321 removed'
+    assert redis_cli.get('github_access_token_654321') is None
+
+
+def test_app_jwt_reused(settings: Settings):
+    jwt1 = _get_app_jwt(settings)
+    assert _get_app_jwt(settings) == jwt1
+    assert stats.snapshot()['counters'] == {'tokens.jwt_created': 1}
+    payload = jwt.decode(jwt1, options={'verify_signature': False})
+    assert payload['iss'] == '12345'
+    assert payload['exp'] - payload['iat'] == 90
+
+    # the JWT is about to expire
+    github_auth._app_jwt = jwt1, int(time()) + 5
+    _get_app_jwt(settings)
+    assert stats.snapshot()['counters'] == {'tokens.jwt_created': 2}
+
+
+def test_connections_reused(settings: Settings, dummy_server: DummyServer, redis_cli, loop):
+    def get_client(repo_full_name: str):
+        loop.run_until_complete(get_repo_client(repo_full_name, settings))
+
+    get_client('user1/repo1')
+    before = pool_stats()
+    get_client('user1/repo2')
+    get_client('user1/repo3')
+    after = pool_stats()
+    # installation lookup for each repo, using the connection from the first client
+    assert after['requests'] - before['requests'] == 2
+    assert after['connections'] == before['connections']
+    assert after['connections_in_use'] == 0
+    assert after['pool_size'] >= settings.github_pool_size
@@ -0,0 +1,112 @@
+import pytest
+import redis
+from foxglove.testing import DummyServer
+
+from src import stats
+from src.github_auth import get_repo_client
+from src.github_client import GithubError, _endpoint_name
+from src.response_cache import cache_stats, clear_response_cache
+from src.settings import Settings
+
+from .dummy_server import sample_config, sample_config_sha
+
+
+def cache_counters():
+    return {k: v for k, v in stats.snapshot()['counters'].items() if k.startswith('github.cache.')}
+
+
+def test_conditional_request(settings: Settings, dummy_server: DummyServer, redis_cli: redis.Redis, loop):
+    async def get_collaborators():
+        gh_repo = await get_repo_client('user1/repo1', settings)
+        return [u.login async for u in gh_repo.get_collaborators()]
+
+    assert loop.run_until_complete(get_collaborators()) == ['user1', 'an_other']
+    assert loop.run_until_complete(get_collaborators()) == ['user1', 'an_other']
+    assert dummy_server.log[-3:] == [
+        'POST /app/installations/654321/access_tokens > 200',
+        'GET /repos/user1/repo1/collaborators > 200',
+        'GET /repos/user1/repo1/collaborators > 304',
+    ]
+    assert redis_cli.ttl(f'github_response_{dummy_server.server_name}/repos/user1/repo1/collaborators') > 86_400
+
+    # another process, the response is found in redis
+    clear_response_cache()
+    assert loop.run_until_complete(get_collaborators()) == ['user1', 'an_other']
+    assert dummy_server.log[-1] == 'GET /repos/user1/repo1/collaborators > 304'
+
+    assert cache_counters() == {'github.cache.collaborators.miss': 1, 'github.cache.collaborators.not_modified': 2}
+    assert cache_stats() == {'collaborators': {'requests': 3, 'hit_rate': 0.6667, 'not_modified_rate': 0.6667}}
+
+
+def test_changed_response(settings: Settings, dummy_server: DummyServer, redis_cli: redis.Redis, loop):
+    async def get_contents(ref: str | None = None):
+        gh_repo = await get_repo_client('user1/repo1', settings)
+        return await gh_repo.get_contents('pyproject.toml', ref=ref)
+
+    content = loop.run_until_complete(get_contents('main')).content
+    cache_key = f'github_response_{dummy_server.server_name}/repos/user1/repo1/contents/pyproject.toml?ref=main'
+    etag = redis_cli.hget(cache_key, 'etag')
+    assert etag is not None
+    redis_cli.hset(cache_key, mapping={'etag': '"old"', 'content': b'{"content": "old"}'})
+    clear_response_cache()
+
+    assert loop.run_until_complete(get_contents('main')).content == content
+    assert redis_cli.hget(cache_key, 'etag') == etag
+    # different parameters are cached separately
+    loop.run_until_complete(get_contents())
+    assert dummy_server.log[-3:] == [
+        'GET /repos/user1/repo1/contents/pyproject.toml?ref=main > 200',
+        'GET /repos/user1/repo1/contents/pyproject.toml?ref=main > 200',
+        'GET /repos/user1/repo1/contents/pyproject.toml > 200',
+    ]
+    assert cache_counters() == {'github.cache.contents.miss': 2, 'github.cache.contents.stale': 1}
+
+
+def test_errors_not_cached(settings: Settings, dummy_server: DummyServer, redis_cli: redis.Redis, loop):
+    async def get_contents():
+        gh_repo = await get_repo_client('user1/repo1', settings)
+        return await gh_repo.get_contents('.hooky.toml')
+
+    with pytest.raises(GithubError, match='404'):
+        loop.run_until_complete(get_contents())
+    assert redis_cli.keys('github_response_*') == []
+    assert cache_counters() == {}
+
+
+def test_get_blobs(settings: Settings, dummy_server: DummyServer, redis_cli: redis.Redis, loop):
+    async def get_blobs():
+        gh_repo = await get_repo_client('user1/repo1', settings)
+        return await gh_repo.get_blobs(('.hooky.toml', 'pyproject.toml'), ref='main')
+
+    blobs = loop.run_until_complete(get_blobs())
+    assert blobs['.hooky.toml'] is None
+    assert blobs['pyproject.toml'].oid == sample_config_sha
+    assert blobs['pyproject.toml'].text == sample_config.decode()
+    assert dummy_server.log[-1] == 'POST /graphql > 200'
+    # GraphQL requests aren't cached
+    assert redis_cli.keys('github_response_*') == []
+
+
+def test_graphql_error(settings: Settings, dummy_server: DummyServer, redis_cli: redis.Redis, loop):
+    async def get_blobs():
+        gh_repo = await get_repo_client('user1/graphql_error', settings)
+        return await gh_repo.get_blobs(('pyproject.toml',))
+
+    with pytest.raises(GithubError, match='Something went wrong'):
+        loop.run_until_complete(get_blobs())
+
+
+@pytest.mark.parametrize(
+    'url,endpoint',
+    [
+        ('https://api.github.com/repos/foo/bar', 'repo'),
+        ('https://api.github.com/repos/foo/bar/collaborators?page=2', 'collaborators'),
+        ('https://api.github.com/repos/foo/bar/pulls/123', 'pulls'),
+        ('https://api.github.com/repos/foo/bar/pulls/123/files', 'pulls.files'),
+        ('https://api.github.com/repos/foo/bar/issues/123/labels', 'issues.labels'),
+        ('https://api.github.com/repos/foo/bar/contents/docs/pyproject.toml?ref=main', 'contents'),
+        ('https://api.github.com/repositories/123/pulls/4/commits?page=2', 'repositories.pulls.commits'),
+    ],
+)
+def test_endpoint_name(url: str, endpoint: str):
+    assert _endpoint_name(url) == endpoint
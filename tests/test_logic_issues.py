@@ -1,11 +1,12 @@
 import pytest
 import redis
 
+from src.github_client import IssueDetails
 from src.logic.issues import IssueAction, LabelAssign
 from src.logic.models import User
 from src.repo_config import RepoConfig
 
-from .blocks import AttrBlock, CallableBlock, IterBlock
+from .blocks import AsyncCallableBlock, AttrBlock, CallableBlock, IterBlock
 
 
 @pytest.fixture(name='gh_repo')
@@ -17,17 +18,18 @@ def fix_gh_repo():
 def fix_gh_issue():
     return AttrBlock(
         'GhIssue',
-        edit=CallableBlock('edit'),
-        body='this is the issue body',
-        assignees=[],
-        add_to_assignees=CallableBlock('add_to_assignees'),
-        labels=[],
-        add_to_labels=CallableBlock('add_to_labels'),
-        create_reaction=CallableBlock('create_reaction'),
+        get_details=get_issue_details,
+        add_to_assignees=AsyncCallableBlock('add_to_assignees'),
+        add_to_labels=AsyncCallableBlock('add_to_labels'),
+        create_reaction=AsyncCallableBlock('create_reaction'),
     )
 
 
-def test_assign_new(settings, gh_issue, gh_repo, redis_cli):
+async def get_issue_details() -> IssueDetails:
+    return IssueDetails(assignees=[], labels=[])
+
+
+def test_assign_new(settings, loop, gh_issue, gh_repo, redis_cli):
     la = LabelAssign(
         gh_issue=gh_issue,
         gh_repo=gh_repo,
@@ -37,7 +39,7 @@ def test_assign_new(settings, gh_issue, gh_repo, redis_cli):
         config=RepoConfig(assignees=['user1', 'user2']),
         settings=settings,
     )
-    acted, msg = la.assign_new()
+    acted, msg = loop.run_until_complete(la.assign_new())
     assert acted, msg
     assert msg == '@user1 successfully assigned to issue, "unconfirmed" label added'
     assert gh_issue.__history__ == ["add_to_assignees: Call('user1')", "add_to_labels: Call('unconfirmed')"]
@@ -51,12 +53,12 @@ def test_assign_new(settings, gh_issue, gh_repo, redis_cli):
         config=RepoConfig(assignees=['user1', 'user2']),
         settings=settings,
     )
-    acted, msg = la2.assign_new()
+    acted, msg = loop.run_until_complete(la2.assign_new())
     assert acted, msg
     assert msg == '@user2 successfully assigned to issue, "unconfirmed" label added'
 
 
-def test_assign_new_one_assignee(settings, gh_issue, gh_repo, redis_cli):
+def test_assign_new_one_assignee(settings, loop, gh_issue, gh_repo, redis_cli):
     la = LabelAssign(
         gh_issue=gh_issue,
         gh_repo=gh_repo,
@@ -66,13 +68,13 @@ def test_assign_new_one_assignee(settings, gh_issue, gh_repo, redis_cli):
         config=RepoConfig(assignees=['user1']),
         settings=settings,
     )
-    acted, msg = la.assign_new()
+    acted, msg = loop.run_until_complete(la.assign_new())
     assert acted, msg
     assert msg == '@user1 successfully assigned to issue, "unconfirmed" label added'
     assert gh_issue.__history__ == ["add_to_assignees: Call('user1')", "add_to_labels: Call('unconfirmed')"]
 
 
-def test_do_not_assign_from_one_of_assignees(settings, gh_issue, gh_repo, redis_cli):
+def test_do_not_assign_from_one_of_assignees(settings, loop, gh_issue, gh_repo, redis_cli):
     la = LabelAssign(
         gh_issue=gh_issue,
         gh_repo=gh_repo,
@@ -82,12 +84,12 @@ def test_do_not_assign_from_one_of_assignees(settings, gh_issue, gh_repo, redis_
         config=RepoConfig(assignees=['user1', 'user2']),
         settings=settings,
     )
-    acted, msg = la.assign_new()
+    acted, msg = loop.run_until_complete(la.assign_new())
     assert not acted, msg
     assert gh_issue.__history__ == []
 
 
-def test_do_not_assign_on_reopen(settings, gh_issue, gh_repo, redis_cli):
+def test_do_not_assign_on_reopen(settings, loop, gh_issue, gh_repo, redis_cli):
     la = LabelAssign(
         gh_issue=gh_issue,
         gh_repo=gh_repo,
@@ -97,12 +99,12 @@ def test_do_not_assign_on_reopen(settings, gh_issue, gh_repo, redis_cli):
         config=RepoConfig(assignees=['user1']),
         settings=settings,
     )
-    acted, msg = la.assign_new()
+    acted, msg = loop.run_until_complete(la.assign_new())
     assert not acted, msg
     assert gh_issue.__history__ == []
 
 
-def test_many_assignments(settings, gh_issue, gh_repo, redis_cli: redis.Redis):
+def test_many_assignments(settings, loop, gh_issue, gh_repo, redis_cli: redis.Redis):
     la = LabelAssign(
         gh_issue=gh_issue,
         gh_repo=gh_repo,
@@ -116,27 +118,27 @@ def test_many_assignments(settings, gh_issue, gh_repo, redis_cli: redis.Redis):
     key = 'assignee:org/repo'
     assert redis_cli.get(key) is None
 
-    assert la._select_assignee() == 'user1'
-    assert la._select_assignee() == 'user2'
-    assert la._select_assignee() == 'user3'
-    assert la._select_assignee() == 'user4'
-    assert la._select_assignee() == 'user1'
-    assert la._select_assignee() == 'user2'
+    assert loop.run_until_complete(la._select_assignee()) == 'user1'
+    assert loop.run_until_complete(la._select_assignee()) == 'user2'
+    assert loop.run_until_complete(la._select_assignee()) == 'user3'
+    assert loop.run_until_complete(la._select_assignee()) == 'user4'
+    assert loop.run_until_complete(la._select_assignee()) == 'user1'
+    assert loop.run_until_complete(la._select_assignee()) == 'user2'
 
     redis_cli.set(key, 4_294_967_295)
-    assert la._select_assignee() == 'user4'
+    assert loop.run_until_complete(la._select_assignee()) == 'user4'
     assert redis_cli.get(key) == b'4294967296'
-    assert la._select_assignee() == 'user1'
+    assert loop.run_until_complete(la._select_assignee()) == 'user1'
     assert redis_cli.get(key) == b'1'
-    assert la._select_assignee() == 'user2'
-    assert la._select_assignee() == 'user3'
-    assert la._select_assignee() == 'user4'
-    assert la._select_assignee() == 'user1'
+    assert loop.run_until_complete(la._select_assignee()) == 'user2'
+    assert loop.run_until_complete(la._select_assignee()) == 'user3'
+    assert loop.run_until_complete(la._select_assignee()) == 'user4'
+    assert loop.run_until_complete(la._select_assignee()) == 'user1'
 
     redis_cli.set(key, 4_294_967_299)
-    assert la._select_assignee() == 'user4'
+    assert loop.run_until_complete(la._select_assignee()) == 'user4'
     assert redis_cli.get(key) == b'4'
 
     redis_cli.set(key, 4_294_967_300)
-    assert la._select_assignee() == 'user1'
+    assert loop.run_until_complete(la._select_assignee()) == 'user1'
     assert redis_cli.get(key) == b'1'
@@ -1,20 +1,32 @@
-import base64
 import re
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 import pytest
-from github import GithubException
 
-from src.logic.models import Comment, PullRequest, PullRequestUpdateEvent, Repository, User
-from src.logic.prs import LabelAssign, check_change_file, check_change_file_content, find_change_file
+from src import stats
+from src.github_client import Blob, Branch as GhBranch, PullRequestDetails
+from src.logic.models import Branch, Comment, PullRequest, PullRequestUpdateEvent, Repository, User
+from src.logic.prs import LabelAssign, check_change_file, check_change_file_content, find_change_file, set_status
 from src.repo_config import RepoConfig
 
-from .blocks import AttrBlock, CallableBlock, IterBlock
+from .blocks import AsyncCallableBlock, AttrBlock, CallableBlock, IterBlock
 
 
 @pytest.fixture(name='gh_repo')
 def fix_gh_repo():
-    return AttrBlock('GhRepo', get_collaborators=CallableBlock('get_collaborators', IterBlock('collaborators')))
+    return AttrBlock(
+        'GhRepo',
+        full_name='org/repo',
+        get_collaborators=CallableBlock('get_collaborators', IterBlock('collaborators')),
+        is_collaborator=AsyncCallableBlock('is_collaborator', False),
+    )
+
+
+def pr_details(body: str):
+    async def get_details() -> PullRequestDetails:
+        return PullRequestDetails(body=body, base=GhBranch(ref='main'))
+
+    return get_details
 
 
 @pytest.fixture(name='gh_pr')
@@ -22,19 +34,18 @@ def fix_gh_pr():
     return AttrBlock(
         'GhPr',
         get_issue_comment=CallableBlock(
-            'get_issue_comment', AttrBlock('Comment', create_reaction=CallableBlock('create_reaction'))
+            'get_issue_comment', AttrBlock('Comment', create_reaction=AsyncCallableBlock('create_reaction'))
         ),
-        body='this is the pr body',
-        add_to_labels=CallableBlock('add_to_labels'),
-        get_labels=CallableBlock('get_labels', IterBlock('get_labels', AttrBlock('labels', name='ready for review'))),
-        remove_from_labels=CallableBlock('remove_from_labels'),
-        add_to_assignees=CallableBlock('add_to_assignees'),
-        remove_from_assignees=CallableBlock('remove_from_assignees'),
-        edit=CallableBlock('edit'),
+        get_details=pr_details('this is the pr body'),
+        add_to_labels=AsyncCallableBlock('add_to_labels'),
+        remove_from_labels=AsyncCallableBlock('remove_from_labels'),
+        add_to_assignees=AsyncCallableBlock('add_to_assignees'),
+        remove_from_assignees=AsyncCallableBlock('remove_from_assignees'),
+        edit=AsyncCallableBlock('edit'),
     )
 
 
-def test_assign_author(settings, gh_pr, gh_repo):
+def test_assign_author(settings, loop, gh_pr, gh_repo):
     la = LabelAssign(
         gh_pr,
         gh_repo,
@@ -45,24 +56,25 @@ def test_assign_author(settings, gh_pr, gh_repo):
         RepoConfig(reviewers=['user1', 'user2']),
         settings,
     )
-    assert la.assign_author() == (
+    assert loop.run_until_complete(la.assign_author()) == (
         True,
         'Author user1 successfully assigned to PR, "awaiting author revision" label added',
     )
     # insert_assert(gh_pr.__history__)
     assert gh_pr.__history__ == [
-        "get_issue_comment: Call(123456) -> AttrBlock('Comment', create_reaction=CallableBlock('create_reaction'))",
+        (
+            "get_issue_comment: Call(123456) -> "
+            "AttrBlock('Comment', create_reaction=AsyncCallableBlock('create_reaction'))"
+        ),
         "get_issue_comment.create_reaction: Call('+1')",
         "add_to_labels: Call('awaiting author revision')",
-        "get_labels: Call() -> IterBlock('get_labels', AttrBlock('labels', name='ready for review'))",
-        "get_labels: Iter(AttrBlock('labels', name='ready for review'))",
         "remove_from_labels: Call('ready for review')",
         "add_to_assignees: Call('user1')",
         "remove_from_assignees: Call('user2')",
     ]
 
 
-def test_assign_author_remove_label(settings, gh_pr, gh_repo):
+def test_assign_author_remove_label(settings, loop, gh_pr, gh_repo):
     la = LabelAssign(
         gh_pr,
         gh_repo,
@@ -73,23 +85,24 @@ def test_assign_author_remove_label(settings, gh_pr, gh_repo):
         RepoConfig(reviewers=['user1']),
         settings,
     )
-    assert la.assign_author() == (
+    assert loop.run_until_complete(la.assign_author()) == (
         True,
         'Author user1 successfully assigned to PR, "awaiting author revision" label added',
     )
     # insert_assert(gh_pr.__history__)
     assert gh_pr.__history__ == [
-        "get_issue_comment: Call(123456) -> AttrBlock('Comment', create_reaction=CallableBlock('create_reaction'))",
+        (
+            "get_issue_comment: Call(123456) -> "
+            "AttrBlock('Comment', create_reaction=AsyncCallableBlock('create_reaction'))"
+        ),
         "get_issue_comment.create_reaction: Call('+1')",
         "add_to_labels: Call('awaiting author revision')",
-        "get_labels: Call() -> IterBlock('get_labels', AttrBlock('labels', name='ready for review'))",
-        "get_labels: Iter(AttrBlock('labels', name='ready for review'))",
         "remove_from_labels: Call('ready for review')",
         "add_to_assignees: Call('user1')",
     ]
 
 
-def test_author_request_review(settings, gh_pr, gh_repo, redis_cli):
+def test_author_request_review(settings, loop, gh_pr, gh_repo, redis_cli):
     la = LabelAssign(
         gh_pr,
         gh_repo,
@@ -100,16 +113,18 @@ def test_author_request_review(settings, gh_pr, gh_repo, redis_cli):
         RepoConfig(reviewers=['user1', 'user2']),
         settings,
     )
-    acted, msg = la.request_review()
+    acted, msg = loop.run_until_complete(la.request_review())
     assert acted, msg
     assert msg == '@user1 successfully assigned to PR as reviewer, "ready for review" label added'
     # insert_assert(gh_pr.__history__)
     assert gh_pr.__history__ == [
-        "get_issue_comment: Call(123456) -> AttrBlock('Comment', create_reaction=CallableBlock('create_reaction'))",
+        (
+            "get_issue_comment: Call(123456) -> "
+            "AttrBlock('Comment', create_reaction=AsyncCallableBlock('create_reaction'))"
+        ),
         "get_issue_comment.create_reaction: Call('+1')",
         "add_to_labels: Call('ready for review')",
-        "get_labels: Call() -> IterBlock('get_labels', AttrBlock('labels', name='ready for review'))",
-        "get_labels: Iter(AttrBlock('labels', name='ready for review'))",
+        "remove_from_labels: Call('awaiting author revision')",
         "edit: Call(body='this is the pr body\\n\\nSelected Reviewer: @user1')",
         "remove_from_assignees: Call('the_author')",
         "add_to_assignees: Call('user1')",
@@ -125,24 +140,55 @@ def test_author_request_review(settings, gh_pr, gh_repo, redis_cli):
         RepoConfig(reviewers=['user1', 'user2']),
         settings,
     )
-    acted, msg = la2.request_review()
+    acted, msg = loop.run_until_complete(la2.request_review())
     assert acted
     assert msg == '@user2 successfully assigned to PR as reviewer, "ready for review" label added'
 
 
-def test_request_review_magic_comment(settings, gh_repo, redis_cli):
+def test_request_review_snapshot(settings, loop, gh_pr, gh_repo, redis_cli):
+    snapshot = PullRequest(
+        number=123, state='open', user=User(login='the_author'), body='this is the pr body\n\nSelected Reviewer: @user2'
+    )
+    la = LabelAssign(
+        gh_pr,
+        gh_repo,
+        'comment',
+        Comment(body='x', user=User(login='the_author'), id=123456),
+        'the_author',
+        'org/repo',
+        RepoConfig(reviewers=['user1', 'user2']),
+        settings,
+        snapshot=snapshot,
+    )
+    acted, msg = loop.run_until_complete(la.request_review())
+    assert acted, msg
+    assert msg == '@user2 successfully assigned to PR as reviewer, "ready for review" label added'
+    # the body from the payload is used, the PR isn't fetched or edited
+    assert gh_pr.__history__ == [
+        (
+            "get_issue_comment: Call(123456) -> "
+            "AttrBlock('Comment', create_reaction=AsyncCallableBlock('create_reaction'))"
+        ),
+        "get_issue_comment.create_reaction: Call('+1')",
+        "add_to_labels: Call('ready for review')",
+        "remove_from_labels: Call('awaiting author revision')",
+        "remove_from_assignees: Call('the_author')",
+        "add_to_assignees: Call('user2')",
+    ]
+
+
+def test_request_review_magic_comment(settings, loop, gh_repo, redis_cli):
     gh_pr = AttrBlock(
         'GhPr',
         get_issue_comment=CallableBlock(
-            'get_issue_comment', AttrBlock('Comment', create_reaction=CallableBlock('create_reaction'))
+            'get_issue_comment', AttrBlock('Comment', create_reaction=AsyncCallableBlock('create_reaction'))
         ),
-        body='this is the pr body\n\nSelected Reviewer: @user2',
-        add_to_labels=CallableBlock('add_to_labels'),
-        get_labels=CallableBlock('get_labels', IterBlock('get_labels', AttrBlock('labels', name='ready for review'))),
-        remove_from_labels=CallableBlock('remove_from_labels'),
-        add_to_assignees=CallableBlock('add_to_assignees'),
-        remove_from_assignees=CallableBlock('remove_from_assignees'),
-        edit=CallableBlock('edit'),
+        get_details=pr_details('this is the pr body\n\nSelected Reviewer: @user2'),
+        add_to_labels=AsyncCallableBlock('add_to_labels'),
+        remove_from_labels=AsyncCallableBlock('remove_from_labels'),
+        add_to_assignees=AsyncCallableBlock('add_to_assignees'),
+        remove_from_assignees=AsyncCallableBlock('remove_from_assignees'),
+        edit=AsyncCallableBlock('edit'),
     )
     la = LabelAssign(
         gh_pr,
@@ -154,34 +200,35 @@ def test_request_review_magic_comment(settings, gh_repo, redis_cli):
         RepoConfig(reviewers=['user1', 'user2']),
         settings,
     )
-    acted, msg = la.request_review()
+    acted, msg = loop.run_until_complete(la.request_review())
     assert acted, msg
     assert msg == '@user2 successfully assigned to PR as reviewer, "ready for review" label added'
     # insert_assert(gh_pr.__history__)
     assert gh_pr.__history__ == [
-        "get_issue_comment: Call(123456) -> AttrBlock('Comment', create_reaction=CallableBlock('create_reaction'))",
+        (
+            "get_issue_comment: Call(123456) -> "
+            "AttrBlock('Comment', create_reaction=AsyncCallableBlock('create_reaction'))"
+        ),
         "get_issue_comment.create_reaction: Call('+1')",
         "add_to_labels: Call('ready for review')",
-        "get_labels: Call() -> IterBlock('get_labels', AttrBlock('labels', name='ready for review'))",
-        "get_labels: Iter(AttrBlock('labels', name='ready for review'))",
+        "remove_from_labels: Call('awaiting author revision')",
         "remove_from_assignees: Call('the_author')",
         "add_to_assignees: Call('user2')",
     ]
 
 
-def test_request_review_bad_magic_comment(settings, gh_repo, redis_cli):
+def test_request_review_bad_magic_comment(settings, loop, gh_repo, redis_cli):
     gh_pr = AttrBlock(
         'GhPr',
         get_issue_comment=CallableBlock(
-            'get_issue_comment', AttrBlock('Comment', create_reaction=CallableBlock('create_reaction'))
+            'get_issue_comment', AttrBlock('Comment', create_reaction=AsyncCallableBlock('create_reaction'))
         ),
-        body='this is the pr body\n\nSelected Reviewer: @other-person',
-        add_to_labels=CallableBlock('add_to_labels'),
-        get_labels=CallableBlock('get_labels', IterBlock('get_labels', AttrBlock('labels', name='ready for review'))),
-        remove_from_labels=CallableBlock('remove_from_labels'),
-        add_to_assignees=CallableBlock('add_to_assignees'),
-        remove_from_assignees=CallableBlock('remove_from_assignees'),
-        edit=CallableBlock('edit'),
+        get_details=pr_details('this is the pr body\n\nSelected Reviewer: @other-person'),
+        add_to_labels=AsyncCallableBlock('add_to_labels'),
+        remove_from_labels=AsyncCallableBlock('remove_from_labels'),
+        add_to_assignees=AsyncCallableBlock('add_to_assignees'),
+        remove_from_assignees=AsyncCallableBlock('remove_from_assignees'),
+        edit=AsyncCallableBlock('edit'),
     )
     la = LabelAssign(
         gh_pr,
@@ -193,12 +240,12 @@ def test_request_review_bad_magic_comment(settings, gh_repo, redis_cli):
         RepoConfig(reviewers=['user1', 'user2']),
         settings,
     )
-    acted, msg = la.request_review()
+    acted, msg = loop.run_until_complete(la.request_review())
     assert not acted, msg
     assert msg == 'Selected reviewer @other-person not in reviewers.'
 
 
-def test_request_review_one_reviewer(settings, gh_pr, gh_repo, redis_cli):
+def test_request_review_one_reviewer(settings, loop, gh_pr, gh_repo, redis_cli):
     la = LabelAssign(
         gh_pr,
         gh_repo,
@@ -209,21 +256,23 @@ def test_request_review_one_reviewer(settings, gh_pr, gh_repo, redis_cli):
         RepoConfig(reviewers=['user1']),
         settings,
     )
-    acted, msg = la.request_review()
+    acted, msg = loop.run_until_complete(la.request_review())
     assert acted, msg
     assert msg == '@user1 successfully assigned to PR as reviewer, "ready for review" label added'
     # insert_assert(gh_pr.__history__)
     assert gh_pr.__history__ == [
-        "get_issue_comment: Call(123456) -> AttrBlock('Comment', create_reaction=CallableBlock('create_reaction'))",
+        (
+            "get_issue_comment: Call(123456) -> "
+            "AttrBlock('Comment', create_reaction=AsyncCallableBlock('create_reaction'))"
+        ),
         "get_issue_comment.create_reaction: Call('+1')",
         "add_to_labels: Call('ready for review')",
-        "get_labels: Call() -> IterBlock('get_labels', AttrBlock('labels', name='ready for review'))",
-        "get_labels: Iter(AttrBlock('labels', name='ready for review'))",
+        "remove_from_labels: Call('awaiting author revision')",
         "edit: Call(body='this is the pr body\\n\\nSelected Reviewer: @user1')",
     ]
 
 
-def test_request_review_from_review(settings, gh_pr, gh_repo, redis_cli):
+def test_request_review_from_review(settings, loop, gh_pr, gh_repo, redis_cli):
     la = LabelAssign(
         gh_pr,
         gh_repo,
@@ -234,20 +283,19 @@ def test_request_review_from_review(settings, gh_pr, gh_repo, redis_cli):
         RepoConfig(reviewers=['user1', 'user2']),
         settings,
     )
-    acted, msg = la.request_review()
+    acted, msg = loop.run_until_complete(la.request_review())
     assert acted
     assert msg == '@user1 successfully assigned to PR as reviewer, "ready for review" label added'
     assert gh_pr.__history__ == [
         "add_to_labels: Call('ready for review')",
-        "get_labels: Call() -> IterBlock('get_labels', AttrBlock('labels', name='ready for review'))",
-        "get_labels: Iter(AttrBlock('labels', name='ready for review'))",
+        "remove_from_labels: Call('awaiting author revision')",
         "edit: Call(body='this is the pr body\\n\\nSelected Reviewer: @user1')",
         "remove_from_assignees: Call('other')",
         "add_to_assignees: Call('user1')",
     ]
 
 
-def test_request_review_not_author(settings, gh_pr, gh_repo):
+def test_request_review_not_author(settings, loop, gh_pr, gh_repo, redis_cli):
     la = LabelAssign(
         gh_pr,
         gh_repo,
@@ -258,12 +306,12 @@ def test_request_review_not_author(settings, gh_pr, gh_repo):
         RepoConfig(),
         settings,
     )
-    acted, msg = la.request_review()
+    acted, msg = loop.run_until_complete(la.request_review())
     assert not acted
     assert msg == 'Only the PR author @the_auth or reviewers can request a review, not "commenter"'
 
 
-def test_assign_author_not_reviewer(settings, gh_pr, gh_repo):
+def test_assign_author_not_reviewer(settings, loop, gh_pr, gh_repo):
     la = LabelAssign(
         gh_pr,
         gh_repo,
@@ -274,11 +322,14 @@ def test_assign_author_not_reviewer(settings, gh_pr, gh_repo):
         RepoConfig(reviewers=['user1', 'user2']),
         settings,
     )
-    assert la.assign_author() == (False, 'Only reviewers "user1", "user2" can assign the author, not "other"')
+    assert loop.run_until_complete(la.assign_author()) == (
+        False,
+        'Only reviewers "user1", "user2" can assign the author, not "other"',
+    )
     assert gh_pr.__history__ == []
 
 
-def test_assign_author_no_reviewers(settings, gh_pr, gh_repo):
+def test_assign_author_no_reviewers(settings, loop, gh_pr, gh_repo, redis_cli):
     la = LabelAssign(
         gh_pr,
         gh_repo,
@@ -289,17 +340,20 @@ def test_assign_author_no_reviewers(settings, gh_pr, gh_repo):
         RepoConfig(),
         settings,
     )
-    assert la.assign_author() == (False, 'Only reviewers (no reviewers configured) can assign the author, not "other"')
-    assert gh_repo.__history__ == [
-        "get_collaborators: Call() -> IterBlock('collaborators')",
-        'get_collaborators.collaborators: Iter()',
-    ]
+    assert loop.run_until_complete(la.assign_author()) == (
+        False,
+        'Only reviewers (the repository\'s collaborators) can assign the author, not "other"',
+    )
+    # the roster isn't fetched, only the commenter's access is checked
+    assert gh_repo.__history__ == ["is_collaborator: Call('other') -> False"]
     assert gh_pr.__history__ == []
 
 
-def test_get_collaborators(settings, gh_pr):
+def test_get_collaborators(settings, loop, gh_pr, redis_cli):
     gh_repo = AttrBlock(
         'GhRepo',
+        full_name='org/repo',
+        is_collaborator=AsyncCallableBlock('is_collaborator', True),
         get_collaborators=CallableBlock(
             'get_collaborators',
             IterBlock(
@@ -317,10 +371,11 @@ def test_get_collaborators(settings, gh_pr):
         RepoConfig(),
         settings,
     )
-    act, msg = la.assign_author()
+    act, msg = loop.run_until_complete(la.assign_author())
     assert act, msg
     assert msg == 'Author user1 successfully assigned to PR, "awaiting author revision" label added'
     assert gh_repo.__history__ == [
+        "is_collaborator: Call('colab2') -> True",
         (
             "get_collaborators: Call() -> IterBlock('collaborators', AttrBlock('Collaborator', login='colab1'), "
             "AttrBlock('Collaborator', login='colab2'))"
@@ -331,79 +386,93 @@ def test_get_collaborators(settings, gh_pr):
         ),
     ]
     assert gh_pr.__history__ == [
-        "get_issue_comment: Call(123456) -> AttrBlock('Comment', create_reaction=CallableBlock('create_reaction'))",
+        (
+            "get_issue_comment: Call(123456) -> "
+            "AttrBlock('Comment', create_reaction=AsyncCallableBlock('create_reaction'))"
+        ),
         "get_issue_comment.create_reaction: Call('+1')",
         "add_to_labels: Call('awaiting author revision')",
-        "get_labels: Call() -> IterBlock('get_labels', AttrBlock('labels', name='ready for review'))",
-        "get_labels: Iter(AttrBlock('labels', name='ready for review'))",
         "remove_from_labels: Call('ready for review')",
         "add_to_assignees: Call('user1')",
         "remove_from_assignees: Call('colab1', 'colab2')",
     ]
 
 
-def test_change_not_open(settings):
+def test_change_not_open(settings, loop):
     e = PullRequestUpdateEvent(
         action='foo',
         pull_request=PullRequest(number=123, state='closed', user=User(login='user1'), body=None),
         repository=Repository(full_name='user/repo', owner=User(login='user1')),
     )
-    assert check_change_file(e, settings) == (False, '[Check change file] Pull Request is closed, not open')
+    assert loop.run_until_complete(check_change_file(e, settings)) == (
+        False,
+        '[Check change file] Pull Request is closed, not open',
+    )
 
 
-def test_change_wrong_action(settings):
+def test_change_wrong_action(settings, loop):
     e = PullRequestUpdateEvent(
         action='foo',
         pull_request=PullRequest(number=123, state='open', user=User(login='user1'), body=None),
         repository=Repository(full_name='user/repo', owner=User(login='user1')),
     )
-    assert check_change_file(e, settings) == (False, '[Check change file] file change not checked on "foo"')
+    assert loop.run_until_complete(check_change_file(e, settings)) == (
+        False,
+        '[Check change file] file change not checked on "foo"',
+    )
 
 
-def test_change_user_bot(settings):
+def test_change_user_bot(settings, loop):
     e = PullRequestUpdateEvent(
         action='opened',
         pull_request=PullRequest(number=123, state='open', user=User(login='foobar[bot]'), body=None),
         repository=Repository(full_name='user/repo', owner=User(login='user1')),
     )
-    assert check_change_file(e, settings) == (False, '[Check change file] Pull Request author is a bot')
+    assert loop.run_until_complete(check_change_file(e, settings)) == (
+        False,
+        '[Check change file] Pull Request author is a bot',
+    )
+
+
+async def get_base_ref() -> str:
+    return 'foobar'
 
 
-def build_gh(*, pr_files: tuple[AttrBlock, ...] = (), get_contents: CallableBlock = None):
-    if get_contents is None:
-        get_contents = CallableBlock('get_contents', raises=GithubException(404, 'Not Found', {}))
+def build_gh(*, pr_files: tuple[AttrBlock, ...] = (), get_blobs: CallableBlock = None):
+    if get_blobs is None:
+        get_blobs = AsyncCallableBlock('get_blobs', {'.hooky.toml': None, 'pyproject.toml': None})
 
     return AttrBlock(
         'Gh',
-        _requester=AttrBlock(
-            'Requestor', _Requester__connection=AttrBlock('Connection', session=CallableBlock('session'))
-        ),
         get_pull=CallableBlock(
             'get_pull',
             AttrBlock(
                 'PullRequest',
-                get_commits=CallableBlock(
-                    'get_commits',
-                    IterBlock('commits', None, AttrBlock('Commit', create_status=CallableBlock('create_status'))),
-                ),
                 get_files=CallableBlock('get_files', IterBlock('files', *pr_files)),
-                base=AttrBlock(
-                    'Base', ref='foobar', repo=AttrBlock('Repo', full_name='user/repo', get_contents=get_contents)
+                get_base_ref=get_base_ref,
+                get_head_sha=AsyncCallableBlock('get_head_sha', 'abc'),
+                repo=AttrBlock(
+                    'Repo',
+                    full_name='user/repo',
+                    get_blobs=get_blobs,
+                    get_commit=CallableBlock(
+                        'get_commit', AttrBlock('Commit', create_status=AsyncCallableBlock('create_status'))
+                    ),
                 ),
             ),
         ),
     )
 
 
-def test_change_no_change_comment(settings, mocker):
+def test_change_no_change_comment(settings, loop, mocker):
     e = PullRequestUpdateEvent(
         action='opened',
         pull_request=PullRequest(number=123, state='open', user=User(login='foobar'), body='skip change file check'),
         repository=Repository(full_name='user/repo', owner=User(login='user1')),
     )
     gh = build_gh()
-    mocker.patch('src.logic.prs.get_repo_client', return_value=FakeGhContext(gh))
-    act, msg = check_change_file(e, settings)
+    mocker.patch('src.logic.prs.get_repo_client', return_value=gh)
+    act, msg = loop.run_until_complete(check_change_file(e, settings))
     assert act, msg
     assert msg == (
         '[Check change file] status set to "success" with description '
@@ -411,45 +480,32 @@ def test_change_no_change_comment(settings, mocker):
     )
 
 
-class FakeGhContext:
-    def __init__(self, gh):
-        self.gh = gh
-
-    def __enter__(self):
-        return self.gh
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        pass
-
-
-def test_change_no_change_file(settings, mocker):
+def test_change_no_change_file(settings, loop, mocker):
     e = PullRequestUpdateEvent(
         action='opened',
         pull_request=PullRequest(number=123, state='open', user=User(login='foobar'), body=None),
         repository=Repository(full_name='user/repo', owner=User(login='user1')),
     )
     gh = build_gh()
-    mocker.patch('src.logic.prs.get_repo_client', return_value=FakeGhContext(gh))
-    assert check_change_file(e, settings) == (
+    mocker.patch('src.logic.prs.get_repo_client', return_value=gh)
+    assert loop.run_until_complete(check_change_file(e, settings)) == (
         True,
         '[Check change file] status set to "error" with description "No change file found"',
     )
     # debug(gh.__history__)
 
 
-def test_change_file_not_required(settings, mocker):
+def test_change_file_not_required(settings, loop, mocker, redis_cli):
     e = PullRequestUpdateEvent(
         action='opened',
         pull_request=PullRequest(number=123, state='open', user=User(login='foobar'), body=None),
         repository=Repository(full_name='user/repo', owner=User(login='user1')),
     )
-    config_change_not_required = base64.b64encode(b'[tool.hooky]\nrequire_change_file = false').decode()
-    get_contents = CallableBlock(
-        'get_contents', AttrBlock('File', status='added', content=config_change_not_required, filename='.hooky.toml')
-    )
-    gh = build_gh(get_contents=get_contents)
-    mocker.patch('src.logic.prs.get_repo_client', return_value=FakeGhContext(gh))
-    act, msg = check_change_file(e, settings)
+    config_change_not_required = Blob(oid='abc', text='[tool.hooky]\nrequire_change_file = false')
+    get_blobs = AsyncCallableBlock('get_blobs', {'.hooky.toml': config_change_not_required})
+    gh = build_gh(get_blobs=get_blobs)
+    mocker.patch('src.logic.prs.get_repo_client', return_value=gh)
+    act, msg = loop.run_until_complete(check_change_file(e, settings))
     assert not act
     assert msg == '[Check change file] change file not required'
 
@@ -503,9 +559,25 @@ class FakeFile:
 @dataclass
 class FakePr:
     _files: list[FakeFile]
+    repo: Repository = field(default_factory=lambda: Repository(full_name='user/repo', owner=User(login='user')))
 
-    def get_files(self):
-        return self._files
+    async def get_files(self):
+        for f in self._files:
+            yield f
+
+    async def get_added_files(self, directory: str, head_sha: str | None = None) -> list[str] | None:
+        assert directory == 'changes'
+        return [f.filename for f in self._files if f.status == 'added' and f.filename.startswith('changes/')]
+
+
+def change_file_pr(*, head_sha: str | None = None, changed_files: int | None = None) -> PullRequest:
+    return PullRequest(
+        number=123,
+        state='open',
+        user=User(login='foobar'),
+        head=Branch(ref='feature', sha=head_sha) if head_sha else None,
+        changed_files=changed_files,
+    )
 
 
 @pytest.mark.parametrize(
@@ -518,15 +590,41 @@ class FakePr:
     ],
     ids=repr,
 )
-def test_find_change_file_ok(files, expected):
-    m = find_change_file(FakePr(files))
+@pytest.mark.parametrize('changed_files', [None, 2, 500])
+def test_find_change_file_ok(settings, loop, redis_cli, files, expected, changed_files):
+    m = loop.run_until_complete(find_change_file(FakePr(files), change_file_pr(changed_files=changed_files), settings))
     if expected is None:
         assert m is None
     else:
         assert m.groups() == expected
+    tree_compared = stats.counter('change_file.tree_compared')
+    assert (tree_compared, stats.counter('change_file.files_listed')) == ((1, 0) if changed_files == 500 else (0, 1))
+    assert redis_cli.keys('change_file_*') == []
+
+
+def test_find_change_file_prefer_own(settings, loop, redis_cli):
+    files = [FakeFile('added', 'changes/100-other.md'), FakeFile('added', 'changes/123-foobar.md')]
+    m = loop.run_until_complete(find_change_file(FakePr(files), change_file_pr(changed_files=500), settings))
+    assert m.groups() == ('123', 'foobar')
 
 
-def test_many_reviews(settings, gh_pr, gh_repo, redis_cli):
+def test_find_change_file_cached(settings, loop, redis_cli):
+    pr = FakePr([FakeFile('added', 'changes/123-foobar.md')])
+    m = loop.run_until_complete(find_change_file(pr, change_file_pr(head_sha='abc'), settings))
+    assert m.groups() == ('123', 'foobar')
+    assert redis_cli.get('change_file_user/repo_123_abc') == b'changes/123-foobar.md'
+
+    pr._files = []
+    m = loop.run_until_complete(find_change_file(pr, change_file_pr(head_sha='abc'), settings))
+    assert m.groups() == ('123', 'foobar')
+    assert loop.run_until_complete(find_change_file(pr, change_file_pr(head_sha='def'), settings)) is None
+    assert redis_cli.get('change_file_user/repo_123_def') == b''
+    assert loop.run_until_complete(find_change_file(pr, change_file_pr(head_sha='def'), settings)) is None
+    assert stats.counter('change_file.cache_hit') == 2
+    assert stats.counter('change_file.files_listed') == 2
+
+
+def test_many_reviews(settings, loop, gh_pr, gh_repo, redis_cli):
     la = LabelAssign(
         gh_pr,
         gh_repo,
@@ -541,27 +639,43 @@ def test_many_reviews(settings, gh_pr, gh_repo, redis_cli):
     key = 'reviewer:org/repo'
     assert redis_cli.get(key) is None
 
-    assert la.find_reviewer() == 'user1'
-    assert la.find_reviewer() == 'user2'
-    assert la.find_reviewer() == 'user3'
-    assert la.find_reviewer() == 'user4'
-    assert la.find_reviewer() == 'user1'
-    assert la.find_reviewer() == 'user2'
+    assert loop.run_until_complete(la.find_reviewer()) == 'user1'
+    assert loop.run_until_complete(la.find_reviewer()) == 'user2'
+    assert loop.run_until_complete(la.find_reviewer()) == 'user3'
+    assert loop.run_until_complete(la.find_reviewer()) == 'user4'
+    assert loop.run_until_complete(la.find_reviewer()) == 'user1'
+    assert loop.run_until_complete(la.find_reviewer()) == 'user2'
 
     redis_cli.set(key, 39)
-    assert la.find_reviewer() == 'user4'
+    assert loop.run_until_complete(la.find_reviewer()) == 'user4'
     assert redis_cli.get(key) == b'40'
-    assert la.find_reviewer() == 'user1'
+    assert loop.run_until_complete(la.find_reviewer()) == 'user1'
     assert redis_cli.get(key) == b'1'
-    assert la.find_reviewer() == 'user2'
-    assert la.find_reviewer() == 'user3'
-    assert la.find_reviewer() == 'user4'
-    assert la.find_reviewer() == 'user1'
+    assert loop.run_until_complete(la.find_reviewer()) == 'user2'
+    assert loop.run_until_complete(la.find_reviewer()) == 'user3'
+    assert loop.run_until_complete(la.find_reviewer()) == 'user4'
+    assert loop.run_until_complete(la.find_reviewer()) == 'user1'
 
     redis_cli.set(key, 43)
-    assert la.find_reviewer() == 'user4'
+    assert loop.run_until_complete(la.find_reviewer()) == 'user4'
     assert redis_cli.get(key) == b'4'
 
     redis_cli.set(key, 44)
-    assert la.find_reviewer() == 'user1'
+    assert loop.run_until_complete(la.find_reviewer()) == 'user1'
     assert redis_cli.get(key) == b'1'
+
+
+@pytest.mark.parametrize('head_sha,history', [('def', []), (None, ["get_pull.get_head_sha: Call() -> 'abc'"])])
+def test_set_status_head_sha(loop, head_sha, history):
+    gh = build_gh()
+    gh_pr = gh.get_pull(123)
+    act, msg = loop.run_until_complete(set_status(gh_pr, change_file_pr(head_sha=head_sha), 'success', 'all good'))
+    assert act, msg
+    # the head commit from the event is used if available, so the PR isn't fetched
+    assert [h for h in gh.__history__ if h.startswith('get_pull.get_head_sha')] == history
+    assert gh.__history__[-2:] == [
+        f"get_pull.repo.get_commit: Call({head_sha or 'abc'!r}) -> "
+        "AttrBlock('Commit', create_status=AsyncCallableBlock('create_status'))",
+        "get_pull.repo.get_commit.create_status: Call('success', description='all good', "
+        "target_url='https://github.com/pydantic/hooky#readme', context='change-file-checks')",
+    ]
@@ -0,0 +1,171 @@
+import asyncio
+from time import time
+
+import pytest
+from foxglove.testing import DummyServer
+
+from src import github_auth, stats
+from src.github_auth import get_repo_client
+from src.rate_limit import Budget, RateLimiter, RateLimitExceeded, get_rate_limiter, rate_limit_stats
+from src.settings import Settings
+
+
+def test_budget_tracked(settings: Settings, dummy_server: DummyServer, redis_cli, loop):
+    async def get_collaborators():
+        gh_repo = await get_repo_client('user1/repo1', settings)
+        return [u.login async for u in gh_repo.get_collaborators()]
+
+    assert loop.run_until_complete(get_collaborators()) == ['user1', 'an_other']
+    limiter = get_rate_limiter(654321, settings)
+    assert limiter.budgets == {'core': Budget(limit=5000, remaining=4321, reset=1700000000)}
+    # the reset time has passed
+    assert not limiter.budget_low()
+    assert rate_limit_stats() == {
+        '654321': {
+            'budgets': {'core': {'limit': 5000, 'remaining': 4321, 'reset_in': 0, 'paused_for': 0}},
+            'paused_for': 0,
+            'write_tokens': settings.github_write_burst,
+            'deferred': 0,
+        }
+    }
+
+
+def test_secondary_rate_limit_retried(settings: Settings, dummy_server: DummyServer, redis_cli, loop):
+    async def get_collaborators():
+        gh_repo = await get_repo_client('user1/rate_limited', settings)
+        return [u.login async for u in gh_repo.get_collaborators()]
+
+    assert loop.run_until_complete(get_collaborators()) == ['user1', 'an_other']
+    assert dummy_server.log[-2:] == [
+        'GET /repos/user1/rate_limited/collaborators > 403',
+        'GET /repos/user1/rate_limited/collaborators > 200',
+    ]
+    assert stats.snapshot()['counters']['github.rate_limit.limited'] == 1
+
+
+def test_limited_response(settings: Settings):
+    limiter = RateLimiter(1, settings)
+    reset = time() + 1000
+    headers = {'X-RateLimit-Limit': '5000', 'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(reset)}
+    assert limiter.update(403, headers, '{"message": "API rate limit exceeded"}') is True
+    assert limiter.budget('core').paused_until == pytest.approx(reset, abs=1)
+    assert limiter.budget_low()
+    # other resources have their own budget
+    assert limiter.budget('graphql').paused_until == 0
+    assert not limiter.budget_low('graphql')
+
+    # permission errors aren't rate limits
+    headers['X-RateLimit-Remaining'] = '100'
+    assert limiter.update(403, headers, '{"message": "Resource not accessible by integration"}') is False
+    assert limiter.update(429, {'Retry-After': '30'}, '') is True
+    # secondary rate limits apply to all resources
+    assert limiter.paused_until == pytest.approx(time() + 30, abs=1)
+
+
+def test_resources_tracked_separately(settings: Settings):
+    limiter = RateLimiter(1, settings)
+    reset = time() + 1000
+    core_headers = {'X-RateLimit-Limit': '5000', 'X-RateLimit-Remaining': '4000', 'X-RateLimit-Reset': str(reset)}
+    assert limiter.update(200, {**core_headers, 'X-RateLimit-Resource': 'core'}, '') is False
+    graphql_headers = {'X-RateLimit-Limit': '5000', 'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(reset)}
+    # the resource in the headers takes precedence
+    assert limiter.update(200, {**graphql_headers, 'X-RateLimit-Resource': 'graphql'}, '', 'core') is False
+    assert limiter.budgets['core'].remaining == 4000
+    assert limiter.budgets['graphql'].remaining == 0
+    assert not limiter.budget_low()
+    assert limiter.budget_low('graphql')
+
+    limiter.limited('graphql')
+    assert limiter.budgets['graphql'].paused_until == pytest.approx(reset, abs=1)
+    assert limiter.budgets['core'].paused_until == 0
+    with pytest.raises(RateLimitExceeded):
+        asyncio.run(limiter.wait('graphql'))
+    asyncio.run(limiter.wait('core'))
+
+
+def test_wait_too_long(settings: Settings, loop):
+    limiter = RateLimiter(1, settings)
+    limiter.paused_until = time() + settings.github_rate_limit_max_wait + 10
+    with pytest.raises(RateLimitExceeded, match=r'^installation 1 rate limited for \d+ more seconds$'):
+        loop.run_until_complete(limiter.wait())
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_write_bucket(settings: Settings, redis_cli, loop, processes):
+    write_settings = settings.model_copy(update={'github_write_burst': 2, 'github_writes_per_second': 10})
+    # separate limiters for the same installation, like in different processes, share the lock and bucket in redis
+    limiters = [RateLimiter(1, write_settings) for _ in range(processes)]
+    order = []
+
+    async def write(n: int):
+        async with limiters[n % processes].write_slot():
+            order.append(f'start {n}')
+            await asyncio.sleep(0.001)
+            order.append(f'end {n}')
+
+    async def run():
+        await asyncio.gather(*[write(n) for n in range(4)])
+
+    start = time()
+    loop.run_until_complete(run())
+    # writes are serialised, but with more than one process they're not necessarily in order
+    assert sorted(order[::2]) == ['start 0', 'start 1', 'start 2', 'start 3']
+    assert [e.replace('end', 'start') for e in order[1::2]] == order[::2]
+    # after the burst, writes wait for the bucket to refill
+    assert time() - start >= 0.2
+    assert stats.snapshot()['timings']['github.rate_limit.write_wait']['count'] >= 1
+    assert redis_cli.ttl('github_write_bucket_1') == 1
+
+
+def test_reaction_deferred(settings: Settings, dummy_server: DummyServer, redis_cli, loop):
+    async def react():
+        gh_repo = await get_repo_client('user1/repo1', settings)
+        limiter = get_rate_limiter(654321, settings)
+        limiter.budget('core').remaining = 10
+        limiter.budget('core').reset = time() + 0.05
+        await gh_repo.get_issue(123).create_reaction('+1')
+        assert rate_limit_stats()['654321']['deferred'] == 1
+        assert dummy_server.log[-1] == 'POST /app/installations/654321/access_tokens > 200'
+        # the access token expires before the deferred request is made
+        github_auth.clear_token_cache()
+        redis_cli.delete('github_access_token_654321')
+        await asyncio.gather(*limiter._deferred)
+
+    loop.run_until_complete(react())
+    assert dummy_server.log[-2:] == [
+        'POST /app/installations/654321/access_tokens > 200',
+        'POST /repos/user1/repo1/issues/123/reactions > 200',
+    ]
+    assert rate_limit_stats()['654321']['deferred'] == 0
+    assert stats.snapshot()['counters']['github.rate_limit.deferred'] == 1
+
+
+def test_graphql_rate_limited(settings: Settings, dummy_server: DummyServer, redis_cli, loop):
+    async def get_blobs():
+        gh_repo = await get_repo_client('user1/graphql_rate_limited', settings)
+        return await gh_repo.get_blobs(('pyproject.toml',))
+
+    blobs = loop.run_until_complete(get_blobs())
+    assert blobs['pyproject.toml'] is not None
+    assert dummy_server.log[-2:] == ['POST /graphql > 200', 'POST /graphql > 200']
+    assert stats.snapshot()['counters']['github.rate_limit.limited'] == 1
+    budgets = get_rate_limiter(654321, settings).budgets
+    # GraphQL's budget doesn't affect the REST API's
+    assert list(budgets) == ['graphql']
+    assert budgets['graphql'].remaining == 4999
+
+
+@pytest.mark.parametrize(
+    'repo,message',
+    [
+        ('graphql_rate_limited_long', r'^installation 654321 rate limited for \d+ more seconds$'),
+        ('graphql_rate_limited_always', '^GraphQL rate limited: '),
+    ],
+)
+def test_graphql_rate_limit_exceeded(settings: Settings, dummy_server: DummyServer, redis_cli, loop, repo, message):
+    async def get_blobs():
+        gh_repo = await get_repo_client(f'user1/{repo}', settings)
+        return await gh_repo.get_blobs(('pyproject.toml',))
+
+    with pytest.raises(RateLimitExceeded, match=message):
+        loop.run_until_complete(get_blobs())
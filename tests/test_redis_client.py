@@ -0,0 +1,43 @@
+import asyncio
+
+from src import stats
+from src.redis_client import close_redis_async, get_redis_async, pool_stats
+
+
+def test_async_client_per_loop(settings, redis_cli):
+    async def run():
+        client = get_redis_async(settings)
+        assert get_redis_async(settings) is client
+        await client.set('foo', 'bar')
+        assert await client.get('foo') == b'bar'
+        assert len(client.connection_pool._connections) == 1
+        await close_redis_async()
+        return client
+
+    # not `asyncio.run()` since that would unset the current event loop
+    loops = [asyncio.new_event_loop() for _ in range(2)]
+    try:
+        client1, client2 = (loop.run_until_complete(run()) for loop in loops)
+    finally:
+        for loop in loops:
+            loop.close()
+    assert client1 is not client2
+    assert stats.snapshot()['timings']['redis.async_pool_wait']['count'] == 4
+
+
+def test_pool_stats(settings, redis_cli, loop):
+    async def run():
+        client = get_redis_async(settings)
+        await client.set('foo', 'bar')
+        before = pool_stats()
+        assert before['connections_created'] >= 1
+        assert before['connections_in_use'] == 0
+        connection = await client.connection_pool.get_connection('GET')
+        try:
+            assert pool_stats()['connections_in_use'] == 1
+        finally:
+            await client.connection_pool.release(connection)
+        assert pool_stats() == before
+        assert stats.snapshot()['gauges']['redis.pools'] == before
+
+    loop.run_until_complete(run())
@@ -1,15 +1,16 @@
-import base64
+import asyncio
+import hashlib
 from dataclasses import dataclass
 
 import pytest
-from github import GithubException
+import rtoml
 
-from src.repo_config import RepoConfig
+from src import stats
+from src.github_client import Blob, GithubError
+from src.rate_limit import RateLimitExceeded
+from src.repo_config import RepoConfig, _hooky_table, clear_config_cache, config_cache_stats
 
-
-@dataclass
-class FakeFileContent:
-    content: str
+from .benchmark_config import large_pyproject
 
 
 class FakeRepo:
@@ -20,23 +21,28 @@ class FakeRepo:
         self.__calls__ = []
         self.full_name = full_name
 
-    def get_contents(self, path: str, ref: str = 'NotSet') -> FakeFileContent:
-        content = self.content.get(f'{path}:{ref}')
-        if content is None:
-            self.__calls__.append(f'{path}:{ref} -> error')
-            raise GithubException(404, 'Not found', {})
-        else:
-            self.__calls__.append(f'{path}:{ref} -> success')
-            return FakeFileContent(base64.b64encode(content.encode()).decode())
+    async def get_blobs(self, paths: tuple[str, ...], ref: str | None = None) -> dict[str, Blob | None]:
+        blobs = {}
+        for path in paths:
+            content = self.content.get(f'{path}:{ref or "NotSet"}')
+            if content is None:
+                self.__calls__.append(f'{path}:{ref or "NotSet"} -> error')
+                blobs[path] = None
+            else:
+                self.__calls__.append(f'{path}:{ref or "NotSet"} -> success')
+                blobs[path] = Blob(oid=self.sha(content), text=content)
+        return blobs
+
+    @staticmethod
+    def sha(content: str) -> str:
+        data = content.encode()
+        return hashlib.sha1(b'blob %d\0%s' % (len(data), data)).hexdigest()
 
 
 @pytest.mark.parametrize(
     'content,log_contains',
     [
-        (
-            None,
-            'test_org/test_repo#[default], No ".hooky.toml" or "pyproject.toml" found, using defaults: 404 "Not found"',
-        ),
+        (None, 'test_org/test_repo#[default], No ".hooky.toml" or "pyproject.toml" found, using defaults'),
         ('foobar', 'test_org/test_repo#[default]/.hooky.toml, Invalid config file, using defaults'),
         ('x = 4', 'test_org/test_repo#[default]/.hooky.toml, No [tools.hooky] section found, using defaults'),
         (
@@ -45,9 +51,9 @@ class FakeRepo:
         ),
     ],
 )
-def test_get_config_invalid(content, log_contains, capsys):
+def test_get_config_invalid(loop, settings, redis_cli, content, log_contains, capsys):
     repo = FakeRepo(content)
-    assert RepoConfig._load_raw(repo) is None
+    assert loop.run_until_complete(RepoConfig._load_raw(repo, settings=settings)) is None
     out, err = capsys.readouterr()
     assert log_contains in out
 
@@ -67,9 +73,9 @@ unconfirmed_label = 'unconfirmed label'
 """
 
 
-def test_get_config_valid():
+def test_get_config_valid(loop, settings, redis_cli):
     repo = FakeRepo(valid_config)
-    config = RepoConfig._load_raw(repo)
+    config = loop.run_until_complete(RepoConfig._load_raw(repo, settings=settings))
     assert config.model_dump() == {
         'reviewers': ['foobar', 'barfoo'],
         'request_update_trigger': 'eggs',
@@ -84,20 +90,18 @@ def test_get_config_valid():
 
 
 @dataclass
-class FakeBase:
+class CustomPr:
     repo: FakeRepo
-    ref: str
-
+    base_ref: str
 
-@dataclass
-class CustomPr:
-    base: FakeBase
+    async def get_base_ref(self) -> str:
+        return self.base_ref
 
 
-def test_cached_default(settings, redis_cli, capsys):
+def test_cached_default(loop, settings, redis_cli, capsys):
     repo = FakeRepo({'pyproject.toml:main': None, 'pyproject.toml:NotSet': valid_config})
-    pr = CustomPr(base=FakeBase(repo=repo, ref='main'))
-    config = RepoConfig.load(pr=pr, settings=settings)
+    pr = CustomPr(repo, 'main')
+    config = loop.run_until_complete(RepoConfig.load(pr=pr, settings=settings))
     assert config.reviewers == ['foobar', 'barfoo']
     assert repo.__calls__ == [
         '.hooky.toml:main -> error',
@@ -105,18 +109,202 @@ def test_cached_default(settings, redis_cli, capsys):
         '.hooky.toml:NotSet -> error',
         'pyproject.toml:NotSet -> success',
     ]
-    config = RepoConfig.load(pr=pr, settings=settings)
+    assert redis_cli.get('config_test_org/test_repo_main') == b'none'
+    assert 0 < redis_cli.ttl('config_test_org/test_repo_main') <= settings.config_missing_cache_timeout
+
+    clear_config_cache()
+    config = loop.run_until_complete(RepoConfig.load(pr=pr, settings=settings))
     assert config.reviewers == ['foobar', 'barfoo']
-    assert repo.__calls__ == [
-        '.hooky.toml:main -> error',
-        'pyproject.toml:main -> error',
-        '.hooky.toml:NotSet -> error',
-        'pyproject.toml:NotSet -> success',
-        '.hooky.toml:main -> error',
-        'pyproject.toml:main -> error',
-    ]
+    # the missing config for main is cached in redis, no more calls to GitHub
+    assert len(repo.__calls__) == 4
+    assert stats.snapshot()['counters'] == {
+        'config.local_miss': 4,
+        'config.missing': 1,
+        'config.parse_miss': 1,
+        'config.redis_hit': 2,
+        'config.redis_miss': 2,
+    }
     out, err = capsys.readouterr()
     assert (
         'test_org/test_repo#[default]/pyproject.toml, '
         "config: reviewers=['foobar', 'barfoo'] request_update_trigger='eggs'"
     ) in out
+
+
+def test_cached_triggers(loop, settings, redis_cli):
+    assert loop.run_until_complete(RepoConfig.cached_triggers('test_org/test_repo', settings)) is None
+
+    repo = FakeRepo({'pyproject.toml:main': valid_config, 'pyproject.toml:NotSet': None})
+    loop.run_until_complete(RepoConfig.load(pr=CustomPr(repo, 'main'), settings=settings))
+    assert loop.run_until_complete(RepoConfig.cached_triggers('test_org/test_repo', settings)) == {'eggs', 'spam'}
+
+    loop.run_until_complete(RepoConfig.load(pr=CustomPr(repo, 'other'), settings=settings))
+    assert loop.run_until_complete(RepoConfig.cached_triggers('test_org/test_repo', settings)) == {
+        'eggs',
+        'spam',
+        'please update',
+        'please review',
+    }
+    assert 0 < redis_cli.ttl('config_triggers_test_org/test_repo') <= settings.config_cache_timeout
+
+
+def test_local_cache(loop, settings, redis_cli):
+    repo = FakeRepo({'pyproject.toml:main': valid_config})
+    pr = CustomPr(repo, 'main')
+    config = loop.run_until_complete(RepoConfig.load(pr=pr, settings=settings))
+    assert config.reviewers == ['foobar', 'barfoo']
+    assert redis_cli.exists('config_test_org/test_repo_main')
+
+    redis_cli.flushdb()
+    assert loop.run_until_complete(RepoConfig.load(pr=pr, settings=settings)) is config
+    assert repo.__calls__ == ['.hooky.toml:main -> error', 'pyproject.toml:main -> success']
+    assert config_cache_stats() == {
+        'local_hit_rate': 0.5,
+        'redis_hit_rate': 0.0,
+        'parse_hit_rate': 0.0,
+        'local_size': 1,
+    }
+
+
+def test_local_cache_expired(loop, settings, redis_cli):
+    settings = settings.model_copy(update={'config_local_cache_timeout': 0})
+    repo = FakeRepo({'pyproject.toml:main': valid_config})
+    pr = CustomPr(repo, 'main')
+    config = loop.run_until_complete(RepoConfig.load(pr=pr, settings=settings))
+    config2 = loop.run_until_complete(RepoConfig.load(pr=pr, settings=settings))
+    assert config2 == config
+    assert repo.__calls__ == ['.hooky.toml:main -> error', 'pyproject.toml:main -> success']
+    assert config_cache_stats() == {
+        'local_hit_rate': 0.0,
+        'redis_hit_rate': 0.5,
+        'parse_hit_rate': 0.0,
+        'local_size': 1,
+    }
+
+
+def test_load_single_flight(loop, settings, redis_cli):
+    class SlowRepo(FakeRepo):
+        async def get_blobs(self, paths: tuple[str, ...], ref: str | None = None) -> dict[str, Blob | None]:
+            await asyncio.sleep(0.01)
+            return await super().get_blobs(paths, ref)
+
+    repo = SlowRepo({'pyproject.toml:main': valid_config})
+
+    async def load_many():
+        return await asyncio.gather(*[RepoConfig.load(pr=CustomPr(repo, 'main'), settings=settings) for _ in range(5)])
+
+    configs = loop.run_until_complete(load_many())
+    assert all(c is configs[0] for c in configs)
+    assert repo.__calls__ == ['.hooky.toml:main -> error', 'pyproject.toml:main -> success']
+    assert stats.snapshot()['counters'] == {
+        'config.load_waited': 4,
+        'config.local_miss': 5,
+        'config.parse_miss': 1,
+        'config.redis_miss': 1,
+    }
+
+
+def test_invalidate(loop, settings, redis_cli):
+    repo = FakeRepo({'pyproject.toml:NotSet': valid_config})
+    config = loop.run_until_complete(RepoConfig.load(issue=CustomPr(repo, 'main'), settings=settings))
+    assert config.reviewers == ['foobar', 'barfoo']
+
+    repo.content = {}
+    loop.run_until_complete(RepoConfig.invalidate('test_org/test_repo', 'main', default_branch=True, settings=settings))
+    config = loop.run_until_complete(RepoConfig.load(issue=CustomPr(repo, 'main'), settings=settings))
+    assert config == RepoConfig()
+
+
+@pytest.mark.parametrize(
+    'error,log_msg',
+    [
+        (GithubError(502, {'message': 'Server Error'}), '502 {"message": "Server Error"}'),
+        (
+            RateLimitExceeded('installation 1 rate limited for 600 more seconds'),
+            'installation 1 rate limited for 600 more seconds',
+        ),
+    ],
+)
+def test_fetch_error_not_cached(loop, settings, redis_cli, capsys, error, log_msg):
+    class ErrorRepo(FakeRepo):
+        async def get_blobs(self, paths: tuple[str, ...], ref: str | None = None) -> dict[str, Blob | None]:
+            self.__calls__.append(f'{ref or "NotSet"} -> error')
+            raise error
+
+    repo = ErrorRepo(None)
+    pr = CustomPr(repo, 'main')
+    assert loop.run_until_complete(RepoConfig.load(pr=pr, settings=settings)) == RepoConfig()
+    assert redis_cli.keys('config_*') == []
+    assert loop.run_until_complete(RepoConfig.cached_triggers('test_org/test_repo', settings)) is None
+
+    # the error isn't remembered, the next event fetches the config again
+    assert loop.run_until_complete(RepoConfig.load(pr=pr, settings=settings)) == RepoConfig()
+    assert repo.__calls__ == ['main -> error', 'NotSet -> error', 'main -> error', 'NotSet -> error']
+    assert stats.counter('config.fetch_error') == 4
+    out, err = capsys.readouterr()
+    assert f'test_org/test_repo#main, Error fetching config files, using defaults: {log_msg}' in out
+
+
+def test_parse_cached_by_sha(loop, settings, redis_cli, capsys):
+    repo1 = FakeRepo({'pyproject.toml:main': valid_config, 'pyproject.toml:other': valid_config})
+    repo2 = FakeRepo({'.hooky.toml:NotSet': valid_config}, full_name='test_org/other_repo')
+    config1 = loop.run_until_complete(RepoConfig.load(pr=CustomPr(repo1, 'main'), settings=settings))
+    config2 = loop.run_until_complete(RepoConfig.load(pr=CustomPr(repo1, 'other'), settings=settings))
+    assert config2 is config1
+    assert loop.run_until_complete(RepoConfig.load(issue=CustomPr(repo2, 'main'), settings=settings)) is config1
+
+    # another process, the parsed config is found in redis
+    clear_config_cache()
+    redis_cli.delete('config_test_org/test_repo_main')
+    config = loop.run_until_complete(RepoConfig.load(pr=CustomPr(repo1, 'main'), settings=settings))
+    assert config == config1
+
+    out, err = capsys.readouterr()
+    assert out.count('config: reviewers=') == 1
+    assert redis_cli.keys('config_blob_*') == [f'config_blob_{FakeRepo.sha(valid_config)}'.encode()]
+    counters = stats.snapshot()['counters']
+    assert counters['config.parse_miss'] == 1
+    assert counters['config.parse_local_hit'] == 2
+    assert counters['config.parse_redis_hit'] == 1
+
+
+@pytest.mark.parametrize('hooky_position', ['start', 'middle', 'end', None])
+def test_large_config_fast_path(hooky_position):
+    text = large_pyproject(hooky_position)
+    assert len(text) > 100_000
+    full = rtoml.loads(text)['tool'].get('hooky')
+    if full is None:
+        with pytest.raises(KeyError):
+            _hooky_table(text)
+    else:
+        assert (
+            _hooky_table(text)
+            == full
+            == {'reviewers': ['user1', 'user2'], 'assignees': ['user3'], 'require_change_file': False}
+        )
+    assert stats.snapshot()['counters'] == {'config.parse_fast': 1}
+
+
+@pytest.mark.parametrize(
+    'hooky_toml,expected,parse',
+    [
+        (
+            "[tool.hooky]\nreviewers = ['a']\n\n[ tool . hooky . extra ]\nx = 1\n",
+            {'reviewers': ['a'], 'extra': {'x': 1}},
+            'fast',
+        ),
+        ('[tool]\nhooky.reviewers = ["a"]\n', {'reviewers': ['a']}, 'fallback'),
+        ('[tool]\nhooky = {reviewers = ["a"]}\n', {'reviewers': ['a']}, 'fallback'),
+        ('[tool.hooky]\nreviewers = """\n[tool.other]\n"""\n', {'reviewers': '[tool.other]\n'}, 'fallback'),
+        ("[tool.other]\nx = '''\n[tool.hooky]\nreviewers = ['a']\n'''\n", None, 'fallback'),
+        ("[tool.hooky]\nreviewers = [\n    ['a']\n]\n", {'reviewers': [['a']]}, 'fallback'),
+    ],
+)
+def test_large_config_parse(hooky_toml, expected, parse):
+    text = large_pyproject(None) + '\n' + hooky_toml
+    if expected is None:
+        with pytest.raises(KeyError):
+            _hooky_table(text)
+    else:
+        assert _hooky_table(text) == expected
+    assert stats.snapshot()['counters'] == {f'config.parse_{parse}': 1}
@@ -1,8 +1,13 @@
 import hashlib
 import hmac
 
+import pytest
+import redis
 from foxglove.testing import DummyServer
 
+from src import stats
+from src.logic.models import extract_action
+from src.repo_config import RepoConfig
 from src.settings import Settings
 
 from .conftest import Client
@@ -63,14 +68,11 @@ def test_please_review(dummy_server: DummyServer, client: Client):
     assert dummy_server.log == [
         'GET /repos/user1/repo1/installation > 200',
         'POST /app/installations/654321/access_tokens > 200',
-        'GET /repos/user1/repo1 > 200',
         'GET /repos/user1/repo1/pulls/123 > 200',
-        'GET /repos/user1/repo1/contents/.hooky.toml?ref=main > 404',
-        'GET /repos/user1/repo1/contents/pyproject.toml?ref=main > 200',
-        'GET /repos/user1/repo1/issues/comments/123456 > 200',
-        'POST /repos/user1/repo1/comments/123456/reactions > 200',
+        'POST /graphql > 200',
+        'POST /repos/user1/repo1/issues/comments/123456/reactions > 200',
         'POST /repos/user1/repo1/issues/123/labels > 200',
-        'GET /repos/user1/repo1/issues/123/labels > 200',
+        'DELETE /repos/user1/repo1/issues/123/labels/awaiting%20author%20revision > 404',
         'PATCH /repos/user1/repo1/pulls/123 > 200',
         'DELETE /repos/user1/repo1/issues/123/assignees > 200',
         'POST /repos/user1/repo1/issues/123/assignees > 200',
@@ -97,17 +99,13 @@ def test_please_review_no_reviews(dummy_server: DummyServer, client: Client):
     assert dummy_server.log == [
         'GET /repos/foobar/no_reviewers/installation > 200',
         'POST /app/installations/654321/access_tokens > 200',
-        'GET /repos/foobar/no_reviewers > 200',
         'GET /repos/foobar/no_reviewers/pulls/123 > 200',
-        'GET /repos/foobar/no_reviewers/contents/.hooky.toml?ref=main > 404',
-        'GET /repos/foobar/no_reviewers/contents/pyproject.toml?ref=main > 404',
-        'GET /repos/foobar/no_reviewers/contents/.hooky.toml > 404',
-        'GET /repos/foobar/no_reviewers/contents/pyproject.toml > 404',
+        'POST /graphql > 200',
+        'POST /graphql > 200',
         'GET /repos/foobar/no_reviewers/collaborators > 200',
-        'GET /repos/foobar/no_reviewers/issues/comments/123456 > 200',
-        'POST /repos/foobar/no_reviewers/comments/123456/reactions > 200',
+        'POST /repos/foobar/no_reviewers/issues/comments/123456/reactions > 200',
         'POST /repos/foobar/no_reviewers/issues/123/labels > 200',
-        'GET /repos/foobar/no_reviewers/issues/123/labels > 200',
+        'DELETE /repos/foobar/no_reviewers/issues/123/labels/awaiting%20author%20revision > 404',
         'PATCH /repos/foobar/no_reviewers/pulls/123 > 200',
         'DELETE /repos/foobar/no_reviewers/issues/123/assignees > 200',
         'POST /repos/foobar/no_reviewers/issues/123/assignees > 200',
@@ -134,14 +132,11 @@ def test_comment_please_update(dummy_server: DummyServer, client: Client):
     assert dummy_server.log == [
         'GET /repos/user1/repo1/installation > 200',
         'POST /app/installations/654321/access_tokens > 200',
-        'GET /repos/user1/repo1 > 200',
         'GET /repos/user1/repo1/pulls/123 > 200',
-        'GET /repos/user1/repo1/contents/.hooky.toml?ref=main > 404',
-        'GET /repos/user1/repo1/contents/pyproject.toml?ref=main > 200',
-        'GET /repos/user1/repo1/issues/comments/123456 > 200',
-        'POST /repos/user1/repo1/comments/123456/reactions > 200',
+        'POST /graphql > 200',
+        'POST /repos/user1/repo1/issues/comments/123456/reactions > 200',
         'POST /repos/user1/repo1/issues/123/labels > 200',
-        'GET /repos/user1/repo1/issues/123/labels > 200',
+        'DELETE /repos/user1/repo1/issues/123/labels/ready%20for%20review > 404',
         'POST /repos/user1/repo1/issues/123/assignees > 200',
         'DELETE /repos/user1/repo1/issues/123/assignees > 200',
     ]
@@ -167,10 +162,8 @@ def test_review_please_update(dummy_server: DummyServer, client: Client):
     assert dummy_server.log == [
         'GET /repos/user1/repo1/installation > 200',
         'POST /app/installations/654321/access_tokens > 200',
-        'GET /repos/user1/repo1 > 200',
         'GET /repos/user1/repo1/pulls/123 > 200',
-        'GET /repos/user1/repo1/contents/.hooky.toml?ref=main > 404',
-        'GET /repos/user1/repo1/contents/pyproject.toml?ref=main > 200',
+        'POST /graphql > 200',
     ]
 
 
@@ -196,7 +189,14 @@ def test_change_file(dummy_server: DummyServer, client: Client):
     r = client.webhook(
         {
             'action': 'opened',
-            'pull_request': {'number': 123, 'user': {'login': 'foobar'}, 'state': 'open', 'body': 'this is a new PR'},
+            'pull_request': {
+                'number': 123,
+                'user': {'login': 'foobar'},
+                'state': 'open',
+                'body': 'this is a new PR',
+                'base': {'ref': 'main'},
+                'head': {'ref': 'feature', 'sha': 'abc'},
+            },
             'repository': {'full_name': 'user1/repo1', 'owner': {'login': 'user1'}},
         }
     )
@@ -204,15 +204,12 @@ def test_change_file(dummy_server: DummyServer, client: Client):
     assert r.text == (
         '[Check change file] status set to "success" with description "Change file ID #123 matches the Pull Request"'
     )
+    # the base branch and head commit are taken from the payload, so the PR isn't fetched
     assert dummy_server.log == [
         'GET /repos/user1/repo1/installation > 200',
         'POST /app/installations/654321/access_tokens > 200',
-        'GET /repos/user1/repo1 > 200',
-        'GET /repos/user1/repo1/pulls/123 > 200',
-        'GET /repos/user1/repo1/contents/.hooky.toml?ref=main > 404',
-        'GET /repos/user1/repo1/contents/pyproject.toml?ref=main > 200',
-        'GET /repos/user1/repo1/pulls/123/files > 200',
-        'GET /repos/user1/repo1/pulls/123/commits > 200',
+        'POST /graphql > 200',
+        'GET /repos/user1/repo1/pulls/123/files?per_page=100 > 200',
         'POST /repos/user1/repo1/statuses/abc > 200',
     ]
 
@@ -230,11 +227,9 @@ def test_issue_opened(dummy_server: DummyServer, client: Client):
     assert dummy_server.log == [
         'GET /repos/user1/repo1/installation > 200',
         'POST /app/installations/654321/access_tokens > 200',
-        'GET /repos/user1/repo1 > 200',
+        'POST /graphql > 200',
+        # the issue is only fetched when its assignees are checked
         'GET /repos/user1/repo1/issues/123 > 200',
-        'GET /repos/user1/repo1 > 200',
-        'GET /repos/user1/repo1/contents/.hooky.toml > 404',
-        'GET /repos/user1/repo1/contents/pyproject.toml > 200',
         'POST /repos/user1/repo1/issues/123/assignees > 200',
         'POST /repos/user1/repo1/issues/123/labels > 200',
     ]
@@ -253,11 +248,7 @@ def test_issue_opened_by_assignee(dummy_server: DummyServer, client: Client):
     assert dummy_server.log == [
         'GET /repos/user1/repo1/installation > 200',
         'POST /app/installations/654321/access_tokens > 200',
-        'GET /repos/user1/repo1 > 200',
-        'GET /repos/user1/repo1/issues/123 > 200',
-        'GET /repos/user1/repo1 > 200',
-        'GET /repos/user1/repo1/contents/.hooky.toml > 404',
-        'GET /repos/user1/repo1/contents/pyproject.toml > 200',
+        'POST /graphql > 200',
     ]
 
 
@@ -272,3 +263,312 @@ def test_issue_reopened(dummy_server: DummyServer, client: Client):
     assert r.status_code == 202, r.text
     assert r.text == 'Ignoring event action "reopened", no action taken'
     assert dummy_server.log == []
+
+
+def test_ignored_event_name(dummy_server: DummyServer, client: Client):
+    r = client.webhook({'zen': 'Keep it logically awesome.'}, event_name='ping')
+    assert r.status_code == 202, r.text
+    assert r.text == 'Ignoring "ping" event, no action taken'
+    assert dummy_server.log == []
+
+
+def test_ignored_event_action(dummy_server: DummyServer, client: Client, mocker):
+    # the payload isn't valid, but that doesn't matter since only the action is inspected
+    process_event = mocker.patch('src.views.process_event')
+    r = client.webhook({'action': 'labeled', 'pull_request': {}}, event_name='pull_request')
+    assert r.status_code == 202, r.text
+    assert r.text == 'Ignoring event action "labeled", no action taken'
+    assert process_event.call_count == 0
+    assert dummy_server.log == []
+
+
+def test_routed_event(dummy_server: DummyServer, client: Client):
+    r = client.webhook(
+        {
+            'action': 'created',
+            'comment': {'body': 'Hello world', 'user': {'login': 'user1'}, 'id': 123456},
+            'issue': {'user': {'login': 'user1'}, 'number': 123},
+            'repository': {'full_name': 'user1/repo1', 'owner': {'login': 'user1'}},
+        },
+        event_name='issue_comment',
+    )
+    assert r.status_code == 202, r.text
+    assert r.text == 'Ignoring event action "created", no action taken'
+
+
+def test_routed_event_invalid(client: Client):
+    r = client.webhook({'action': 'opened', 'issue': {}}, event_name='issues')
+    assert r.status_code == 202, r.text
+    assert r.text == 'Error parsing request body, no action taken'
+
+
+def test_comment_state_from_payload(dummy_server: DummyServer, client: Client):
+    r = client.webhook(
+        {
+            'action': 'edited',
+            'pull_request': {
+                'number': 123,
+                'user': {'login': 'user1'},
+                'state': 'open',
+                'body': 'skip change file check',
+                'base': {'ref': 'main'},
+                'head': {'ref': 'feature', 'sha': 'abc'},
+            },
+            'repository': {'full_name': 'user1/repo1', 'owner': {'login': 'user1'}},
+        }
+    )
+    assert r.status_code == 200, r.text
+    dummy_server.log.clear()
+
+    r = client.webhook(
+        {
+            'action': 'created',
+            'comment': {'body': 'Hello world, please update', 'user': {'login': 'user1'}, 'id': 123456},
+            'issue': {
+                'pull_request': {'url': 'https://api.github.com/repos/user1/repo1/pulls/123'},
+                'user': {'login': 'user1'},
+                'number': 123,
+                'assignees': [],
+            },
+            'repository': {'full_name': 'user1/repo1', 'owner': {'login': 'user1'}},
+        }
+    )
+    assert r.status_code == 200, r.text
+    assert r.text == (
+        '[Label and assign] Author user1 successfully assigned to PR, "awaiting author revision" label added'
+    )
+    # the base branch is known from the "pull_request" event so there are no reads, labels are removed without
+    # checking the PR has them, here the PR doesn't have the label so GitHub responds with 404
+    assert dummy_server.log == [
+        'POST /repos/user1/repo1/issues/comments/123456/reactions > 200',
+        'POST /repos/user1/repo1/issues/123/labels > 200',
+        'DELETE /repos/user1/repo1/issues/123/labels/ready%20for%20review > 404',
+        'POST /repos/user1/repo1/issues/123/assignees > 200',
+        'DELETE /repos/user1/repo1/issues/123/assignees > 200',
+    ]
+
+
+def test_issue_opened_state_from_payload(dummy_server: DummyServer, client: Client):
+    r = client.webhook(
+        {
+            'action': 'opened',
+            'issue': {
+                'user': {'login': 'user1'},
+                'number': 123,
+                'labels': [{'name': 'unconfirmed'}],
+                'assignees': [{'login': 'user3'}],
+            },
+            'repository': {'full_name': 'user1/repo1', 'owner': {'login': 'user1'}},
+        }
+    )
+    assert r.status_code == 200, r.text
+    assert r.text == '@user3 successfully assigned to issue, "unconfirmed" label added'
+    # the issue isn't fetched, the assignee and label are already set
+    assert dummy_server.log == [
+        'GET /repos/user1/repo1/installation > 200',
+        'POST /app/installations/654321/access_tokens > 200',
+        'POST /graphql > 200',
+    ]
+
+
+def test_change_file_large_pr(dummy_server: DummyServer, client: Client, redis_cli: redis.Redis):
+    event = {
+        'action': 'synchronize',
+        'pull_request': {
+            'number': 123,
+            'user': {'login': 'foobar'},
+            'state': 'open',
+            'body': 'this is a new PR',
+            'base': {'ref': 'main'},
+            'head': {'ref': 'feature', 'sha': 'abc'},
+            'changed_files': 2000,
+        },
+        'repository': {'full_name': 'user1/repo1', 'owner': {'login': 'user1'}},
+    }
+    r = client.webhook(event)
+    assert r.status_code == 200, r.text
+    assert r.text == (
+        '[Check change file] status set to "success" with description "Change file ID #123 matches the Pull Request"'
+    )
+    # the changes directory at the merge base and the head are compared instead of listing all files
+    assert dummy_server.log[-4:] == [
+        'POST /graphql > 200',
+        'GET /repos/user1/repo1/compare/main...abc?per_page=1 > 200',
+        'POST /graphql > 200',
+        'POST /repos/user1/repo1/statuses/abc > 200',
+    ]
+    assert redis_cli.get('change_file_user1/repo1_123_abc') == b'changes/123-foobar.md'
+
+    dummy_server.log.clear()
+    r = client.webhook(event)
+    assert r.status_code == 200, r.text
+    # the config and change file are both cached
+    assert dummy_server.log == ['POST /repos/user1/repo1/statuses/abc > 200']
+
+
+def push_event(ref: str, *changed_files: str) -> dict:
+    return {
+        'ref': ref,
+        'repository': {'full_name': 'user1/repo1', 'owner': {'login': 'user1'}, 'default_branch': 'main'},
+        'commits': [{'added': [], 'modified': ['src/foobar.py'], 'removed': []}, {'modified': list(changed_files)}],
+        'installation': {'id': 654321},
+    }
+
+
+def set_config_keys(redis_cli: redis.Redis) -> None:
+    for key in 'config_user1/repo1', 'config_user1/repo1_main', 'config_user1/repo1_feature':
+        redis_cli.set(key, '{}')
+    redis_cli.sadd('config_triggers_user1/repo1', 'please update', 'please review')
+
+
+def test_push_default_branch_config(dummy_server: DummyServer, client: Client, redis_cli: redis.Redis):
+    set_config_keys(redis_cli)
+    r = client.webhook(push_event('refs/heads/main', 'pyproject.toml'), event_name='push')
+    assert r.status_code == 200, r.text
+    assert r.text == '[Config] cached config for main reloaded'
+    assert sorted(redis_cli.keys('config_user1/*')) == [b'config_user1/repo1', b'config_user1/repo1_feature']
+    assert RepoConfig.model_validate_json(redis_cli.get('config_user1/repo1')).reviewers == ['user1', 'user2']
+    assert dummy_server.log == ['POST /app/installations/654321/access_tokens > 200', 'POST /graphql > 200']
+
+
+def test_push_new_trigger(dummy_server: DummyServer, client: Client, redis_cli: redis.Redis):
+    redis_cli.set('config_user1/custom_triggers', RepoConfig().model_dump_json())
+    redis_cli.sadd('config_triggers_user1/custom_triggers', 'please update', 'please review')
+
+    # the new config on main adds the "eggs" trigger
+    event = push_event('refs/heads/main', 'pyproject.toml')
+    event['repository']['full_name'] = 'user1/custom_triggers'
+    r = client.webhook(event, event_name='push')
+    assert r.status_code == 200, r.text
+    assert redis_cli.smembers('config_triggers_user1/custom_triggers') == {b'please update', b'please review', b'eggs'}
+
+    comment = pr_comment('eggs', 123)
+    comment['repository']['full_name'] = 'user1/custom_triggers'
+    r = client.webhook(comment)
+    assert r.status_code == 200, r.text
+    assert r.text == (
+        '[Label and assign] Author user1 successfully assigned to PR, "awaiting author revision" label added'
+    )
+    assert stats.snapshot()['counters'].get('label_assign.prefiltered') is None
+
+
+def test_push_branch_config(dummy_server: DummyServer, client: Client, redis_cli: redis.Redis):
+    set_config_keys(redis_cli)
+    r = client.webhook(push_event('refs/heads/feature', '.hooky.toml'), event_name='push')
+    assert r.status_code == 200, r.text
+    assert r.text == '[Config] cached config for feature reloaded'
+    config = RepoConfig.model_validate_json(redis_cli.get('config_user1/repo1_feature'))
+    assert config.reviewers == ['user1', 'user2']
+    assert redis_cli.get('config_user1/repo1_main') == b'{}'
+    assert redis_cli.get('config_user1/repo1') == b'{}'
+
+
+def pr_comment(body: str, number: int) -> dict:
+    return {
+        'action': 'created',
+        'comment': {'body': body, 'user': {'login': 'user1'}, 'id': 123456},
+        'issue': {
+            'pull_request': {'url': f'https://api.github.com/repos/user1/repo1/pulls/{number}'},
+            'user': {'login': 'user1'},
+            'number': number,
+        },
+        'repository': {'full_name': 'user1/repo1', 'owner': {'login': 'user1'}},
+    }
+
+
+def test_push_then_branch_trigger(dummy_server: DummyServer, client: Client, redis_cli: redis.Redis):
+    redis_cli.set('config_user1/repo1', RepoConfig().model_dump_json())
+    redis_cli.set('config_user1/repo1_feature', RepoConfig(request_update_trigger='eggs').model_dump_json())
+    redis_cli.sadd('config_triggers_user1/repo1', 'please update', 'please review', 'eggs')
+    redis_cli.set('pr_base_ref_user1/repo1_123', 'feature')
+
+    r = client.webhook(push_event('refs/heads/main', 'pyproject.toml'), event_name='push')
+    assert r.text == '[Config] cached config for main reloaded'
+    # a comment on a PR into main loads main's new config
+    r = client.webhook(pr_comment('please update', 124))
+    assert r.status_code == 200, r.text
+
+    # the PR into "feature" still uses its custom trigger, so the comment mustn't be skipped by the prefilter
+    r = client.webhook(pr_comment('eggs', 123))
+    assert r.status_code == 200, r.text
+    assert r.text == (
+        '[Label and assign] Author user1 successfully assigned to PR, "awaiting author revision" label added'
+    )
+    assert stats.snapshot()['counters'].get('label_assign.prefiltered') is None
+
+
+@pytest.mark.parametrize(
+    'event,response',
+    [
+        (push_event('refs/heads/main'), 'Ignoring push event, config not changed, no action taken'),
+        (push_event('refs/heads/main', 'docs/pyproject.toml'), '[Config] config not changed on main, no action taken'),
+        (push_event('refs/tags/v1', 'pyproject.toml'), '[Config] refs/tags/v1 is not a branch, no action taken'),
+    ],
+)
+def test_push_ignored(dummy_server: DummyServer, client: Client, redis_cli: redis.Redis, event: dict, response: str):
+    set_config_keys(redis_cli)
+    r = client.webhook(event, event_name='push')
+    assert r.status_code == 202, r.text
+    assert r.text == response
+    assert len(redis_cli.keys('config_*')) == 4
+
+
+def set_collaborator_keys(redis_cli: redis.Redis) -> None:
+    for repo in 'user1/repo1', 'user1/repo2', 'other/repo1':
+        redis_cli.sadd(f'collaborators_{repo}', '', 'user1')
+        redis_cli.sadd(f'collaborators_repos_{repo.split("/")[0]}', repo)
+
+
+def test_member_event(dummy_server: DummyServer, client: Client, redis_cli: redis.Redis):
+    set_collaborator_keys(redis_cli)
+    r = client.webhook(
+        {
+            'action': 'added',
+            'member': {'login': 'new_user'},
+            'repository': {'full_name': 'user1/repo1', 'owner': {'login': 'user1'}},
+            'installation': {'id': 654321},
+        },
+        event_name='member',
+    )
+    assert r.status_code == 200, r.text
+    assert r.text == '[Collaborators] cached collaborators for user1/repo1 cleared'
+    assert sorted(redis_cli.keys('collaborators_user1/*')) == [b'collaborators_user1/repo2']
+    assert dummy_server.log == []
+
+
+def test_membership_event(dummy_server: DummyServer, client: Client, redis_cli: redis.Redis):
+    set_collaborator_keys(redis_cli)
+    r = client.webhook(
+        {
+            'action': 'removed',
+            'scope': 'team',
+            'member': {'login': 'user2'},
+            'team': {'name': 'reviewers'},
+            'organization': {'login': 'user1'},
+            'installation': {'id': 654321},
+        },
+        event_name='membership',
+    )
+    assert r.status_code == 200, r.text
+    assert r.text == '[Collaborators] cached collaborators for 2 user1 repos cleared'
+    assert sorted(redis_cli.keys('collaborators_*')) == [b'collaborators_other/repo1', b'collaborators_repos_other']
+
+
+def test_team_event_ignored(client: Client, redis_cli: redis.Redis):
+    r = client.webhook({'action': 'created', 'organization': {'login': 'user1'}}, event_name='team')
+    assert r.status_code == 202, r.text
+    assert r.text == 'Ignoring event action "created", no action taken'
+
+
+@pytest.mark.parametrize(
+    'request_body,action',
+    [
+        (b'{"action": "opened", "issue": {}}', 'opened'),
+        (b'  {\n  "action":"created"}', 'created'),
+        (b'{"issue": {"action": "nested"}, "action": "closed"}', 'closed'),
+        (b'{"issue": {}}', None),
+        (b'not json', None),
+    ],
+)
+def test_extract_action(request_body: bytes, action: str | None):
+    assert extract_action(request_body) == action
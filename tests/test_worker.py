@@ -0,0 +1,208 @@
+import json
+
+import httpx
+import pytest
+import redis
+from pytest_mock import MockerFixture
+
+from src import stats
+from src.github_client import GithubError
+from src.rate_limit import RateLimitExceeded
+from src.settings import Settings
+from src.worker import StreamWorker
+
+from .conftest import Client
+
+
+def test_webhook_stream(client: Client, settings: Settings, redis_cli: redis.Redis, mocker: MockerFixture):
+    mocker.patch.object(settings, 'event_processing', 'stream')
+    r = client.webhook({'action': 'opened'})
+    assert r.status_code == 202, r.text
+    assert r.text == 'Event queued'
+    r = client.webhook({'action': 'opened'}, event_name='issues')
+    assert r.status_code == 202, r.text
+    entries = redis_cli.xrange(settings.stream_name)
+    assert [fields for _, fields in entries] == [
+        {b'body': b'{"action": "opened"}'},
+        {b'body': b'{"action": "opened"}', b'event': b'issues'},
+    ]
+
+
+def test_stream_delivery_saved_by_worker(client: Client, settings: Settings, loop, redis_cli: redis.Redis, mocker):
+    mocker.patch.object(settings, 'event_processing', 'stream')
+    r = client.webhook({'action': 'opened'}, delivery_id='abc123')
+    assert r.text == 'Event queued'
+    # the "queued" response isn't the result, only the short claim is kept until the event is processed
+    assert redis_cli.get('delivery_abc123') == b'pending'
+    assert redis_cli.ttl('delivery_abc123') <= settings.delivery_pending_timeout
+    r = client.webhook({'action': 'opened'}, delivery_id='abc123')
+    assert r.text == 'Delivery abc123 is already being processed'
+    [(_, fields)] = redis_cli.xrange(settings.stream_name)
+    assert fields == {b'body': b'{"action": "opened"}', b'delivery': b'abc123'}
+
+    mocker.patch('src.worker.process_event', return_value=(True, 'done'))
+    worker = StreamWorker(settings.model_copy(update={'stream_block_ms': 10}), 'worker-1')
+    loop.run_until_complete(worker.create_group())
+    assert loop.run_until_complete(worker.run_once()) == 1
+    assert redis_cli.ttl('delivery_abc123') > settings.delivery_pending_timeout
+    r = client.webhook({'action': 'opened'}, delivery_id='abc123')
+    assert r.status_code == 200, r.text
+    assert r.text == 'done'
+
+
+def test_stream_delivery_released_on_error(settings: Settings, loop, redis_cli: redis.Redis, mocker: MockerFixture):
+    mocker.patch('src.worker.process_event', side_effect=ValueError('broken'))
+    redis_cli.set('delivery_abc123', b'pending')
+    worker = StreamWorker(settings.model_copy(update={'stream_block_ms': 10}), 'worker-1')
+    loop.run_until_complete(worker.create_group())
+    redis_cli.xadd(settings.stream_name, {'body': b'{}', 'delivery': b'abc123'})
+
+    assert loop.run_until_complete(worker.run_once()) == 1
+    assert redis_cli.get('delivery_abc123') is None
+
+
+def test_worker_process(settings: Settings, loop, redis_cli: redis.Redis, mocker: MockerFixture):
+    process_event = mocker.patch('src.worker.process_event', return_value=(True, 'done'))
+    worker = StreamWorker(settings.model_copy(update={'stream_block_ms': 10}), 'worker-1')
+    loop.run_until_complete(worker.create_group())
+    # creating the group twice is fine
+    loop.run_until_complete(worker.create_group())
+    redis_cli.xadd(settings.stream_name, {'body': b'{"a": 1}'})
+    redis_cli.xadd(settings.stream_name, {'body': b'{"a": 2}', 'event': b'issues'})
+
+    assert loop.run_until_complete(worker.run_once()) == 1
+    assert loop.run_until_complete(worker.run_once()) == 1
+    assert loop.run_until_complete(worker.run_once()) == 0
+    assert [(c.kwargs['request_body'], c.kwargs['event_name']) for c in process_event.call_args_list] == [
+        (b'{"a": 1}', None),
+        (b'{"a": 2}', 'issues'),
+    ]
+    assert redis_cli.xpending(settings.stream_name, settings.stream_group)['pending'] == 0
+    assert stats.snapshot()['timings']['stream.process']['count'] == 2
+
+
+def test_worker_reclaim(settings: Settings, loop, redis_cli: redis.Redis, mocker: MockerFixture):
+    process_event = mocker.patch('src.worker.process_event', return_value=(False, 'nothing'))
+    worker_settings = settings.model_copy(update={'stream_block_ms': 10, 'stream_claim_idle_ms': 0})
+    worker = StreamWorker(worker_settings, 'worker-1')
+    loop.run_until_complete(worker.create_group())
+    redis_cli.xadd(settings.stream_name, {'body': b'{"a": 1}'})
+    # a consumer reads the entry then dies without acknowledging it
+    redis_cli.xreadgroup(settings.stream_group, 'dead-worker', {settings.stream_name: '>'}, count=1)
+
+    assert loop.run_until_complete(worker.run_once()) == 1
+    assert process_event.call_count == 1
+    assert redis_cli.xpending(settings.stream_name, settings.stream_group)['pending'] == 0
+    assert stats.snapshot()['counters'] == {'stream.reclaimed': 1}
+
+
+def test_worker_error(settings: Settings, loop, redis_cli: redis.Redis, mocker: MockerFixture, capsys):
+    mocker.patch('src.worker.process_event', side_effect=ValueError('broken'))
+    worker = StreamWorker(settings.model_copy(update={'stream_block_ms': 10}), 'worker-1')
+    loop.run_until_complete(worker.create_group())
+    redis_cli.xadd(settings.stream_name, {'body': b'{}'})
+
+    assert loop.run_until_complete(worker.run_once()) == 1
+    assert redis_cli.xpending(settings.stream_name, settings.stream_group)['pending'] == 0
+    assert stats.snapshot()['counters'] == {'stream.errors': 1}
+    out, err = capsys.readouterr()
+    assert 'ValueError: broken' in out
+
+
+def test_worker_transient_error_retried(settings: Settings, loop, redis_cli: redis.Redis, mocker: MockerFixture):
+    process_event = mocker.patch(
+        'src.worker.process_event', side_effect=[GithubError(502, {'message': 'Server Error'}), (True, 'done')]
+    )
+    worker_settings = settings.model_copy(update={'stream_block_ms': 10, 'stream_claim_idle_ms': 0})
+    worker = StreamWorker(worker_settings, 'worker-1')
+    loop.run_until_complete(worker.create_group())
+    redis_cli.set('delivery_abc123', b'pending')
+    redis_cli.xadd(settings.stream_name, {'body': b'{}', 'delivery': b'abc123'})
+
+    assert loop.run_until_complete(worker.run_once()) == 1
+    # not acknowledged, so the entry is reclaimed and processed again
+    assert redis_cli.xpending(settings.stream_name, settings.stream_group)['pending'] == 1
+    assert redis_cli.get('delivery_abc123') == b'pending'
+
+    assert loop.run_until_complete(worker.run_once()) == 1
+    assert process_event.call_count == 2
+    assert redis_cli.xpending(settings.stream_name, settings.stream_group)['pending'] == 0
+    assert json.loads(redis_cli.get('delivery_abc123')) == {'status_code': 200, 'message': 'done'}
+    assert stats.snapshot()['counters'] == {'stream.errors': 1, 'stream.reclaimed': 1, 'stream.retried': 1}
+
+
+@pytest.mark.parametrize(
+    'error',
+    [
+        httpx.ReadTimeout('timed out'),
+        RateLimitExceeded('installation 654321 rate limited for 600 more seconds'),
+        GithubError(403, {'message': 'You have exceeded a secondary rate limit.'}),
+        GithubError(429, {'message': 'Too many requests'}),
+    ],
+)
+def test_worker_max_deliveries(settings: Settings, loop, redis_cli: redis.Redis, mocker: MockerFixture, error):
+    process_event = mocker.patch('src.worker.process_event', side_effect=error)
+    worker_settings = settings.model_copy(
+        update={'stream_block_ms': 10, 'stream_claim_idle_ms': 0, 'stream_max_deliveries': 2}
+    )
+    worker = StreamWorker(worker_settings, 'worker-1')
+    loop.run_until_complete(worker.create_group())
+    redis_cli.set('delivery_abc123', b'pending')
+    redis_cli.xadd(settings.stream_name, {'body': b'{}', 'delivery': b'abc123'})
+
+    assert loop.run_until_complete(worker.run_once()) == 1
+    assert redis_cli.xpending(settings.stream_name, settings.stream_group)['pending'] == 1
+    assert loop.run_until_complete(worker.run_once()) == 1
+    # given up after the second delivery
+    assert process_event.call_count == 2
+    assert redis_cli.xpending(settings.stream_name, settings.stream_group)['pending'] == 0
+    assert redis_cli.get('delivery_abc123') is None
+    assert stats.snapshot()['counters'] == {'stream.errors': 2, 'stream.reclaimed': 1, 'stream.retried': 1}
+
+
+def test_worker_client_error_not_retried(settings: Settings, loop, redis_cli: redis.Redis, mocker: MockerFixture):
+    mocker.patch('src.worker.process_event', side_effect=GithubError(403, {'message': 'Forbidden'}))
+    worker = StreamWorker(settings.model_copy(update={'stream_block_ms': 10, 'stream_claim_idle_ms': 0}), 'worker-1')
+    loop.run_until_complete(worker.create_group())
+    redis_cli.xadd(settings.stream_name, {'body': b'{}'})
+
+    assert loop.run_until_complete(worker.run_once()) == 1
+    assert redis_cli.xpending(settings.stream_name, settings.stream_group)['pending'] == 0
+    assert stats.snapshot()['counters'] == {'stream.errors': 1}
+
+
+def test_worker_token_refresh_error(settings: Settings, loop, redis_cli: redis.Redis, mocker: MockerFixture, capsys):
+    worker = StreamWorker(settings.model_copy(update={'token_refresh_interval': -1}), 'worker-1')
+    mocker.patch.object(worker, 'run_once', return_value=0)
+
+    async def refresh_tokens(_settings: Settings) -> int:
+        if refresh.call_count == 1:
+            raise httpx.ConnectError('no network')
+        worker.stop()
+        return 0
+
+    refresh = mocker.patch('src.worker.refresh_tokens', side_effect=refresh_tokens)
+    loop.run_until_complete(worker.run())
+    # the worker kept running after the error
+    assert refresh.call_count == 2
+    out, err = capsys.readouterr()
+    assert 'worker-1: error refreshing access tokens:\n  ConnectError: no network' in out
+
+
+def test_worker_redis_error(settings: Settings, loop, redis_cli: redis.Redis, mocker: MockerFixture, capsys):
+    worker = StreamWorker(settings, 'worker-1')
+
+    async def run_once() -> int:
+        if run_once_mock.call_count == 1:
+            raise redis.ConnectionError('Connection refused')
+        worker.stop()
+        return 0
+
+    run_once_mock = mocker.patch.object(worker, 'run_once', side_effect=run_once)
+    mocker.patch('src.worker.redis_error_wait', 0)
+    loop.run_until_complete(worker.run())
+    # the worker kept running after the error
+    assert run_once_mock.call_count == 2
+    assert stats.snapshot()['counters'] == {'stream.redis_errors': 1}
+    out, err = capsys.readouterr()
+    assert 'worker-1: redis error, retrying in 0s:\n  ConnectionError: Connection refused' in out